@@ -0,0 +1,215 @@
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import pty
+import selectors
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import yaml
+from replay import FakeSwitch, expected_bills, load_app, load_transcript, write_configs, POS_DIR
+from messaging import LoopbackBroker
+
+# CPU and memory per lane of the multi-lane runtime (--lanes-config), one
+# fresh process per lane count. Every lane gets a pty pair for its POS and
+# printer, all POS ports are fed the transcript at the same time at the given
+# baud rate while the printers are drained, the lanes share one fake
+# storetracker switch over one connection. Reports CPU while feeding and
+# while idle, RSS growth per lane and bills seen on every lane's mirror topic
+#   python bench/bench_lanes.py --lanes 1 4 16 32 --repeat 20
+# The loopback broker and fake switch run inside the measured process, their
+# share of the CPU is small next to the lanes but it is in the numbers
+
+
+def rss_kb():
+    with open("/proc/self/status", 'r') as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1])
+    return 0
+
+
+def feeder(pos_masters, print_masters, data, bytes_per_sec, settle, conn):
+    # Child process, one thread paces each POS port, the printers are
+    # drained here until they stay quiet for settle seconds
+    def feed(fd):
+        block = 64
+        start = time.monotonic()
+        for offset in range(0, len(data), block):
+            os.write(fd, data[offset:offset + block])
+            if bytes_per_sec:
+                delay = start + (offset + block) / bytes_per_sec - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+
+    selector = selectors.DefaultSelector()
+    for fd in print_masters:
+        os.set_blocking(fd, False)
+        selector.register(fd, selectors.EVENT_READ)
+    received = [0]
+    stop = threading.Event()
+
+    def drain():
+        while not stop.is_set():
+            for key, _ in selector.select(0.1):
+                try:
+                    received[0] += len(os.read(key.fd, 65536))
+                except (BlockingIOError, OSError):
+                    pass
+
+    drainer = threading.Thread(target=drain, daemon=True)
+    drainer.start()
+    start = time.monotonic()
+    threads = [threading.Thread(target=feed, args=(fd,)) for fd in pos_masters]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    end = time.monotonic()
+    last = -1
+    while received[0] != last:
+        last = received[0]
+        time.sleep(settle)
+    stop.set()
+    drainer.join()
+    conn.send((start, end, received[0]))
+
+
+def write_lanes_config(directory, count, pos_path, print_path):
+    pos_ports, print_ports, lanes = [], [], []
+    for index in range(count):
+        pos_master, pos_slave = pty.openpty()
+        print_master, print_slave = pty.openpty()
+        pos_ports.append((pos_master, pos_slave))
+        print_ports.append((print_master, print_slave))
+        lanes.append({"name": "lane{}".format(index + 1), "checkout_id": index + 1,
+                      "pos_port": os.ttyname(pos_slave), "printer_port": os.ttyname(print_slave),
+                      "pos_config": pos_path, "printer_config": print_path})
+    path = os.path.join(directory, "lanes_config.yaml")
+    with open(path, 'w') as f:
+        yaml.safe_dump({"service": "pos-lanes", "LANES": lanes}, f)
+    return path, pos_ports, print_ports
+
+
+def measure(args):
+    entries = load_transcript(args.transcript) * args.repeat
+    data = b"".join(payload for _, payload in entries)
+
+    broker = LoopbackBroker()
+    bills = {}
+    broker.listeners.append(lambda topic, payload: bills.__setitem__(topic, bills.get(topic, 0) + 1)
+                            if topic.startswith("pos/billing/mirror/") else None)
+    switch = FakeSwitch()
+    directory = tempfile.mkdtemp(prefix="bench-lanes-")
+    pos_path, print_path, switch_path = write_configs(directory, "/dev/null", "/dev/null", True)
+    lanes_path, pos_ports, print_ports = write_lanes_config(directory, args.child, pos_path, print_path)
+
+    pos_app = load_app("pos_app", POS_DIR)
+    from switch_client import SwitchClient
+    with open(switch_path, 'r') as f:
+        client = SwitchClient(yaml.safe_load(f), "127.0.0.1", switch.port)
+    rss_before = rss_kb()
+    threads_before = threading.active_count()
+    posif = pos_app.POSInterface(pos_path, print_path, bill_sink=client.submit, lanes_config=lanes_path,
+                                 config_cache=os.path.join(directory, "config_cache"), mqtt_backend=broker.client)
+    expected = expected_bills(entries, posif._lanes[0].transactions is not None)
+    expected_accs = sum(1 for bill_ok in expected if bill_ok) * args.child
+    client.start()
+    threading.Thread(target=lambda: asyncio.run(posif.run_async()), name="pos-lanes", daemon=True).start()
+    time.sleep(0.5)
+    rss_setup = rss_kb()
+
+    # Idle first, a lane with nothing to read should cost nothing
+    cpu = time.process_time()
+    time.sleep(args.idle)
+    idle_cpu = time.process_time() - cpu
+
+    parent, child = multiprocessing.Pipe()
+    proc = multiprocessing.Process(target=feeder, args=([m for m, _ in pos_ports], [m for m, _ in print_ports],
+                                                        data, args.baud / 10.0, args.settle, child))
+    cpu = time.process_time()
+    proc.start()
+    start, end, printed = parent.recv()
+    proc.join()
+    # Until every lane has classified everything it was sent
+    total = -1
+    while True:
+        count = sum(lane.latency.snapshot()["pos.classify"].get("count", 0) for lane in posif._lanes)
+        if count == total and not any(lane.reader.pending() for lane in posif._lanes):
+            break
+        total = count
+        time.sleep(0.5)
+    posif.messenger.flush()
+    busy_cpu = time.process_time() - cpu
+    busy_wall = time.monotonic() - start
+    deadline = time.monotonic() + args.settle + 2
+    while len(switch.arrivals) < expected_accs and time.monotonic() < deadline:
+        time.sleep(0.05)
+    rss_after = rss_kb()
+
+    lanes = args.child
+    return {
+        "lanes": lanes,
+        "bytes_per_lane": len(data),
+        "feed_seconds": round(end - start, 2),
+        "frames": total,
+        "bills_expected": len(expected) * lanes,
+        "bills_observed": sum(bills.values()),
+        "lanes_with_all_bills": sum(1 for count in bills.values() if count == len(expected)),
+        "accs_expected": expected_accs,
+        "accs": len(switch.arrivals),
+        "printer_bytes": printed,
+        "printer_expected": len(data) * lanes,
+        "cpu_pct": round(100.0 * busy_cpu / busy_wall, 2),
+        "cpu_pct_per_lane": round(100.0 * busy_cpu / busy_wall / lanes, 3),
+        "idle_cpu_pct": round(100.0 * idle_cpu / args.idle, 3),
+        "rss_mb": round(rss_after / 1024.0, 1),
+        "rss_kb_per_lane": round((rss_setup - rss_before) / lanes, 1),
+        "threads_per_lane": round((threading.active_count() - threads_before) / lanes, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='bench_lanes.py', description='Multi-lane CPU and memory benchmark')
+    parser.add_argument('transcript', nargs='?', default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                                      "transcripts", "grocery.txt"))
+    parser.add_argument('--lanes', type=int, nargs='+', default=[1, 4, 8, 16, 32])
+    parser.add_argument('--repeat', type=int, default=20, help="transcript repeats per lane")
+    parser.add_argument('--baud', type=int, default=38400, help="feed rate of every POS port, 0 as fast as possible")
+    parser.add_argument('--idle', type=float, default=2.0, help="seconds of idle CPU measured before feeding")
+    parser.add_argument('--settle', type=float, default=0.5)
+    parser.add_argument('--json', action='store_true')
+    parser.add_argument('--child', type=int, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.ERROR, format='%(asctime)s %(message)s')
+
+    if args.child is not None:
+        print(json.dumps(measure(args)), flush=True)
+        os._exit(0)
+
+    results = []
+    for count in args.lanes:
+        # A fresh process per count so RSS is not carried over
+        command = [sys.executable, os.path.abspath(__file__), args.transcript, "--child", str(count),
+                   "--repeat", str(args.repeat), "--baud", str(args.baud), "--idle", str(args.idle),
+                   "--settle", str(args.settle)]
+        output = subprocess.run(command, check=True, stdout=subprocess.PIPE, text=True).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    columns = ("lanes", "bills_observed", "bills_expected", "accs", "cpu_pct", "cpu_pct_per_lane", "idle_cpu_pct",
+               "rss_mb", "rss_kb_per_lane", "threads_per_lane")
+    print(" ".join("{:>16}".format(column) for column in columns))
+    for result in results:
+        print(" ".join("{:>16}".format(result[column]) for column in columns))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+import argparse
+import os
+import random
+import string
+import sys
+import timeit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "pos-interface"))
+
+import yaml
+from matcher import LineMatcher, CATEGORY_GENERIC, CATEGORY_SUCCESS, CATEGORY_FAILURE
+
+# Compares the compiled LineMatcher against the any() chains it replaced
+#   python bench/bench_matcher.py --sizes 10 100 1000
+
+RECEIPT = [
+    "        RADFORD GROCERY STORE\n",
+    "  12 High Street, Radford\n",
+    "MILK 2L                       2.49\n",
+    "BREAD WHOLEMEAL               1.20\n",
+    "BANANAS 1.2kg @ 0.99/kg       1.19\n",
+    "SUBTOTAL                      4.88\n",
+    "VISA ************1234\n",
+    "AUTH CODE 0X31A2\n",
+    "valid payment\n",
+    "TRANSACTION 000123 TILL 4\n",
+    "Thank you for shopping with us\n",
+    "\n",
+]
+
+
+def random_word(rng, low=6, high=24):
+    return "".join(rng.choice(string.ascii_lowercase + " ") for _ in range(rng.randint(low, high))).strip() or "x"
+
+
+def make_config(size, seed=0):
+    with open(os.path.join(ROOT, "pos-interface", "config", "pos_config.yaml"), 'r') as f:
+        config = yaml.safe_load(f)
+    rng = random.Random(seed)
+    # Pad each category up to size/3 patterns with vendor-like noise
+    for section in ("GENERIC_STRINGS", "SUCCESS_STRINGS", "FAILURE_STRINGS"):
+        strings = list(config[section])
+        while len(strings) < max(size // 3, len(config[section])):
+            strings.append(random_word(rng))
+        config[section] = strings
+    return config
+
+
+def any_chain(config):
+    generic = config["GENERIC_STRINGS"]
+    success = config["SUCCESS_STRINGS"]
+    failure = config["FAILURE_STRINGS"]
+
+    def classify(line):
+        if any(string in line for string in generic):
+            return CATEGORY_GENERIC
+        elif any(string in line for string in success):
+            return CATEGORY_SUCCESS
+        elif any(string in line for string in failure):
+            return CATEGORY_FAILURE
+        return None
+    return classify
+
+
+def compiled(config):
+    matcher = LineMatcher.from_config(config)
+
+    def classify(line):
+        result = matcher.match(line)
+        return result[0] if result else None
+    return classify
+
+
+def run(sizes, number):
+    print("{:>6} {:>14} {:>14} {:>8}".format("rules", "any() us/line", "match us/line", "speedup"))
+    for size in sizes:
+        config = make_config(size)
+        old = any_chain(config)
+        new = compiled(config)
+        for line in RECEIPT:
+            assert old(line) == new(line), line
+
+        def loop(fn):
+            for line in RECEIPT:
+                fn(line)
+        t_old = min(timeit.repeat(lambda: loop(old), number=number, repeat=5))
+        t_new = min(timeit.repeat(lambda: loop(new), number=number, repeat=5))
+        per_line = number * len(RECEIPT) / 1e6
+        print("{:>6} {:>14.2f} {:>14.2f} {:>7.1f}x".format(size, t_old / per_line, t_new / per_line, t_old / t_new))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='bench_matcher.py', description='Line matcher micro-benchmark')
+    parser.add_argument('--sizes', nargs='+', type=int, default=[10, 100, 1000])
+    parser.add_argument('--number', type=int, default=2000, help="receipts per timing run")
+    args = parser.parse_args()
+    run(args.sizes, args.number)
@@ -0,0 +1,159 @@
+import argparse
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "common"))
+
+from latency import LatencyHistogram, now_ns
+from messaging import Messenger, encode, KIND_STATUS, KIND_BILL
+from mqtt_broker import MiniBroker
+
+# Publish throughput and latency of the services' MQTT events per QoS level,
+# real paho clients through Messenger against the MiniBroker stand-in on
+# 127.0.0.1. For every QoS:
+#   unpaced: --count status events as fast as publish() takes them, events
+#            per second until the last one reached the subscriber
+#   paced:   --paced-count events at --rate per second, publish() call time
+#            and end to end latency from the envelope's monotonic stamp
+#   away:    the subscriber disconnects, --away events are published, then it
+#            comes back with the same persistent session, how many arrive
+#   python bench/bench_mqtt.py --qos 0 1 2
+# paho keeps at most 20 QoS 1/2 messages in flight, the unpaced QoS 1/2 rate
+# is bound by broker round trips on purpose, that is what the services get
+
+TOPIC = "bench/events"
+
+
+class Subscriber:
+    def __init__(self, port, qos, client_id):
+        self.lock = threading.Lock()
+        self.count = 0
+        self.last_ns = 0
+        self.latency = LatencyHistogram()
+        self.messenger = Messenger(client_id, host="127.0.0.1", port=port, qos_events=qos, batch_interval=0)
+        self.messenger.subscribe(TOPIC, self._on_event)
+        self.messenger.start()
+
+    def _on_event(self, message):
+        now = now_ns()
+        with self.lock:
+            self.count += 1
+            self.last_ns = now
+            self.latency.record((now - message.ts_ns) // 1000)
+
+    def reset(self):
+        with self.lock:
+            self.count = 0
+            self.latency.reset()
+
+    def wait(self, count, timeout):
+        deadline = time.monotonic() + timeout
+        while self.count < count and time.monotonic() < deadline:
+            time.sleep(0.001)
+        return self.count
+
+
+def wait_connected(*messengers):
+    deadline = time.monotonic() + 5
+    while not all(m.connected for m in messengers):
+        if time.monotonic() > deadline:
+            raise RuntimeError("No connection to the broker")
+        time.sleep(0.01)
+    # Let the SUBACK in before publishing
+    time.sleep(0.2)
+
+
+def publish(publisher, count, rate, calls):
+    start = time.monotonic()
+    for index in range(count):
+        t = now_ns()
+        publisher.publish_status(TOPIC, index % 2 == 0)
+        calls.record((now_ns() - t) // 1000)
+        if rate:
+            delay = start + (index + 1) / rate - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+
+def measure(qos, args):
+    broker = MiniBroker()
+    sub_id = "bench-sub-{}".format(qos)
+    subscriber = Subscriber(broker.port, qos, sub_id)
+    publisher = Messenger("bench-pub-{}".format(qos), host="127.0.0.1", port=broker.port, qos_events=qos,
+                          batch_interval=0)
+    publisher.start()
+    wait_connected(subscriber.messenger, publisher)
+    result = {"qos": qos}
+
+    calls = LatencyHistogram()
+    start_ns = now_ns()
+    publish(publisher, args.count, 0, calls)
+    delivered = subscriber.wait(args.count, args.timeout)
+    result["unpaced_delivered"] = delivered
+    result["unpaced_per_sec"] = round(delivered / max((subscriber.last_ns - start_ns) / 1e9, 1e-9))
+    result["unpaced_call_us"] = calls.summary()
+
+    subscriber.reset()
+    calls = LatencyHistogram()
+    publish(publisher, args.paced_count, args.rate, calls)
+    result["paced_delivered"] = subscriber.wait(args.paced_count, args.timeout)
+    result["paced_call_us"] = calls.summary()
+    result["paced_e2e_us"] = subscriber.latency.summary()
+    result["duplicates"] = subscriber.messenger.stats["duplicates"]
+    result["gaps"] = subscriber.messenger.stats["gaps"]
+
+    subscriber.messenger.stop()
+    time.sleep(0.2)
+    publish(publisher, args.away, 0, LatencyHistogram())
+    time.sleep(0.2)
+    returned = Subscriber(broker.port, qos, sub_id)
+    result["away_delivered"] = returned.wait(args.away, 2.0)
+    result["away_sent"] = args.away
+
+    returned.messenger.stop()
+    publisher.stop()
+    broker.stop()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='bench_mqtt.py', description='MQTT event throughput and latency per QoS')
+    parser.add_argument('--qos', type=int, nargs='+', default=[0, 1, 2])
+    parser.add_argument('--count', type=int, default=5000, help="unpaced events")
+    parser.add_argument('--paced-count', type=int, default=2000, help="paced events")
+    parser.add_argument('--rate', type=float, default=500, help="paced events per second")
+    parser.add_argument('--away', type=int, default=100, help="events published while the subscriber is away")
+    parser.add_argument('--timeout', type=float, default=10.0)
+    parser.add_argument('--json', action='store_true')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.ERROR, format='%(asctime)s %(message)s')
+
+    results = [measure(qos, args) for qos in args.qos]
+    sizes = {"status_text": len("False"), "status_envelope": len(encode(KIND_STATUS, 1, now_ns(), None, b"\x00")),
+             "bill_text": len("True 1a2b3c4d 123456789012345 123456789012345 9f8e7d6c"),
+             "bill_envelope": len(encode(KIND_BILL, 1, now_ns(), "lane1",
+                                         "True 1a2b3c4d 123456789012345 123456789012345 9f8e7d6c"))}
+    if args.json:
+        print(json.dumps({"results": results, "payload_bytes": sizes}, indent=2))
+        return
+    columns = ("qos", "unpaced_per_sec", "unpaced_call_p99", "paced_call_p50", "paced_call_p99", "e2e_p50", "e2e_p99",
+               "e2e_p99_9", "lost", "away")
+    print(" ".join("{:>16}".format(column) for column in columns))
+    for result in results:
+        row = (result["qos"], result["unpaced_per_sec"], result["unpaced_call_us"].get("p99"),
+               result["paced_call_us"].get("p50"), result["paced_call_us"].get("p99"),
+               result["paced_e2e_us"].get("p50"), result["paced_e2e_us"].get("p99"),
+               result["paced_e2e_us"].get("p99_9"),
+               args.count + args.paced_count - result["unpaced_delivered"] - result["paced_delivered"],
+               "{}/{}".format(result["away_delivered"], result["away_sent"]))
+        print(" ".join("{:>16}".format(value) for value in row))
+    print("payload bytes: {}".format(sizes))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+import argparse
+import logging
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "storetracker-interface"))
+
+from outbox import AccOutbox
+from switch_connection import SwitchConnection
+
+# Sustained enqueue rate and drain rate after a switch outage for the ACC
+# outbox, against a fake storetracker on localhost. Run it with --dir on the
+# SD card to see real fsync costs
+#   python bench/bench_outbox.py --count 2000 --synchronous NORMAL FULL
+
+
+def fake_storetracker():
+    srv = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    srv.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    srv.bind(("127.0.0.1", 0))
+    srv.listen()
+
+    def handle(conn):
+        with conn:
+            while True:
+                data = conn.recv(1024)
+                if not data:
+                    return
+                conn.sendall(b"OK\n")
+
+    def serve():
+        while True:
+            try:
+                conn, _ = srv.accept()
+            except OSError:
+                return
+            threading.Thread(target=handle, args=(conn,), daemon=True).start()
+    threading.Thread(target=serve, daemon=True).start()
+    return srv, srv.getsockname()[1]
+
+
+class Switch:
+    # Send function that can be cut off to simulate an outage
+    def __init__(self, connection):
+        self.connection = connection
+        self.up = True
+
+    def send(self, payload, tag=None):
+        if not self.up:
+            return None
+        return self.connection.send(payload.encode())
+
+
+def wait_for(predicate, timeout=120):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            raise TimeoutError()
+        time.sleep(0.001)
+
+
+def run(directory, synchronous, count, batch_size):
+    srv, port = fake_storetracker()
+    connection = SwitchConnection("127.0.0.1", port)
+    connection.start()
+    switch = Switch(connection)
+    path = os.path.join(directory, "bench_outbox_{}.db".format(synchronous))
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    outbox = AccOutbox(switch.send, path=path, synchronous=synchronous, batch_size=batch_size,
+                       retry_interval=0.05, max_age=0)
+    outbox.start()
+
+    # Sustained: bills arrive back to back while the switch is up
+    start = time.monotonic()
+    for i in range(count):
+        outbox.enqueue("ACC {:014d}{:04d}\n".format(i, 1234))
+    enqueue_time = time.monotonic() - start
+    wait_for(lambda: outbox.stats()["sent"] >= count)
+    sustained_time = time.monotonic() - start
+
+    # Outage: everything queues on disk, then the switch comes back
+    switch.up = False
+    for i in range(count):
+        outbox.enqueue("ACC {:014d}{:04d}\n".format(i, 1234))
+    wait_for(lambda: outbox.stats()["pending"] >= count)
+    start = time.monotonic()
+    switch.up = True
+    wait_for(lambda: outbox.stats()["pending"] == 0)
+    drain_time = time.monotonic() - start
+
+    outbox.stop(timeout=5)
+    connection.stop()
+    srv.close()
+    return count / enqueue_time, count / sustained_time, count / drain_time
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='bench_outbox.py', description='ACC outbox benchmark')
+    parser.add_argument('--count', type=int, default=2000)
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--synchronous', nargs='+', default=["NORMAL", "FULL"])
+    parser.add_argument('--dir', default=None, help="directory for the database, default a temp dir")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    directory = args.dir or tempfile.mkdtemp()
+    print("{:>12} {:>14} {:>16} {:>14}".format("synchronous", "enqueue/s", "sustained ACC/s", "drain ACC/s"))
+    for synchronous in args.synchronous:
+        enqueue_rate, sustained_rate, drain_rate = run(directory, synchronous, args.count, args.batch_size)
+        print("{:>12} {:>14.0f} {:>16.0f} {:>14.0f}".format(synchronous, enqueue_rate, sustained_rate, drain_rate))
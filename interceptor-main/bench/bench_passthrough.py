@@ -0,0 +1,157 @@
+import argparse
+import multiprocessing
+import os
+import pty
+import random
+import sys
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "pos-interface"))
+
+import serial
+import yaml
+from matcher import LineMatcher
+from printer_writer import PrinterWriter
+from serial_reader import FrameReader
+
+# Relays a receipt stream POS pty -> interceptor -> printer pty at a paced
+# baud rate and reports CPU per MB, delivered bytes and errors for the old
+# readline/decode/encode path and the passthrough path
+#   python bench/bench_passthrough.py --bauds 38400 115200 --receipts 40
+
+
+def make_receipt(rng):
+    # Text lines plus what breaks decode: a raster logo, a code page switch
+    # with a latin-1 pound sign and a barcode
+    logo = b"\x1dv0\x00\x30\x00\x18\x00" + bytes(rng.getrandbits(8) for _ in range(48 * 24))
+    lines = [
+        b"\x1b@", logo, b"\n",
+        b"\x1ba\x01        RADFORD GROCERY STORE\n\x1ba\x00",
+        b"MILK 2L                       2.49\n",
+        b"\x1bt\x10BREAD WHOLEMEAL              \xa31.20\n",
+        b"SUBTOTAL                      3.69\n",
+        b"VISA ************1234\n",
+        b"valid payment\n",
+        b"\x1dk\x04012345678901\x00\n",
+        b"Thank you for shopping with us\n",
+        b"\x1dVA\x03",
+    ]
+    return b"".join(lines)
+
+
+def feeder(pos_master, print_master, data, baud, conn):
+    # Child process, paces the POS side and drains the printer side
+    received = bytearray()
+    done = threading.Event()
+
+    def drain():
+        while not done.is_set() or len(received) < len(data):
+            try:
+                chunk = os.read(print_master, 4096)
+            except OSError:
+                break
+            received.extend(chunk)
+            if len(received) >= len(data):
+                break
+    t = threading.Thread(target=drain, daemon=True)
+    t.start()
+
+    bytes_per_sec = baud / 10.0
+    block = 64
+    start = time.monotonic()
+    for offset in range(0, len(data), block):
+        os.write(pos_master, data[offset:offset + block])
+        due = start + (offset + block) / bytes_per_sec
+        delay = due - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+    feed_time = time.monotonic() - start
+    t.join(timeout=3)
+    done.set()
+    conn.send((feed_time, bytes(received)))
+
+
+def relay_legacy(pos, printer, matcher, stop, counters):
+    # What POSInterface.run did before, readline then decode/encode per line
+    pos.timeout = 0.2
+    while not stop.is_set():
+        try:
+            raw = pos.readline()
+            if not raw:
+                continue
+            line = raw.decode('utf-8')
+            matcher.match(line)
+            printer.write(line.encode())
+        except Exception:
+            counters["errors"] += 1
+
+
+def relay_passthrough(pos, printer, matcher, stop, counters):
+    writer = PrinterWriter(printer, policy="block")
+    writer.start()
+    reader = FrameReader(pos, on_chunk=writer.put)
+    while not stop.is_set():
+        try:
+            frame = reader.read_frame()
+            if frame is not None:
+                matcher.match_bytes(frame)
+        except Exception:
+            counters["errors"] += 1
+    writer.stop(timeout=1)
+
+
+def run_one(mode, baud, data, matcher):
+    pos_master, pos_slave = pty.openpty()
+    print_master, print_slave = pty.openpty()
+    pos = serial.Serial(os.ttyname(pos_slave), baud)
+    printer = serial.Serial(os.ttyname(print_slave), baud)
+
+    parent, child = multiprocessing.Pipe()
+    proc = multiprocessing.Process(target=feeder, args=(pos_master, print_master, data, baud, child))
+    stop = threading.Event()
+    counters = {"errors": 0}
+    relay = relay_legacy if mode == "legacy" else relay_passthrough
+    t = threading.Thread(target=relay, args=(pos, printer, matcher, stop, counters))
+
+    cpu = time.process_time()
+    t.start()
+    proc.start()
+    feed_time, received = parent.recv()
+    stop.set()
+    t.join()
+    cpu = time.process_time() - cpu
+    proc.join()
+    for fd in (pos_master, print_master):
+        os.close(fd)
+    pos.close()
+    printer.close()
+    return {
+        "cpu_ms_per_mb": cpu * 1000 / (len(data) / 1e6),
+        "kb_per_sec": len(received) / feed_time / 1000,
+        "exact": received == data,
+        "delivered": len(received) / len(data),
+        "errors": counters["errors"],
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='bench_passthrough.py', description='Printer relay benchmark')
+    parser.add_argument('--bauds', nargs='+', type=int, default=[38400, 115200])
+    parser.add_argument('--receipts', type=int, default=40)
+    args = parser.parse_args()
+
+    with open(os.path.join(ROOT, "pos-interface", "config", "pos_config.yaml"), 'r') as f:
+        matcher = LineMatcher.from_config(yaml.safe_load(f))
+    rng = random.Random(0)
+    data = b"".join(make_receipt(rng) for _ in range(args.receipts))
+
+    print("{} bytes per run".format(len(data)))
+    print("{:>7} {:>12} {:>12} {:>8} {:>6} {:>10} {:>7}".format(
+        "baud", "mode", "cpu ms/MB", "kB/s", "exact", "delivered", "errors"))
+    for baud in args.bauds:
+        for mode in ("legacy", "passthrough"):
+            r = run_one(mode, baud, data, matcher)
+            print("{:>7} {:>12} {:>12.0f} {:>8.1f} {:>6} {:>9.1%} {:>7}".format(
+                baud, mode, r["cpu_ms_per_mb"], r["kb_per_sec"], str(r["exact"]), r["delivered"], r["errors"]))
@@ -0,0 +1,243 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import pty
+import tempfile
+import threading
+import time
+
+import yaml
+from replay import FakeSwitch, load_app, write_configs, POS_DIR, STORETRACKER_DIR
+from messaging import Messenger
+from mqtt_broker import MiniBroker
+
+# Recovery time of the in-process supervisor. Runs the real POSInterface on
+# ptys with real paho clients against the MiniBroker stand-in, breaks one
+# component at a time and times it from the fault until the supervisor has it
+# back and work flows through it again:
+#   printer - the printer writer thread dies, a queued line must still print
+#   reader  - the POS loop fails MAX_READ_ERRORS + 1 times in a row, the next
+#             bill must come out
+#   mqtt    - the paho network thread dies, a status event must reach the broker
+#   switch  - (unified) the ACC outbox thread dies, the next ACC must arrive
+#   python bench/bench_recovery.py --runtime split
+# A container restart costs the full init sequence on top of Docker's delay,
+# several seconds, these are the numbers to hold against it. Errors are
+# logged, except the ones the injected faults cause
+#   python bench/bench_recovery.py --log-level WARNING
+
+
+class Fault(Exception):
+    def __init__(self, what):
+        super().__init__("injected fault: {}".format(what))
+
+
+def quiet_faults(args, hook=threading.excepthook):
+    # A thread ended by an injected fault is expected, anything else is shown
+    if not issubclass(args.exc_type, Fault):
+        hook(args)
+
+
+class FaultFilter(logging.Filter):
+    # Drops log records about an injected fault
+    def filter(self, record):
+        if record.exc_info and record.exc_info[0] is not None and issubclass(record.exc_info[0], Fault):
+            return False
+        return "injected fault" not in record.getMessage()
+
+
+def wait_for(condition, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.001)
+    return True
+
+
+class Rig:
+    def __init__(self, runtime):
+        self.broker = MiniBroker()
+        self.switch = FakeSwitch()
+        directory = tempfile.mkdtemp(prefix="recovery-")
+        self.pos_master, pos_slave = pty.openpty()
+        self.print_master, print_slave = pty.openpty()
+        os.set_blocking(self.print_master, False)
+        pos_path, print_path, switch_path = write_configs(directory, os.ttyname(pos_slave), os.ttyname(print_slave),
+                                                          False, False)
+        for path in (pos_path, switch_path):
+            with open(path, 'r') as f:
+                config = yaml.safe_load(f)
+            config['SETTINGS'].setdefault('MQTT', {}).update({'port': self.broker.port, 'batch_interval': 0})
+            with open(path, 'w') as f:
+                yaml.safe_dump(config, f)
+
+        self.events = []
+        self.watcher = Messenger("recovery-watcher", port=self.broker.port, batch_interval=0)
+        self.watcher.subscribe("#", lambda message: self.events.append((message.topic, message.text())))
+        self.watcher.start()
+        wait_for(lambda: self.watcher.connected)
+
+        pos_app = load_app("pos_app", POS_DIR)
+        cache = os.path.join(directory, "config_cache")
+        if runtime == "unified":
+            from switch_client import SwitchClient
+            with open(switch_path, 'r') as f:
+                self.client = SwitchClient(yaml.safe_load(f), "127.0.0.1", self.switch.port)
+            self.posif = pos_app.POSInterface(pos_path, print_path, bill_sink=self.client.submit, config_cache=cache)
+            self.client.start()
+            self.posif.supervisor.add("switch", alive=self.client.alive, restart=self.client.restart)
+            target = lambda: asyncio.run(self.posif.run_async())
+        else:
+            storetracker_app = load_app("storetracker_app", STORETRACKER_DIR)
+            self.storetracker = storetracker_app.SwitchInterface(switch_path, "127.0.0.1", self.switch.port,
+                                                                 config_cache=cache)
+            threading.Thread(target=self.storetracker.run, name="storetracker", daemon=True).start()
+            self.posif = pos_app.POSInterface(pos_path, print_path, config_cache=cache)
+            target = self.posif.run
+        threading.Thread(target=target, name="pos-interface", daemon=True).start()
+        self.lane = self.posif._lanes[0]
+        wait_for(lambda: self.posif.messenger.connected)
+        time.sleep(0.3)
+
+    def restarts(self, name):
+        return self.posif.supervisor.stats()[name]["restarts"]
+
+    def recovered(self, name, restarts):
+        stats = self.posif.supervisor.stats()[name]
+        return stats["restarts"] > restarts and stats["state"] == "up"
+
+    def printed(self):
+        try:
+            return os.read(self.print_master, 65536)
+        except BlockingIOError:
+            return b""
+
+    def bills(self):
+        return sum(1 for topic, _ in self.events if topic.startswith("pos/billing"))
+
+
+def fault_printer(rig):
+    name = rig.lane.topic("printer")
+    restarts = rig.restarts(name)
+    rig.printed()
+    writer = rig.lane.print_writer
+
+    def die():
+        raise Fault("printer writer")
+    writer._take_batch = die
+    events = len(rig.events)
+    start = time.monotonic()
+    rig.lane.print_writer.put(b"after the fault\n")
+    wait_for(lambda: rig.recovered(name, restarts))
+    out = bytearray()
+    wait_for(lambda: out.extend(rig.printed()) or b"after the fault" in out)
+    # The restarted writer is reported up again on printer/init
+    topic = rig.lane.topic("printer/init")
+    republished = wait_for(lambda: any(t == topic for t, _ in rig.events[events:]))
+    return time.monotonic() - start, b"after the fault" in out and republished
+
+
+def fault_reader(rig):
+    name = rig.lane.topic("pos")
+    restarts = rig.restarts(name)
+    handle = rig.lane.handle_frame
+    failures = [0]
+
+    def failing(frame):
+        failures[0] += 1
+        raise Fault("reader")
+    rig.lane.handle_frame = failing
+    start = time.monotonic()
+    # One line at a time like a till, each one a failed read
+    for _ in range(6):
+        os.write(rig.pos_master, b"garbage\n")
+        time.sleep(0.01)
+    wait_for(lambda: failures[0] >= 6)
+    rig.lane.handle_frame = handle
+    wait_for(lambda: rig.recovered(name, restarts))
+    bills = rig.bills()
+    os.write(rig.pos_master, b"valid payment\n")
+    ok = wait_for(lambda: rig.bills() > bills)
+    return time.monotonic() - start, ok
+
+
+def fault_mqtt(rig):
+    restarts = rig.restarts("mqtt")
+    client = rig.posif.messenger._client
+    on_message = client.on_message
+
+    def die(*args):
+        client.on_message = on_message
+        raise Fault("paho callback")
+    client.on_message = die
+    start = time.monotonic()
+    rig.watcher.publish("metrics/dump", "")
+    wait_for(lambda: rig.recovered("mqtt", restarts))
+    events = len(rig.events)
+    rig.posif.publish_status("pos/init", True)
+    ok = wait_for(lambda: len(rig.events) > events)
+    return time.monotonic() - start, ok
+
+
+def fault_switch(rig):
+    restarts = rig.restarts("switch")
+    outbox = rig.client._outbox
+    flush = outbox._flush_incoming
+
+    def die():
+        outbox._flush_incoming = flush
+        raise Fault("outbox")
+    outbox._flush_incoming = die
+    start = time.monotonic()
+    accs = len(rig.switch.arrivals)
+    os.write(rig.pos_master, b"valid payment\n")
+    wait_for(lambda: rig.recovered("switch", restarts))
+    ok = wait_for(lambda: len(rig.switch.arrivals) > accs)
+    return time.monotonic() - start, ok
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='bench_recovery.py', description='In-process recovery times')
+    parser.add_argument('--runtime', default="split", choices=["split", "unified"])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--json', action='store_true')
+    parser.add_argument('--log-level', default="ERROR")
+    args = parser.parse_args()
+    logging.basicConfig(level=args.log_level.upper(), format='%(asctime)s %(message)s')
+    for handler in logging.getLogger().handlers:
+        handler.addFilter(FaultFilter())
+    threading.excepthook = quiet_faults
+
+    rig = Rig(args.runtime)
+    faults = [("printer", fault_printer), ("reader", fault_reader), ("mqtt", fault_mqtt)]
+    if args.runtime == "unified":
+        faults.append(("switch", fault_switch))
+    results = {}
+    for name, fault in faults:
+        times, recovered = [], 0
+        for _ in range(args.repeat):
+            seconds, ok = fault(rig)
+            times.append(seconds * 1000)
+            recovered += 1 if ok else 0
+            # Past stable_after is not waited for, later runs show the backoff
+            time.sleep(0.2)
+        times.sort()
+        results[name] = {"recovered": "{}/{}".format(recovered, args.repeat),
+                         "ms_min": round(times[0], 1), "ms_median": round(times[len(times) // 2], 1),
+                         "ms_max": round(times[-1], 1)}
+    results["supervisor"] = rig.posif.supervisor.stats()
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    for name, _ in faults:
+        print("{:>8} recovered {:>5}  min {:>7}ms  median {:>7}ms  max {:>7}ms".format(
+            name, results[name]["recovered"], results[name]["ms_min"], results[name]["ms_median"],
+            results[name]["ms_max"]))
+    os._exit(0)
+
+
+if __name__ == '__main__':
+    main()
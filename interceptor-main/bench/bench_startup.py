@@ -0,0 +1,236 @@
+import argparse
+import json
+import logging
+import os
+import pty
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import yaml
+from replay import FakeSwitch, write_configs, POS_DIR, STORETRACKER_DIR
+from messaging import Messenger
+from mqtt_broker import MiniBroker
+
+# Cold start of the services as separate processes, the way a container
+# restart runs them: python app.py on ptys for the POS and the printer, a
+# fresh MiniBroker for MQTT and the fake switch. From the moment the process
+# is spawned the lane prints a "valid payment" line every --line-interval
+# seconds. A real UART drops what arrives while nobody has the port open, so
+# lines due before the service opened the POS port are counted as lost
+# instead of written. Per run:
+#   pos_open_ms   spawn to the POS port open, seen in /proc/<pid>/fd
+#   first_byte_ms process start to the first POS byte read, from the
+#                 service's metrics/startup report
+#   first_acc_ms  spawn to the first ACC at the switch
+#   lost_lines    lines due before the port was open, bills a restart costs
+# plus the service's own milestones. --bytecode cold runs without any cached
+# bytecode (a fresh PYTHONPYCACHEPREFIX), --config-cache cold without the
+# compiled config cache, --fast-start sets SETTINGS.STARTUP.fast_start.
+#   python bench/bench_startup.py --runtime unified --runs 5
+
+LINE = b"valid payment\n"
+
+
+def median(values):
+    values = sorted(value for value in values if value is not None)
+    return values[len(values) // 2] if values else None
+
+
+class Run:
+    def __init__(self, args, directory, switch, broker_port, index):
+        self.args = args
+        # A fresh broker every run, on the same port so the configs stay the
+        # same and a warm config cache is hit
+        self.broker = MiniBroker(port=broker_port)
+        self.switch = switch
+        self.accs = len(switch.arrivals)
+        self.reports = {}
+        self.watcher = Messenger("startup-watcher", port=self.broker.port, batch_interval=0)
+        self.watcher.subscribe("metrics/startup/#", self._on_report)
+        self.watcher.start()
+        self.pos_master, pos_slave = pty.openpty()
+        self.print_master, print_slave = pty.openpty()
+        os.set_blocking(self.print_master, False)
+        # The bench keeps the slaves open, the pty would hang up otherwise
+        self._slaves = (pos_slave, print_slave)
+        self.pos_port = os.ttyname(pos_slave)
+        self.print_port = os.ttyname(print_slave)
+        self.processes = []
+        self.log = open(os.path.join(directory, "run-{}.log".format(index)), 'w')
+        self._prepare(directory)
+
+    def _on_report(self, message):
+        self.reports[message.topic.rsplit("/", 1)[-1]] = json.loads(message.text())
+
+    def _prepare(self, directory):
+        for name in ("acc_outbox.db", "acc_outbox.db-wal", "acc_outbox.db-shm", "acc_outbox_unified.db",
+                     "acc_outbox_unified.db-wal", "acc_outbox_unified.db-shm", "printer_spill.bin"):
+            if os.path.exists(os.path.join(directory, name)):
+                os.remove(os.path.join(directory, name))
+        if self.args.config_cache == "cold":
+            shutil.rmtree(os.path.join(directory, "config_cache"), ignore_errors=True)
+        config_dir = os.path.join(directory, "pos", "config")
+        os.makedirs(config_dir, exist_ok=True)
+        os.makedirs(os.path.join(directory, "storetracker", "config"), exist_ok=True)
+        # The ptys change every run, they are given on the command line
+        paths = write_configs(config_dir, "/dev/ttyPOS", "/dev/ttyPRINTER", None, transactions=False)
+        for path in paths:
+            with open(path, 'r') as f:
+                config = yaml.safe_load(f)
+            settings = config['SETTINGS']
+            settings.setdefault('MQTT', {})['port'] = self.broker.port
+            settings['device_cache'] = os.path.join(directory, "device_cache.json")
+            settings.setdefault('DIAGNOSTICS', {})['directory'] = os.path.join(directory, "diagnostics")
+            if self.args.fast_start is not None:
+                settings.setdefault('STARTUP', {})['fast_start'] = self.args.fast_start == "on"
+            with open(path, 'w') as f:
+                yaml.safe_dump(config, f)
+        shutil.copy(paths[2], os.path.join(directory, "storetracker", "config", "switch_config.yaml"))
+
+    def _spawn(self, cwd, app, extra, env):
+        command = [sys.executable, app, "--log-level", "WARNING",
+                   "--config-cache", os.path.join(os.path.dirname(cwd), "config_cache"),
+                   "--switch-ip", "127.0.0.1", "--switch-port", str(self.switch.port)] + extra
+        return subprocess.Popen(command, cwd=cwd, env=env, stdout=self.log, stderr=subprocess.STDOUT)
+
+    def _port_open(self, pid):
+        try:
+            for fd in os.listdir("/proc/{}/fd".format(pid)):
+                if os.readlink("/proc/{}/fd/{}".format(pid, fd)) == self.pos_port:
+                    return True
+        except OSError:
+            pass
+        return False
+
+    def _drain(self, stopped):
+        while not stopped.is_set():
+            try:
+                os.read(self.print_master, 65536)
+            except BlockingIOError:
+                time.sleep(0.005)
+            except OSError:
+                return
+
+    def measure(self, directory):
+        env = dict(os.environ)
+        if self.args.bytecode == "cold":
+            env["PYTHONPYCACHEPREFIX"] = tempfile.mkdtemp(prefix="pycache-", dir=directory)
+        pos_dir = os.path.join(directory, "pos")
+        pos_app = os.path.join(POS_DIR, "app.py")
+        ports = ["--pos-port", self.pos_port, "--print-port", self.print_port, "--runtime", self.args.runtime,
+                 "--outbox-path", os.path.join(directory, "acc_outbox_unified.db")]
+
+        stopped = threading.Event()
+        threading.Thread(target=self._drain, args=(stopped,), daemon=True).start()
+        spawn_ns = time.monotonic_ns()
+        pos = self._spawn(pos_dir, pos_app, ports, env)
+        self.processes.append(pos)
+        if self.args.runtime == "split":
+            self.processes.append(self._spawn(os.path.join(directory, "storetracker"),
+                                              os.path.join(STORETRACKER_DIR, "app.py"), [], env))
+
+        # The lane prints a line every line_interval from the spawn on, the
+        # ones due before the port is open are lost like on a real UART
+        open_ns, lost, written = None, 0, 0
+        deadline = spawn_ns + int(self.args.timeout * 1e9)
+        next_line = spawn_ns
+        while time.monotonic_ns() < deadline and len(self.switch.arrivals) == self.accs:
+            now = time.monotonic_ns()
+            if open_ns is None and self._port_open(pos.pid):
+                open_ns = now
+            if now >= next_line:
+                next_line += int(self.args.line_interval * 1e9)
+                if open_ns is None:
+                    lost += 1
+                else:
+                    os.write(self.pos_master, LINE)
+                    written += 1
+            if pos.poll() is not None:
+                break
+            time.sleep(0.0005)
+        acc_ns = self.switch.arrivals[self.accs] if len(self.switch.arrivals) > self.accs else None
+        # The complete reports go out on the services' next tick once MQTT is
+        # up, they can trail the first ACC by a second or so
+        expected = {"pos-interface": "first_byte"}
+        if self.args.runtime == "split":
+            expected["storetracker-interface"] = "switch"
+        report_deadline = time.monotonic() + 3
+        while time.monotonic() < report_deadline and \
+                any(mark not in self.reports.get(service, {}) for service, mark in expected.items()):
+            time.sleep(0.01)
+
+        for process in self.processes:
+            process.kill()
+            process.wait()
+        stopped.set()
+        self.watcher.stop()
+        self.broker.stop()
+        self.log.close()
+        for fd in (self.pos_master, self.print_master) + self._slaves:
+            os.close(fd)
+        report = self.reports.get("pos-interface", {})
+        return {"pos_open_ms": round((open_ns - spawn_ns) / 1e6, 1) if open_ns else None,
+                "first_byte_ms": report.get("first_byte"),
+                "first_acc_ms": round((acc_ns - spawn_ns) / 1e6, 1) if acc_ns else None,
+                "lost_lines": lost, "written_lines": written,
+                "milestones": {service: {key: value for key, value in report.items() if isinstance(value, (int, float))
+                                         and not isinstance(value, bool)}
+                               for service, report in self.reports.items()}}
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='bench_startup.py', description='Service cold start times')
+    parser.add_argument('--runtime', default="unified", choices=["split", "unified"])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--line-interval', type=float, default=0.02, help="seconds between POS lines")
+    parser.add_argument('--bytecode', default="warm", choices=["warm", "cold"])
+    parser.add_argument('--config-cache', default="warm", choices=["warm", "cold"])
+    parser.add_argument('--fast-start', default=None, choices=["on", "off"], help="default: as in pos_config.yaml")
+    parser.add_argument('--timeout', type=float, default=20.0)
+    parser.add_argument('--max-first-byte-ms', type=float, default=None, help="exit 1 when the median is above")
+    parser.add_argument('--max-first-acc-ms', type=float, default=None, help="exit 1 when the median is above")
+    parser.add_argument('--json', action='store_true')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.CRITICAL, format='%(asctime)s %(message)s')
+
+    directory = tempfile.mkdtemp(prefix="startup-")
+    switch = FakeSwitch()
+    with socket.create_server(("127.0.0.1", 0)) as probe:
+        broker_port = probe.getsockname()[1]
+    # A first run fills the bytecode and config caches the warm runs use
+    Run(args, directory, switch, broker_port, "warmup").measure(directory)
+    runs = [Run(args, directory, switch, broker_port, index).measure(directory) for index in range(args.runs)]
+
+    summary = {key: median(run[key] for run in runs)
+               for key in ("pos_open_ms", "first_byte_ms", "first_acc_ms", "lost_lines")}
+    milestones = {}
+    for run in runs:
+        for service, marks in run["milestones"].items():
+            for key, value in marks.items():
+                milestones.setdefault(service, {}).setdefault(key, []).append(value)
+    summary["milestones"] = {service: {key: median(values) for key, values in marks.items()}
+                             for service, marks in milestones.items()}
+    if args.json:
+        print(json.dumps({"summary": summary, "runs": runs}, indent=2))
+    else:
+        print("runtime {}, bytecode {}, config cache {}, fast start {}, median of {} runs".format(
+            args.runtime, args.bytecode, args.config_cache, args.fast_start or "config", args.runs))
+        for key in ("pos_open_ms", "first_byte_ms", "first_acc_ms", "lost_lines"):
+            print("{:>16} {}".format(key, summary[key]))
+        for service, marks in summary["milestones"].items():
+            print("{:>16} {}".format(service, marks))
+    failed = [name for name, limit, value in (("first_byte_ms", args.max_first_byte_ms, summary["first_byte_ms"]),
+                                              ("first_acc_ms", args.max_first_acc_ms, summary["first_acc_ms"]))
+              if limit is not None and (value is None or value > limit)]
+    if failed:
+        print("over budget: {}".format(", ".join(failed)))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+import argparse
+import logging
+import os
+import pty
+import sys
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "pos-interface"))
+
+import serial
+from serial_reader import FrameReader
+
+# FrameReader against a real pty pair: what the POS side writes, split into
+# writes the way a UART delivers it, and the frames read_frame() must return.
+# Covers line endings, frames and cut commands split across reads, the idle
+# flush of an unterminated tail and the max_frame flush. Exits 1 when a case
+# does not frame as expected
+#   python bench/check_framing.py
+
+IDLE_GAP = 0.1
+MAX_FRAME = 64
+
+# (name, writes, expected frames, idle flush). Writes reach the port one at a
+# time while the reader runs, --spacing apart, well inside the idle gap
+CASES = [
+    ("lf and crlf in one read", [b"MILK 2L  2.49\nvalid payment\r\n"],
+     [b"MILK 2L  2.49\n", b"valid payment\r\n"], False),
+    ("line split across reads", [b"valid pay", b"ment\nSUBTO", b"TAL 3.69\n"],
+     [b"valid payment\n", b"SUBTOTAL 3.69\n"], False),
+    ("GS V A n cut", [b"Thank you\n\x1dVA\x03"],
+     [b"Thank you\n", b"\x1dVA\x03"], False),
+    ("GS V A n split after GS V", [b"footer\x1dV", b"A\x03next\n"],
+     [b"footer\x1dVA\x03", b"next\n"], False),
+    ("GS V A n split before n", [b"footer\x1dVA", b"\x00next\n"],
+     [b"footer\x1dVA\x00", b"next\n"], False),
+    ("GS V 0 cut", [b"end\x1dV0rest\n"],
+     [b"end\x1dV0", b"rest\n"], False),
+    ("ESC i cut split", [b"end\x1b", b"inext\n"],
+     [b"end\x1bi", b"next\n"], False),
+    ("CRLF split between reads", [b"valid payment\r", b"\nnext\n"],
+     [b"valid payment\r\n", b"next\n"], False),
+    ("unterminated tail, idle flush", [b"no newline at all"],
+     [b"no newline at all"], True),
+    ("max_frame without terminator", [b"x" * (MAX_FRAME + 10), b"\n"],
+     [b"x" * (MAX_FRAME + 10), b"\n"], False),
+]
+
+
+def write_spaced(master, writes, spacing):
+    for data in writes:
+        os.write(master, data)
+        time.sleep(spacing)
+
+
+def run_case(port, master, writes, expected, spacing):
+    # Frames read while the writes come in, and the bytes left unframed
+    reader = FrameReader(port, idle_gap=IDLE_GAP, max_frame=MAX_FRAME)
+    port.reset_input_buffer()
+    writer = threading.Thread(target=write_spaced, args=(master, writes, spacing))
+    writer.start()
+    frames = []
+    deadline = time.monotonic() + 2
+    while len(frames) < len(expected) and time.monotonic() < deadline:
+        frame = reader.read_frame()
+        if frame is not None:
+            frames.append(frame)
+    writer.join()
+    return frames, reader.pending()
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='check_framing.py', description='FrameReader on a pty pair')
+    parser.add_argument('--spacing', type=float, default=0.02, help="seconds between writes of one case")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.CRITICAL, format='%(asctime)s %(message)s')
+
+    master, slave = pty.openpty()
+    port = serial.Serial(os.ttyname(slave), baudrate=115200)
+    failed = 0
+    for name, writes, expected, idle in CASES:
+        start = time.monotonic()
+        frames, pending = run_case(port, master, writes, expected, args.spacing)
+        elapsed = time.monotonic() - start - args.spacing * (len(writes) - 1)
+        ok = frames == expected and not pending
+        note = ""
+        if idle:
+            # The tail only comes out once the port stayed quiet for idle_gap
+            ok = ok and elapsed >= IDLE_GAP
+            note = "  (flushed {:.0f} ms after the last write)".format(elapsed * 1000)
+        print("{:<36} {}{}".format(name, "ok" if ok else "FAILED", note))
+        if not ok:
+            print("    expected {}\n    got      {} ({} bytes left)".format(expected, frames, pending))
+            failed += 1
+    port.close()
+    os.close(master)
+    os.close(slave)
+    if failed:
+        print("{} of {} cases failed".format(failed, len(CASES)))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,318 @@
+import argparse
+import logging
+import os
+import socket
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "storetracker-interface"))
+
+from outbox import AccOutbox, STATE_ACKED, STATE_UNACKED
+from switch_connection import NoReply, SwitchConnection
+
+# SwitchConnection against a fake storetracker switch that can hang up, go
+# away, come back and answer late. Covers:
+#   reconnect   - a connection the switch closed while idle is replaced and
+#                 the ACC goes out once; a switch that restarts is picked up
+#                 again by the background thread
+#   breaker     - after breaker_threshold failures sends fail fast without
+#                 connecting, until the switch is back
+#   no retry    - a reply timeout is not resent, the switch may have acted on
+#                 it, and the late reply is not taken for the next command.
+#                 Also through the ACC outbox, which marks the entry unacked
+#   coalescing  - after an outage the outbox sends one ACC per checkout, a
+#                 drain that only lags behind a burst sends them all
+#   lock        - a second outbox on the same file, e.g. another container on
+#                 the same /data, sends nothing until the first one stops
+# Exits 1 when a case fails
+#   python bench/check_switch_connection.py
+
+REPLY_TIMEOUT = 0.5
+
+
+class ScriptedSwitch:
+    # Fake switch on localhost. Records every command it gets, replies "OK"
+    # after reply_delay, and can be stopped and started on the same port
+    def __init__(self):
+        self.commands = []
+        self.connections = 0
+        self.reply_delay = 0.0
+        self._conns = []
+        self._lock = threading.Lock()
+        self._srv = None
+        self.port = None
+        self.start()
+
+    def start(self):
+        self._srv = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._srv.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._srv.bind(("127.0.0.1", self.port or 0))
+        self._srv.listen()
+        self.port = self._srv.getsockname()[1]
+        threading.Thread(target=self._serve, args=(self._srv,), daemon=True).start()
+
+    def stop(self):
+        # Refuses new connections and hangs up the open ones
+        try:
+            self._srv.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._srv.close()
+        self.hang_up()
+
+    def hang_up(self):
+        with self._lock:
+            conns, self._conns = self._conns, []
+        for conn in conns:
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            conn.close()
+
+    def _serve(self, srv):
+        while True:
+            try:
+                conn, _ = srv.accept()
+            except OSError:
+                return
+            with self._lock:
+                self._conns.append(conn)
+                self.connections += 1
+            threading.Thread(target=self._handle, args=(conn,), daemon=True).start()
+
+    def _handle(self, conn):
+        while True:
+            try:
+                data = conn.recv(1024)
+            except OSError:
+                return
+            if not data:
+                return
+            self.commands.append(data)
+            time.sleep(self.reply_delay)
+            try:
+                conn.sendall(b"OK " + data.split()[-1] + b"\n")
+            except OSError:
+                return
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def connection(switch, **kwargs):
+    settings = dict(reply_timeout=REPLY_TIMEOUT, backoff_min=0.05, backoff_max=0.2, breaker_threshold=3,
+                    breaker_reset=30.0, probe_interval=30.0)
+    settings.update(kwargs)
+    return SwitchConnection("127.0.0.1", switch.port, **settings)
+
+
+def check_reconnect_idle():
+    switch = ScriptedSwitch()
+    conn = connection(switch)
+    conn.start()
+    ok = conn.send(b"ACC 1 0001\n") == b"OK 0001\n"
+    # The switch drops the idle connection, the next send must get through
+    # on a new one and reach the switch exactly once
+    switch.hang_up()
+    time.sleep(0.05)
+    ok = ok and conn.send(b"ACC 1 0002\n") == b"OK 0002\n"
+    conn.stop()
+    switch.stop()
+    return ok and switch.commands.count(b"ACC 1 0002\n") == 1 and switch.connections == 2
+
+
+def check_reconnect_restart():
+    switch = ScriptedSwitch()
+    states = []
+    conn = connection(switch, on_state=states.append)
+    conn.start()
+    switch.stop()
+    ok = conn.send(b"ACC 1 0001\n") is None
+    switch.start()
+    # The background thread finds the switch again without a send
+    ok = ok and wait_for(lambda: conn.connected)
+    ok = ok and conn.send(b"ACC 1 0002\n") == b"OK 0002\n"
+    conn.stop()
+    switch.stop()
+    return ok and states[0] is True and False in states and states[-1] is True
+
+
+def check_breaker():
+    # No background thread here, it would close the breaker as soon as it
+    # got a connection back. send() connects on its own
+    switch = ScriptedSwitch()
+    conn = connection(switch, breaker_reset=0.5)
+    switch.stop()
+    for i in range(3):
+        conn.send("ACC 1 000{}\n".format(i).encode())
+    ok = conn.breaker_open
+    # Open: fails fast, no connection attempt reaches the switch even though
+    # it is back
+    switch.start()
+    ok = ok and conn.send(b"ACC 1 0009\n") is None
+    ok = ok and switch.connections == 0 and b"ACC 1 0009\n" not in switch.commands
+    # After breaker_reset a send is tried again and gets through
+    time.sleep(0.6)
+    ok = ok and not conn.breaker_open and conn.send(b"ACC 1 0010\n") == b"OK 0010\n"
+    conn.stop()
+    switch.stop()
+    return ok
+
+
+def check_no_retry_on_timeout():
+    switch = ScriptedSwitch()
+    conn = connection(switch)
+    conn.start()
+    switch.reply_delay = REPLY_TIMEOUT + 0.3
+    try:
+        conn.send(b"ACC 1 0001\n")
+        ok = False
+    except NoReply:
+        ok = True
+    # The late reply arrives, the command must not have been sent again
+    time.sleep(0.6)
+    switch.reply_delay = 0.0
+    ok = ok and conn.send(b"ACC 1 0002\n") == b"OK 0002\n"
+    time.sleep(0.2)
+    conn.stop()
+    switch.stop()
+    return ok and switch.commands.count(b"ACC 1 0001\n") == 1
+
+
+def check_outbox_no_retry_on_timeout():
+    switch = ScriptedSwitch()
+    conn = connection(switch)
+    conn.start()
+    switch.reply_delay = REPLY_TIMEOUT + 0.3
+    with tempfile.TemporaryDirectory() as directory:
+        outbox = AccOutbox(lambda payload, tag: conn.send(payload.encode()), path=os.path.join(directory, "outbox.db"),
+                           retry_interval=0.1)
+        outbox.start()
+        outbox.enqueue("ACC 1 0001\n")
+        ok = wait_for(lambda: outbox.stats()["unacked"] == 1)
+        # Late reply, then a second bill with the switch answering again
+        time.sleep(0.6)
+        switch.reply_delay = 0.0
+        outbox.enqueue("ACC 1 0002\n")
+        ok = ok and wait_for(lambda: outbox.stats()["sent"] == 1)
+        time.sleep(0.5)
+        stats = outbox.stats()
+        outbox.stop(timeout=2)
+        db = sqlite3.connect(os.path.join(directory, "outbox.db"))
+        states = [row[0] for row in db.execute("SELECT state FROM outbox ORDER BY id")]
+        db.close()
+    conn.stop()
+    switch.stop()
+    return (ok and stats["pending"] == 0 and states == [STATE_UNACKED, STATE_ACKED]
+            and switch.commands.count(b"ACC 1 0001\n") == 1)
+
+
+def check_outbox_coalesce():
+    switch = ScriptedSwitch()
+    conn = connection(switch)
+    conn.start()
+    up = threading.Event()
+
+    def send(payload, tag):
+        return conn.send(payload.encode()) if up.is_set() else None
+    with tempfile.TemporaryDirectory() as directory:
+        outbox = AccOutbox(send, path=os.path.join(directory, "outbox.db"), retry_interval=0.1, coalesce_after=0.2)
+        outbox.start()
+        # Outage: three bills on checkout 1, two on checkout 2, one unkeyed
+        for payload, key in (("ACC 1 0001", "1"), ("ACC 2 0002", "2"), ("ACC 3 0001", "1"), ("ACC 4 0002", "2"),
+                             ("ACC 5 0001", "1"), ("ACC 6 0009", None)):
+            outbox.enqueue(payload + "\n", key=key)
+        time.sleep(0.3)
+        up.set()
+        ok = wait_for(lambda: outbox.stats()["pending"] == 0)
+        stats = outbox.stats()
+        outbox.stop(timeout=2)
+    conn.stop()
+    switch.stop()
+    return ok and stats["coalesced"] == 3 and switch.commands == [b"ACC 4 0002\n", b"ACC 5 0001\n", b"ACC 6 0009\n"]
+
+
+def check_outbox_no_coalesce_when_up():
+    switch = ScriptedSwitch()
+    switch.reply_delay = 0.05
+    conn = connection(switch)
+    conn.start()
+    with tempfile.TemporaryDirectory() as directory:
+        outbox = AccOutbox(lambda payload, tag: conn.send(payload.encode()), path=os.path.join(directory, "outbox.db"),
+                           retry_interval=0.1, coalesce_after=0.01)
+        outbox.start()
+        # A burst on one checkout, the drain falls behind but every send is answered
+        for i in range(10):
+            outbox.enqueue("ACC {} 0001\n".format(i), key="1")
+        ok = wait_for(lambda: outbox.stats()["sent"] == 10)
+        stats = outbox.stats()
+        outbox.stop(timeout=2)
+    conn.stop()
+    switch.stop()
+    return ok and stats["coalesced"] == 0 and len(switch.commands) == 10
+
+
+def check_outbox_lock():
+    switch = ScriptedSwitch()
+    conn = connection(switch)
+    conn.start()
+    send = lambda payload, tag: conn.send(payload.encode())
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "outbox.db")
+        first = AccOutbox(send, path=path, retry_interval=0.1)
+        first.start()
+        second = AccOutbox(send, path=path, retry_interval=0.1)
+        second.start()
+        first.enqueue("ACC 1 0001\n")
+        second.enqueue("ACC 2 0001\n")
+        ok = wait_for(lambda: first.stats()["sent"] == 1)
+        time.sleep(0.3)
+        ok = ok and second.stats()["sent"] == 0
+        # Released, the second one takes over the file and its bill goes out
+        first.stop(timeout=2)
+        ok = ok and wait_for(lambda: second.stats()["sent"] == 1)
+        second.stop(timeout=2)
+    conn.stop()
+    switch.stop()
+    return ok and switch.commands == [b"ACC 1 0001\n", b"ACC 2 0001\n"]
+
+
+CHECKS = [
+    ("reconnect after an idle hang up", check_reconnect_idle),
+    ("reconnect after a switch restart", check_reconnect_restart),
+    ("circuit breaker fails fast", check_breaker),
+    ("no resend after a reply timeout", check_no_retry_on_timeout),
+    ("outbox: reply timeout is unacked", check_outbox_no_retry_on_timeout),
+    ("outbox: backlog coalesced", check_outbox_coalesce),
+    ("outbox: lagging drain not coalesced", check_outbox_no_coalesce_when_up),
+    ("outbox: one drainer per file", check_outbox_lock),
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='check_switch_connection.py', description='SwitchConnection against a fake switch')
+    parser.parse_args()
+    logging.basicConfig(level=logging.CRITICAL, format='%(asctime)s %(message)s')
+    failed = 0
+    for name, check in CHECKS:
+        ok = check()
+        print("{:<36} {}".format(name, "ok" if ok else "FAILED"))
+        failed += 0 if ok else 1
+    if failed:
+        print("{} of {} checks failed".format(failed, len(CHECKS)))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,263 @@
+import logging
+import socket
+import struct
+import threading
+
+import paho.mqtt.client as mqtt
+
+# Just enough of an MQTT 3.1.1 broker to benchmark the services' clients
+# without mosquitto: CONNECT with clean or persistent sessions, PUBLISH at
+# QoS 0/1/2 both ways, SUBSCRIBE/UNSUBSCRIBE with wildcards, PINGREQ and
+# DISCONNECT. A persistent session that is away gets its QoS 1/2 messages
+# queued and delivered on reconnect, like mosquitto. There is no
+# retransmission, no retained messages, no wills and no auth, it is meant for
+# 127.0.0.1 only.
+#   broker = MiniBroker(); ...; broker.stop()
+
+CONNECT = 1
+CONNACK = 2
+PUBLISH = 3
+PUBACK = 4
+PUBREC = 5
+PUBREL = 6
+PUBCOMP = 7
+SUBSCRIBE = 8
+SUBACK = 9
+UNSUBSCRIBE = 10
+UNSUBACK = 11
+PINGREQ = 12
+PINGRESP = 13
+DISCONNECT = 14
+
+U16 = struct.Struct("!H")
+
+
+def packet(kind, flags, body=b""):
+    length = len(body)
+    header = bytearray([kind << 4 | flags])
+    while True:
+        byte, length = length & 0x7F, length >> 7
+        header.append(byte | (0x80 if length else 0))
+        if not length:
+            return bytes(header) + body
+
+
+def string(text):
+    data = text.encode('utf-8')
+    return U16.pack(len(data)) + data
+
+
+def read_packet(stream):
+    # (kind, flags, body) or None at the end of the stream
+    first = stream.read(1)
+    if not first:
+        return None
+    length, shift = 0, 0
+    while True:
+        byte = stream.read(1)
+        if not byte:
+            return None
+        length |= (byte[0] & 0x7F) << shift
+        shift += 7
+        if not byte[0] & 0x80:
+            break
+    body = stream.read(length)
+    if len(body) != length:
+        return None
+    return first[0] >> 4, first[0] & 0x0F, body
+
+
+def read_string(body, offset):
+    length = U16.unpack_from(body, offset)[0]
+    start = offset + U16.size
+    return body[start:start + length].decode('utf-8'), start + length
+
+
+class Session:
+    def __init__(self, client_id, clean):
+        self.client_id = client_id
+        self.clean = clean
+        self.subscriptions = {}
+        self.queued = []
+        self.connection = None
+
+
+class Connection:
+    def __init__(self, broker, sock):
+        self.broker = broker
+        self.sock = sock
+        self.session = None
+        self._write_lock = threading.Lock()
+        self._next_mid = 0
+        self._qos2_in = set()
+
+    def send(self, data):
+        with self._write_lock:
+            self.sock.sendall(data)
+
+    def deliver(self, topic, payload, qos):
+        with self._write_lock:
+            body = string(topic)
+            if qos:
+                self._next_mid = self._next_mid % 0xFFFF + 1
+                body += U16.pack(self._next_mid)
+            self.sock.sendall(packet(PUBLISH, qos << 1, body + payload))
+
+    def serve(self):
+        stream = self.sock.makefile('rb')
+        try:
+            while True:
+                received = read_packet(stream)
+                if received is None:
+                    break
+                kind, flags, body = received
+                if kind == DISCONNECT:
+                    break
+                self.handle(kind, flags, body)
+        except OSError:
+            pass
+        finally:
+            self.broker.disconnected(self)
+            self.sock.close()
+
+    def handle(self, kind, flags, body):
+        if kind == CONNECT:
+            _, offset = read_string(body, 0)
+            connect_flags = body[offset + 1]
+            client_id, _ = read_string(body, offset + 4)
+            present = self.broker.connected(self, client_id, bool(connect_flags & 0x02))
+            self.send(packet(CONNACK, 0, bytes([1 if present else 0, 0])))
+            self.broker.drain(self.session)
+        elif kind == PUBLISH:
+            qos = (flags >> 1) & 3
+            topic, offset = read_string(body, 0)
+            mid = None
+            if qos:
+                mid = U16.unpack_from(body, offset)[0]
+                offset += U16.size
+            payload = body[offset:]
+            if qos == 2:
+                # Routed once, a resent PUBLISH before PUBREL is a duplicate
+                if mid not in self._qos2_in:
+                    self._qos2_in.add(mid)
+                    self.broker.route(topic, payload, qos)
+                self.send(packet(PUBREC, 0, U16.pack(mid)))
+            else:
+                self.broker.route(topic, payload, qos)
+                if qos == 1:
+                    self.send(packet(PUBACK, 0, U16.pack(mid)))
+        elif kind == PUBREL:
+            mid = U16.unpack_from(body)[0]
+            self._qos2_in.discard(mid)
+            self.send(packet(PUBCOMP, 0, U16.pack(mid)))
+        elif kind == PUBREC:
+            self.send(packet(PUBREL, 2, body[:2]))
+        elif kind == SUBSCRIBE:
+            mid = body[:2]
+            offset, granted = 2, bytearray()
+            while offset < len(body):
+                topic, offset = read_string(body, offset)
+                qos = min(body[offset], 2)
+                offset += 1
+                self.session.subscriptions[topic] = qos
+                granted.append(qos)
+            self.send(packet(SUBACK, 0, mid + bytes(granted)))
+        elif kind == UNSUBSCRIBE:
+            offset = 2
+            while offset < len(body):
+                topic, offset = read_string(body, offset)
+                self.session.subscriptions.pop(topic, None)
+            self.send(packet(UNSUBACK, 0, body[:2]))
+        elif kind == PINGREQ:
+            self.send(packet(PINGRESP, 0))
+
+
+class MiniBroker:
+    def __init__(self, host="127.0.0.1", port=0):
+        self._server = socket.create_server((host, port))
+        self.port = self._server.getsockname()[1]
+        self._lock = threading.Lock()
+        self._sessions = {}
+        self._connections = []
+        self.routed = 0
+        threading.Thread(target=self._accept, name="mini-broker", daemon=True).start()
+
+    def _accept(self):
+        while True:
+            try:
+                sock, _ = self._server.accept()
+            except OSError:
+                return
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            connection = Connection(self, sock)
+            with self._lock:
+                self._connections.append(connection)
+            threading.Thread(target=connection.serve, name="mini-broker-conn", daemon=True).start()
+
+    def connected(self, connection, client_id, clean):
+        # True when a persistent session was picked up again
+        with self._lock:
+            # An empty client id gets a session of its own
+            client_id = client_id or "anonymous-{}".format(id(connection))
+            session = self._sessions.get(client_id)
+            present = session is not None and not clean and not session.clean
+            if not present:
+                session = Session(client_id, clean)
+                self._sessions[client_id] = session
+            old, session.connection = session.connection, connection
+            connection.session = session
+        if old is not None:
+            # Same client id, the old connection is taken over
+            old.sock.close()
+        return present
+
+    def disconnected(self, connection):
+        with self._lock:
+            if connection in self._connections:
+                self._connections.remove(connection)
+            session = connection.session
+            if session is not None and session.connection is connection:
+                session.connection = None
+                if session.clean:
+                    self._sessions.pop(session.client_id, None)
+
+    def route(self, topic, payload, qos):
+        with self._lock:
+            self.routed += 1
+            targets = []
+            for session in self._sessions.values():
+                granted = [sub_qos for sub, sub_qos in session.subscriptions.items() if mqtt.topic_matches_sub(sub, topic)]
+                if not granted:
+                    continue
+                out_qos = min(qos, max(granted))
+                if session.connection is not None:
+                    targets.append((session.connection, out_qos))
+                elif not session.clean and out_qos:
+                    session.queued.append((topic, payload, out_qos))
+        for connection, out_qos in targets:
+            try:
+                connection.deliver(topic, payload, out_qos)
+            except OSError as e:
+                logging.debug("Dropping delivery to {}: {}".format(connection.session.client_id, e))
+
+    def drain(self, session):
+        with self._lock:
+            queued, session.queued = session.queued, []
+        for topic, payload, qos in queued:
+            session.connection.deliver(topic, payload, qos)
+
+    def stop(self):
+        # shutdown wakes the accept thread, a close alone leaves the port
+        # listening until it returns
+        try:
+            self._server.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._server.close()
+        with self._lock:
+            connections = list(self._connections)
+        for connection in connections:
+            try:
+                connection.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
@@ -0,0 +1,372 @@
+import argparse
+import asyncio
+import codecs
+import importlib.util
+import json
+import logging
+import multiprocessing
+import os
+import pty
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+POS_DIR = os.path.join(ROOT, "pos-interface")
+STORETRACKER_DIR = os.path.join(ROOT, "storetracker-interface")
+sys.path.insert(0, os.path.join(ROOT, "common"))
+sys.path.insert(0, STORETRACKER_DIR)
+sys.path.insert(0, POS_DIR)
+
+import yaml
+from latency import LatencyHistogram, parse_bill_payload
+from messaging import LoopbackBroker, decode
+from serial_reader import has_cut
+
+# Replays a receipt transcript through the real POSInterface without hardware.
+# pty pairs stand in for the POS and the printer, an in-memory broker for
+# mosquitto and a local TCP server for the storetracker switch. Reports line
+# throughput, bill classification accuracy, dropped or garbled printer bytes
+# and ACC latency percentiles, and exits 1 when a --min/--max limit is missed
+#   python bench/replay.py bench/transcripts/grocery.txt --repeat 50 --speed 0
+#   python bench/replay.py capture.bin --baud 38400 --runtime unified
+# --speed is a multiple of the baud rate, 0 writes as fast as the pty takes it
+
+EXPECT_NONE = "-"
+EXPECT_VALUES = ("success", "failure", "generic", EXPECT_NONE)
+
+
+def load_transcript(path):
+    # Returns [(expect, bytes)]. Raw captures (anything but .txt) have no
+    # expectations, accuracy is not reported for them
+    if not path.endswith(".txt"):
+        with open(path, 'rb') as f:
+            return [(None, f.read())]
+    entries = []
+    with open(path, 'r', encoding='ascii') as f:
+        for number, line in enumerate(f, 1):
+            line = line.rstrip("\r\n")
+            if not line or line.startswith("#"):
+                continue
+            expect, sep, payload = line.partition("|")
+            expect = expect.strip()
+            if not sep or expect not in EXPECT_VALUES:
+                raise ValueError("{}:{}: expected '<{}>|<bytes>'".format(path, number, "|".join(EXPECT_VALUES)))
+            entries.append((expect, codecs.escape_decode(payload.encode('ascii'))[0]))
+    return entries
+
+
+def load_app(name, directory):
+    # Both services have an app.py, load them side by side under new names
+    spec = importlib.util.spec_from_file_location(name, os.path.join(directory, "app.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class FakeSwitch:
+    # Storetracker switch on localhost, answers every ACC and stamps its arrival
+    def __init__(self):
+        self.arrivals = []
+        self._srv = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._srv.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._srv.bind(("127.0.0.1", 0))
+        self._srv.listen()
+        self.port = self._srv.getsockname()[1]
+        threading.Thread(target=self._serve, name="fake-switch", daemon=True).start()
+
+    def _serve(self):
+        while True:
+            try:
+                conn, _ = self._srv.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._handle, args=(conn,), daemon=True).start()
+
+    def _handle(self, conn):
+        with conn:
+            while True:
+                data = conn.recv(1024)
+                if not data:
+                    return
+                now = time.monotonic_ns()
+                commands = data.count(b"ACC ")
+                self.arrivals.extend([now] * commands)
+                conn.sendall(b"OK\n" if commands else b"PONG\n")
+
+
+def feeder(pos_master, print_master, entries, bytes_per_sec, expected_len, settle, conn):
+    # Child process, paces the POS side and drains the printer side. Sends
+    # back when it started and stopped writing, when the last printer byte
+    # arrived and everything the printer got
+    received = bytearray()
+    last_rx = [0.0]
+    done = threading.Event()
+
+    def drain():
+        os.set_blocking(print_master, False)
+        while True:
+            if len(received) >= expected_len:
+                break
+            if done.is_set() and time.monotonic() - max(last_rx[0], done.stamp) > settle:
+                break
+            try:
+                chunk = os.read(print_master, 65536)
+            except BlockingIOError:
+                time.sleep(0.001)
+                continue
+            except OSError:
+                break
+            received.extend(chunk)
+            last_rx[0] = time.monotonic()
+    t = threading.Thread(target=drain, daemon=True)
+    t.start()
+
+    block = 64
+    start = time.monotonic()
+    sent = 0
+    for _, data in entries:
+        for offset in range(0, len(data), block):
+            os.write(pos_master, data[offset:offset + block])
+            sent += len(data[offset:offset + block])
+            if bytes_per_sec:
+                delay = start + sent / bytes_per_sec - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+    done.stamp = time.monotonic()
+    done.set()
+    t.join()
+    conn.send((start, done.stamp, last_rx[0], bytes(received)))
+
+
+def write_configs(directory, pos_port, print_port, passthrough, transactions=None):
+    # Copies of the shipped configs pointed at the ptys and a temp dir
+    with open(os.path.join(POS_DIR, "config", "pos_config.yaml"), 'r') as f:
+        pos_config = yaml.safe_load(f)
+    pos_config['SETTINGS']['SERIAL']['static_port'] = pos_port
+    pos_config['SETTINGS'].setdefault('METRICS', {})['latency_interval'] = 1e9
+    if transactions is not None:
+        pos_config.setdefault('TRANSACTIONS', {})['enabled'] = transactions
+
+    with open(os.path.join(POS_DIR, "config", "printer_config.yaml"), 'r') as f:
+        print_config = yaml.safe_load(f)
+    print_config['SETTINGS']['SERIAL']['static_port'] = print_port
+    print_config['SETTINGS']['QUEUE']['spill_file'] = os.path.join(directory, "printer_spill.bin")
+    if passthrough is not None:
+        print_config['passthrough'] = passthrough
+
+    with open(os.path.join(STORETRACKER_DIR, "config", "switch_config.yaml"), 'r') as f:
+        switch_config = yaml.safe_load(f)
+    switch_config['SETTINGS'].setdefault('OUTBOX', {})['path'] = os.path.join(directory, "acc_outbox.db")
+
+    paths = []
+    for name, config in (("pos_config.yaml", pos_config), ("printer_config.yaml", print_config),
+                         ("switch_config.yaml", switch_config)):
+        path = os.path.join(directory, name)
+        with open(path, 'w') as f:
+            yaml.safe_dump(config, f)
+        paths.append(path)
+    return paths
+
+
+def expected_bills(entries, transactions):
+    # Bill results the transcript should produce, one per line or, with
+    # transactions, one per receipt the way TransactionTracker groups them
+    # with its defaults: a cut ends one
+    if not transactions:
+        return [expect == "success" for expect, _ in entries if expect in ("success", "failure")]
+    bills = []
+    outcome = None
+    for expect, data in entries:
+        if expect == "success" or (expect == "failure" and outcome is None):
+            outcome = expect
+        if has_cut(data) and outcome is not None:
+            bills.append(outcome == "success")
+            outcome = None
+    if outcome is not None:
+        bills.append(outcome == "success")
+    return bills
+
+
+def printer_damage(expected, received, resync=16, horizon=65536):
+    # (dropped, garbled) bytes. Walks both streams, on a mismatch looks ahead
+    # in expected for the next resync bytes of received: bytes skipped to get
+    # there were dropped, a byte that cannot be matched was garbled
+    if expected == received:
+        return 0, 0
+    dropped = garbled = 0
+    i = j = 0
+    while i < len(expected) and j < len(received):
+        if expected[i] == received[j]:
+            i += 1
+            j += 1
+            continue
+        k = expected.find(received[j:j + resync], i, i + horizon + resync)
+        if k > i:
+            dropped += k - i
+            i = k
+        else:
+            garbled += 1
+            i += 1
+            j += 1
+    return dropped + len(expected) - i, garbled + len(received) - j
+
+
+def run(args):
+    entries = load_transcript(args.transcript) * args.repeat
+    data = b"".join(payload for _, payload in entries)
+    broker = LoopbackBroker()
+    bills = []
+    broker.listeners.append(lambda topic, payload: bills.append(decode(topic, payload).text())
+                            if topic in ("pos/billing", "pos/billing/mirror") else None)
+    switch = FakeSwitch()
+    directory = tempfile.mkdtemp(prefix="replay-")
+
+    pos_master, pos_slave = pty.openpty()
+    print_master, print_slave = pty.openpty()
+    pos_path, print_path, switch_path = write_configs(directory, os.ttyname(pos_slave), os.ttyname(print_slave),
+                                                      args.passthrough, args.transactions)
+
+    pos_app = load_app("pos_app", POS_DIR)
+    config_cache = os.path.join(directory, "config_cache")
+    if args.runtime == "unified":
+        from switch_client import SwitchClient
+        with open(switch_path, 'r') as f:
+            client = SwitchClient(yaml.safe_load(f), "127.0.0.1", switch.port)
+        posif = pos_app.POSInterface(pos_path, print_path, bill_sink=client.submit, config_cache=config_cache,
+                                     mqtt_backend=broker.client)
+        client.start()
+        switch_latency = client.latency
+        target = lambda: asyncio.run(posif.run_async())
+    else:
+        storetracker_app = load_app("storetracker_app", STORETRACKER_DIR)
+        storetracker = storetracker_app.SwitchInterface(switch_path, "127.0.0.1", switch.port, config_cache=config_cache,
+                                                        mqtt_backend=broker.client)
+        switch_latency = storetracker._switch.latency
+        posif = pos_app.POSInterface(pos_path, print_path, config_cache=config_cache, mqtt_backend=broker.client)
+        target = posif.run
+    threading.Thread(target=target, name="pos-interface", daemon=True).start()
+    lane = posif._lanes[0]
+
+    parent, child = multiprocessing.Pipe()
+    bytes_per_sec = args.baud / 10.0 * args.speed
+    proc = multiprocessing.Process(target=feeder, args=(pos_master, print_master, entries, bytes_per_sec,
+                                                        len(data) if lane.print_enabled else 0, args.settle, child))
+    cpu = time.process_time()
+    proc.start()
+    start, feed_end, printer_end, received = parent.recv()
+    proc.join()
+
+    # In passthrough the printer can have everything before the last lines
+    # are classified, wait for the POS loop to go quiet
+    frames = -1
+    quiet = lane.reader.idle_gap * 2
+    while True:
+        count = lane.latency.snapshot()["pos.classify"].get("count", 0)
+        if count == frames and not lane.reader.pending():
+            break
+        frames = count
+        time.sleep(quiet)
+    # The bill mirror is batched with the metrics
+    posif.messenger.flush()
+
+    # Wait for the ACCs of every bill seen so far to reach the switch
+    expected_accs = sum(1 for payload in list(bills) if payload.startswith("True"))
+    deadline = time.monotonic() + args.settle + 2
+    while len(switch.arrivals) < expected_accs and time.monotonic() < deadline:
+        time.sleep(0.01)
+        expected_accs = sum(1 for payload in list(bills) if payload.startswith("True"))
+    cpu = time.process_time() - cpu
+
+    end = max(feed_end, printer_end, lane.reader.last_rx or 0)
+    result = {
+        "runtime": args.runtime,
+        "passthrough": lane.passthrough,
+        "transactions": lane.transactions is not None,
+        "bytes": len(data),
+        "frames": frames,
+        "seconds": round(end - start, 3),
+        "lines_per_sec": round(frames / max(end - start, 1e-9), 1),
+        "cpu_ms_per_1k_lines": round(cpu * 1e6 / max(frames, 1), 2),
+    }
+
+    parsed = [parse_bill_payload(payload) for payload in bills]
+    if all(expect is not None for expect, _ in entries):
+        expected = expected_bills(entries, lane.transactions is not None)
+        observed = [bill[0] for bill in parsed if bill is not None]
+        correct = sum(1 for e, o in zip(expected, observed) if e == o)
+        result.update({"bills_expected": len(expected), "bills_observed": len(observed),
+                       "accuracy": round(correct / max(len(expected), len(observed), 1), 4)})
+
+    if lane.print_enabled:
+        dropped, garbled = printer_damage(data, received)
+        result.update({"printer_bytes": len(received), "printer_dropped": dropped, "printer_garbled": garbled})
+
+    # ACC n at the switch is the nth successful bill, the outbox keeps order
+    histogram = LatencyHistogram()
+    traces = [bill[1] for bill in parsed if bill is not None and bill[0]]
+    for trace, arrival in zip(traces, list(switch.arrivals)):
+        if trace is not None and trace["rx_ns"] is not None:
+            histogram.record((arrival - trace["rx_ns"]) // 1000)
+    result["accs"] = len(switch.arrivals)
+    result["accs_expected"] = len(traces)
+    result["acc_latency_us"] = histogram.summary()
+    result["switch_latency_us"] = switch_latency.snapshot()
+    return result
+
+
+def check_limits(args, result):
+    failures = []
+    if args.min_lines_per_sec is not None and result["lines_per_sec"] < args.min_lines_per_sec:
+        failures.append("lines/s {} < {}".format(result["lines_per_sec"], args.min_lines_per_sec))
+    if args.min_accuracy is not None and result.get("accuracy", 1.0) < args.min_accuracy:
+        failures.append("accuracy {} < {}".format(result["accuracy"], args.min_accuracy))
+    if args.max_printer_errors is not None:
+        errors = result.get("printer_dropped", 0) + result.get("printer_garbled", 0)
+        if errors > args.max_printer_errors:
+            failures.append("printer errors {} > {}".format(errors, args.max_printer_errors))
+    if result["accs"] != result["accs_expected"]:
+        # Every paid bill opens the gate exactly once
+        failures.append("ACCs {} != paid bills {}".format(result["accs"], result["accs_expected"]))
+    p99 = result["acc_latency_us"].get("p99")
+    if args.max_acc_p99_ms is not None and p99 is not None and p99 / 1000.0 > args.max_acc_p99_ms:
+        failures.append("ACC p99 {:.1f}ms > {}ms".format(p99 / 1000.0, args.max_acc_p99_ms))
+    return failures
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='replay.py', description='Replay a receipt transcript through POSInterface')
+    parser.add_argument('transcript', nargs='?', default=os.path.join(ROOT, "bench", "transcripts", "grocery.txt"))
+    parser.add_argument('--repeat', type=int, default=20, help="times the transcript is replayed back to back")
+    parser.add_argument('--baud', type=int, default=38400)
+    parser.add_argument('--speed', type=float, default=1.0, help="multiple of the baud rate, 0 for unpaced")
+    parser.add_argument('--runtime', default="split", choices=["split", "unified"])
+    parser.add_argument('--passthrough', default=None, choices=["on", "off"], help="override printer_config.yaml")
+    parser.add_argument('--transactions', default=None, choices=["on", "off"], help="override pos_config.yaml")
+    parser.add_argument('--settle', type=float, default=1.0, help="seconds of quiet that end the run")
+    parser.add_argument('--json', default=None, help="also write the result to this file")
+    parser.add_argument('--log-level', default="WARNING", choices=["CRITICAL", "ERROR", "WARNING", "INFO", "DEBUG"])
+    parser.add_argument('--min-lines-per-sec', type=float, default=None)
+    parser.add_argument('--min-accuracy', type=float, default=None)
+    parser.add_argument('--max-printer-errors', type=int, default=None)
+    parser.add_argument('--max-acc-p99-ms', type=float, default=None)
+    args = parser.parse_args()
+    if args.passthrough is not None:
+        args.passthrough = args.passthrough == "on"
+    if args.transactions is not None:
+        args.transactions = args.transactions == "on"
+    logging.basicConfig(level=args.log_level, format='%(asctime)s %(message)s')
+
+    result = run(args)
+    print(json.dumps(result, indent=2))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(result, f, indent=2)
+    failures = check_limits(args, result)
+    for failure in failures:
+        print("FAIL: {}".format(failure))
+    # Service threads are still running, do not wait for them
+    sys.stdout.flush()
+    os._exit(1 if failures else 0)
@@ -0,0 +1,245 @@
+import copy
+import hashlib
+import logging
+import os
+import pickle
+import select
+import sys
+import threading
+import time
+from inotify import Inotify, IN_CLOSE_WRITE, IN_CREATE, IN_MOVED_TO
+
+DEFAULT_CACHE_DIR = "/data/config_cache"
+DEFAULT_DEBOUNCE = 0.2
+DEFAULT_POLL_INTERVAL = 2.0
+CACHE_VERSION = 1
+
+_code_digests = {}
+
+
+def merge(config, overrides):
+    # Copy of config with overrides laid over it, nested mappings are merged
+    merged = copy.deepcopy(config)
+    for key, value in (overrides or {}).items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = merge(merged[key], value)
+        else:
+            merged[key] = copy.deepcopy(value)
+    return merged
+
+
+def _code_digest(modules):
+    # Source of the modules that build a compiled form, a cache written by
+    # other code is never loaded
+    digest = hashlib.sha1(sys.version.encode())
+    for module in modules:
+        path = getattr(module, "__file__", None)
+        if path not in _code_digests:
+            try:
+                with open(path, 'rb') as f:
+                    _code_digests[path] = hashlib.sha1(f.read()).hexdigest()
+            except (OSError, TypeError):
+                _code_digests[path] = ""
+        digest.update(_code_digests[path].encode())
+    return digest.hexdigest()
+
+
+class _Watch:
+    def __init__(self, path, on_change, build, validate, depends):
+        self.path = path
+        self.on_change = on_change
+        self.build = build
+        self.validate = validate
+        self.depends = depends
+        self.digest = None
+        self.stat = None
+
+
+class ConfigService:
+    # Loads YAML config files and keeps them current.
+    # load() parses a file, checks it with validate(config), which raises
+    # ValueError on a bad one, and compiles it with build(config). The parsed
+    # config and the compiled form are pickled in cache_dir keyed on the
+    # file contents and the code of the depends modules, a cold start with
+    # an unchanged file skips the YAML parse and the build.
+    # watch() reloads a file when it changes, inotify on its directory so
+    # editors that write a new file and rename it over the old one are seen.
+    # A config that does not validate or build is logged and ignored, the
+    # running one stays. on_change(config, compiled) runs on the watcher
+    # thread, callers hand the result over to their own loop
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, debounce=DEFAULT_DEBOUNCE, poll_interval=DEFAULT_POLL_INTERVAL):
+        self._cache_dir = cache_dir
+        self._debounce = float(debounce)
+        self._poll_interval = float(poll_interval)
+        self._watches = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self._running = False
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        if self._cache_dir:
+            try:
+                os.makedirs(self._cache_dir, exist_ok=True)
+            except OSError as e:
+                logging.warning("No config cache in {}: {}".format(self._cache_dir, e))
+                self._cache_dir = None
+
+    def _cache_file(self, path, build):
+        if not self._cache_dir:
+            return None
+        name = "{}:{}".format(os.path.abspath(path), getattr(build, "__qualname__", None))
+        return os.path.join(self._cache_dir, hashlib.sha1(name.encode()).hexdigest()[:16] + ".pickle")
+
+    def _parse(self, path, data, build, validate):
+        # yaml is only imported when a file is not in the cache
+        import yaml
+        config = yaml.safe_load(data)
+        if not isinstance(config, dict):
+            raise ValueError("{} is not a mapping".format(path))
+        if validate is not None:
+            validate(config)
+        compiled = build(config) if build is not None else None
+        return config, compiled
+
+    def _load(self, path, build, validate, depends):
+        # (config, compiled, digest) straight from the file or the cache
+        with open(path, 'rb') as f:
+            data = f.read()
+        digest = hashlib.sha1(data).hexdigest()
+        cache_file = self._cache_file(path, build)
+        key = (CACHE_VERSION, digest, _code_digest(depends))
+        if cache_file is not None:
+            try:
+                with open(cache_file, 'rb') as f:
+                    cached_key, config, compiled = pickle.load(f)
+                if cached_key == key:
+                    logging.debug("Config {} from cache {}".format(path, cache_file))
+                    return config, compiled, digest
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                logging.warning("Ignoring config cache {}: {}".format(cache_file, e))
+
+        config, compiled = self._parse(path, data, build, validate)
+        if cache_file is not None:
+            try:
+                tmp = cache_file + ".tmp"
+                with open(tmp, 'wb') as f:
+                    pickle.dump((key, config, compiled), f, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(tmp, cache_file)
+            except Exception as e:
+                logging.warning("Could not write config cache {}: {}".format(cache_file, e))
+        return config, compiled, digest
+
+    def load(self, path, build=None, validate=None, depends=()):
+        # Returns (config, compiled), compiled is None without build. Raises
+        # on a missing, unreadable or invalid file
+        config, compiled, _ = self._load(path, build, validate, depends)
+        return config, compiled
+
+    def watch(self, path, on_change, build=None, validate=None, depends=()):
+        # Starts watching path, returns (config, compiled) like load()
+        config, compiled, digest = self._load(path, build, validate, depends)
+        watch = _Watch(path, on_change, build, validate, depends)
+        watch.digest = digest
+        watch.stat = self._stat(path)
+        with self._lock:
+            self._watches.setdefault(os.path.abspath(path), []).append(watch)
+        if self._thread is None:
+            self._running = True
+            self._thread = threading.Thread(target=self._run, name="config-watcher", daemon=True)
+            self._thread.start()
+        else:
+            os.write(self._wakeup_w, b"\0")
+        return config, compiled
+
+    def alive(self):
+        return self._thread is None or not self._running or self._thread.is_alive()
+
+    def restart(self):
+        # New watcher thread for one that died, the watches are kept
+        self._thread = threading.Thread(target=self._run, name="config-watcher", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        os.write(self._wakeup_w, b"\0")
+
+    @staticmethod
+    def _stat(path):
+        try:
+            st = os.stat(path)
+            return st.st_mtime_ns, st.st_size, st.st_ino
+        except OSError:
+            return None
+
+    def _reload(self, watch):
+        try:
+            with open(watch.path, 'rb') as f:
+                digest = hashlib.sha1(f.read()).hexdigest()
+        except OSError as e:
+            # Half way through being replaced, the next event brings it back
+            logging.debug("Config {} not readable: {}".format(watch.path, e))
+            return
+        if digest == watch.digest:
+            return
+        try:
+            config, compiled, digest = self._load(watch.path, watch.build, watch.validate, watch.depends)
+        except Exception as e:
+            logging.error("Config {} not applied, keeping the running one: {}".format(watch.path, e))
+            watch.digest = digest
+            return
+        watch.digest = digest
+        logging.info("Config {} changed, applying".format(watch.path))
+        try:
+            watch.on_change(config, compiled)
+        except Exception as e:
+            logging.error("Applying config {} failed: {}".format(watch.path, e))
+
+    def _watched(self):
+        with self._lock:
+            return [watch for watches in self._watches.values() for watch in watches]
+
+    def _run(self):
+        inotify = None
+        try:
+            inotify = Inotify()
+        except OSError as e:
+            logging.warning("No inotify ({}), polling configs every {}s".format(e, self._poll_interval))
+        watched_dirs = set()
+        while self._running:
+            watches = self._watched()
+            directories = set(os.path.dirname(os.path.abspath(watch.path)) for watch in watches)
+            if inotify is not None:
+                for directory in directories - watched_dirs:
+                    try:
+                        inotify.add_watch(directory, IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE)
+                    except OSError as e:
+                        logging.warning("Not watching {}: {}".format(directory, e))
+                    watched_dirs.add(directory)
+
+            fds = [self._wakeup_r] + ([inotify.fileno()] if inotify is not None else [])
+            ready = select.select(fds, [], [], None if inotify is not None else self._poll_interval)[0]
+            if self._wakeup_r in ready:
+                os.read(self._wakeup_r, 64)
+            changed = set()
+            if inotify is not None and inotify.fileno() in ready:
+                # Editors write in several steps, wait for them to settle
+                deadline = time.monotonic() + self._debounce
+                while True:
+                    changed.update(inotify.read())
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0 or not select.select([inotify], [], [], remaining)[0]:
+                        break
+                    deadline = time.monotonic() + self._debounce
+            for watch in watches:
+                if inotify is not None:
+                    if os.path.basename(watch.path) not in changed:
+                        continue
+                else:
+                    stat = self._stat(watch.path)
+                    if stat == watch.stat:
+                        continue
+                    watch.stat = stat
+                self._reload(watch)
+        if inotify is not None:
+            inotify.close()
@@ -0,0 +1,438 @@
+import collections
+import gc
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import tracemalloc
+
+# On-demand diagnostics for a running service, driven by commands on its MQTT
+# control topic. Nothing runs until a command asks for it: the sampling
+# profiler is a thread that only exists while profiling, and tracemalloc only
+# traces between its start and stop, both stop on their own after
+# max_duration. Profiles and snapshots are written under directory/<service>,
+# pruned to max_files and max_bytes, and a summary of every command is
+# published back.
+# A command is a bare name or a JSON object with "command", an optional
+# "service" to address one service, and its arguments:
+#   profile_start        {"interval": 0.01, "duration": 60, "mode": "cpu"}
+#   profile_stop
+#   tracemalloc_start    {"frames": 10}
+#   tracemalloc_snapshot top allocations
+#   tracemalloc_diff     growth since the previous snapshot
+#   tracemalloc_stop
+#   threads              CPU seconds per thread, and % since the last call
+#   resources            RSS, CPU, fds, gc and the service's byte counters
+
+DEFAULT_DIRECTORY = "/data/diagnostics"
+DEFAULT_MAX_FILES = 20
+DEFAULT_MAX_BYTES = 50 * 1024 * 1024
+DEFAULT_SAMPLE_INTERVAL = 0.01
+DEFAULT_PROFILE_DURATION = 60.0
+DEFAULT_MAX_DURATION = 600.0
+DEFAULT_TRACE_FRAMES = 10
+DEFAULT_TOP = 15
+
+# cpu: only threads that ran since the previous sample, wall: every thread
+MODE_CPU = "cpu"
+MODE_WALL = "wall"
+
+PROC_TASKS = "/proc/self/task"
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+
+
+def parse_command(text):
+    # The command as a dict from a JSON object or a bare name, None otherwise
+    text = text.strip()
+    if not text.startswith("{"):
+        return {"command": text} if text else None
+    try:
+        command = json.loads(text)
+    except ValueError:
+        return None
+    return command if isinstance(command, dict) and "command" in command else None
+
+
+def thread_cpu_ns(tid):
+    # CPU time of a thread of this process by its native id, None once it is
+    # gone. schedstat has ns, stat only clock ticks
+    try:
+        with open("{}/{}/schedstat".format(PROC_TASKS, tid), 'rb') as f:
+            return int(f.read().split()[0])
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        with open("{}/{}/stat".format(PROC_TASKS, tid), 'rb') as f:
+            fields = f.read().rsplit(b")", 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) * 1000000000 // CLOCK_TICKS
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def thread_comm(tid):
+    try:
+        with open("{}/{}/comm".format(PROC_TASKS, tid), 'r') as f:
+            return f.read().strip()
+    except OSError:
+        return str(tid)
+
+
+def memory_kb():
+    # Current and peak RSS, only the peak without /proc
+    memory = {}
+    try:
+        with open("/proc/self/status", 'r') as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    memory["rss_kb"] = int(line.split()[1])
+                elif line.startswith("VmHWM:"):
+                    memory["rss_peak_kb"] = int(line.split()[1])
+    except OSError:
+        import resource
+        memory["rss_peak_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return memory
+
+
+def where(statistic):
+    frame = statistic.traceback[0]
+    return "{}:{}".format(frame.filename, frame.lineno)
+
+
+class SamplingProfiler:
+    # Samples the Python stacks of all other threads every interval seconds
+    # into folded stacks, "thread;outer;...;leaf us" lines that flamegraph.pl
+    # and speedscope read. In cpu mode a stack is weighted with the CPU time
+    # its thread used since the previous sample, so threads blocked in select
+    # or on a queue and threads that only wake up briefly do not hide where
+    # the time goes. In wall mode every stack counts the interval
+    def __init__(self, interval=DEFAULT_SAMPLE_INTERVAL, mode=MODE_CPU):
+        if mode not in (MODE_CPU, MODE_WALL):
+            raise ValueError("mode must be {} or {}".format(MODE_CPU, MODE_WALL))
+        self.interval = float(interval)
+        self.mode = mode if os.path.isdir(PROC_TASKS) else MODE_WALL
+        self.stacks = collections.Counter()
+        self.ticks = 0
+        self.started = None
+        self.elapsed = 0.0
+        self._cpu = {}
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self, duration, on_expired):
+        # on_expired() is called from the profiler thread when duration
+        # passed before stop()
+        self.started = time.monotonic()
+        self._thread = threading.Thread(target=self._run, args=(duration, on_expired), name="diagnostics-profiler",
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+
+    def _run(self, duration, on_expired):
+        deadline = self.started + duration
+        own = threading.get_ident()
+        while not self._stopped.wait(self.interval):
+            if time.monotonic() >= deadline:
+                self.elapsed = time.monotonic() - self.started
+                on_expired()
+                return
+            threads = {thread.ident: thread for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                thread = threads.get(ident)
+                weight = self._weight(thread) if ident != own else 0
+                if weight:
+                    self.stacks[self._fold(thread.name if thread is not None else str(ident), frame)] += weight
+            self.ticks += 1
+        self.elapsed = time.monotonic() - self.started
+
+    def _weight(self, thread):
+        # Microseconds the sample stands for
+        if self.mode == MODE_WALL:
+            return int(self.interval * 1e6)
+        if thread is None or thread.native_id is None:
+            return 0
+        cpu = thread_cpu_ns(thread.native_id)
+        last = self._cpu.get(thread.native_id)
+        self._cpu[thread.native_id] = cpu
+        if cpu is None or last is None:
+            return 0
+        return max(cpu - last, 0) // 1000
+
+    @staticmethod
+    def _fold(name, frame):
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            names.append("{}:{}".format(os.path.basename(code.co_filename), code.co_name))
+            frame = frame.f_back
+        names.append(name)
+        return ";".join(reversed(names))
+
+    def folded(self):
+        return "".join("{} {}\n".format(stack, count) for stack, count in self.stacks.most_common())
+
+    def summary(self, top=DEFAULT_TOP):
+        # Share of the sampled time per thread, per function on top of the
+        # stack (self) and per function anywhere in the stack (total), in %
+        sampled = sum(self.stacks.values())
+        threads, own, total = collections.Counter(), collections.Counter(), collections.Counter()
+        for stack, count in self.stacks.items():
+            names = stack.split(";")
+            threads[names[0]] += count
+            own[names[-1]] += count
+            for name in set(names[1:]):
+                total[name] += count
+
+        def share(counter):
+            return [[name, round(100.0 * count / sampled, 1)] for name, count in counter.most_common(top)]
+        return {"mode": self.mode, "seconds": round(self.elapsed, 1), "ticks": self.ticks,
+                "sampled_ms": round(sampled / 1000.0, 1),
+                "threads": share(threads), "self": share(own), "total": share(total)}
+
+
+class Diagnostics:
+    # Runs the commands of the control topic for one service. handle() is the
+    # MQTT handler, each command runs on a thread of its own, one at a time,
+    # and its report goes to publish(report). counters() adds the service's
+    # byte counters to the resources report
+    def __init__(self, service, publish, counters=None, directory=DEFAULT_DIRECTORY, max_files=DEFAULT_MAX_FILES,
+                 max_bytes=DEFAULT_MAX_BYTES, sample_interval=DEFAULT_SAMPLE_INTERVAL,
+                 max_duration=DEFAULT_MAX_DURATION, top=DEFAULT_TOP):
+        self._service = service
+        self._publish = publish
+        self._counters = counters
+        self._directory = os.path.join(directory, service) if directory else None
+        self._max_files = int(max_files)
+        self._max_bytes = int(max_bytes)
+        self._sample_interval = float(sample_interval)
+        self._max_duration = float(max_duration)
+        self._top = int(top)
+        self._started = time.monotonic()
+        self._lock = threading.Lock()
+        self._profiler = None
+        self._snapshot = None
+        self._trace_timer = None
+        self._thread_cpu = {}
+        self._thread_cpu_at = None
+        self._commands = {
+            "profile_start": self._profile_start,
+            "profile_stop": self._profile_stop,
+            "tracemalloc_start": self._tracemalloc_start,
+            "tracemalloc_snapshot": self._tracemalloc_snapshot,
+            "tracemalloc_diff": self._tracemalloc_diff,
+            "tracemalloc_stop": self._tracemalloc_stop,
+            "threads": self._threads,
+            "resources": self._resources,
+        }
+
+    @classmethod
+    def from_config(cls, diagnostics_config, service, publish, counters=None):
+        diagnostics_config = diagnostics_config or {}
+        return cls(service, publish, counters=counters,
+                   directory=diagnostics_config.get('directory', DEFAULT_DIRECTORY),
+                   max_files=diagnostics_config.get('max_files', DEFAULT_MAX_FILES),
+                   max_bytes=diagnostics_config.get('max_bytes', DEFAULT_MAX_BYTES),
+                   sample_interval=diagnostics_config.get('sample_interval', DEFAULT_SAMPLE_INTERVAL),
+                   max_duration=diagnostics_config.get('max_duration', DEFAULT_MAX_DURATION),
+                   top=diagnostics_config.get('top', DEFAULT_TOP))
+
+    def handle(self, message):
+        # MQTT network thread, a profile or snapshot must not hold it up
+        command = parse_command(message.text())
+        if command is None:
+            logging.warning("Ignoring diagnostics command {!r}".format(message.text()))
+            return
+        if command.get("service") not in (None, self._service):
+            return
+        self._dispatch(command)
+
+    def stop(self):
+        # Ends profiling and tracing, nothing is written
+        with self._lock:
+            if self._profiler is not None:
+                self._profiler.stop()
+                self._profiler = None
+            self._stop_tracing()
+
+    def _dispatch(self, command):
+        threading.Thread(target=self._execute, args=(command,), name="diagnostics", daemon=True).start()
+
+    def _execute(self, command):
+        name = command.get("command")
+        report = {"service": self._service, "command": name}
+        if "reason" in command:
+            report["reason"] = command["reason"]
+        with self._lock:
+            try:
+                action = self._commands.get(name)
+                if action is None:
+                    raise ValueError("unknown command, one of {}".format(", ".join(sorted(self._commands))))
+                report.update(action(command))
+                report["ok"] = True
+            except Exception as e:
+                logging.error("Diagnostics command {} failed: {}".format(name, e))
+                report["ok"] = False
+                report["error"] = str(e)
+        logging.info("Diagnostics {}: {}".format(name, "ok" if report["ok"] else report["error"]))
+        try:
+            self._publish(report)
+        except Exception as e:
+            logging.error("Publishing the diagnostics report failed: {}".format(e))
+
+    def _duration(self, command, default):
+        return min(float(command.get("duration", default)), self._max_duration)
+
+    def _write(self, kind, suffix, writer):
+        # Path of the new file, None when nothing is kept on disk. The oldest
+        # files go once there are more than max_files or max_bytes
+        if not self._directory:
+            return None
+        os.makedirs(self._directory, exist_ok=True)
+        path = os.path.join(self._directory, "{}-{}.{}".format(kind, time.strftime("%Y%m%d-%H%M%S"), suffix))
+        writer(path)
+        self._prune()
+        return path
+
+    def _prune(self):
+        entries = []
+        for name in os.listdir(self._directory):
+            path = os.path.join(self._directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        # The newest file always stays
+        entries.sort(reverse=True)
+        total = 0
+        for index, (_, size, path) in enumerate(entries):
+            total += size
+            if index and (index >= self._max_files or total > self._max_bytes):
+                try:
+                    os.remove(path)
+                except OSError as e:
+                    logging.warning("Could not remove {}: {}".format(path, e))
+
+    def _profile_start(self, command):
+        if self._profiler is not None:
+            raise ValueError("already profiling")
+        duration = self._duration(command, DEFAULT_PROFILE_DURATION)
+        profiler = SamplingProfiler(command.get("interval", self._sample_interval), command.get("mode", MODE_CPU))
+        profiler.start(duration, lambda: self._dispatch({"command": "profile_stop", "reason": "duration"}))
+        self._profiler = profiler
+        return {"interval": profiler.interval, "duration": duration, "mode": profiler.mode}
+
+    def _profile_stop(self, command):
+        if self._profiler is None:
+            raise ValueError("not profiling")
+        profiler, self._profiler = self._profiler, None
+        profiler.stop()
+
+        def write(path):
+            with open(path, 'w') as f:
+                f.write(profiler.folded())
+        report = profiler.summary(self._top)
+        report["file"] = self._write("profile", "folded", write)
+        return report
+
+    def _tracemalloc_start(self, command):
+        if tracemalloc.is_tracing():
+            raise ValueError("already tracing")
+        frames = int(command.get("frames", DEFAULT_TRACE_FRAMES))
+        duration = self._duration(command, self._max_duration)
+        tracemalloc.start(frames)
+        self._snapshot = None
+        self._trace_timer = threading.Timer(duration, self._dispatch,
+                                            args=({"command": "tracemalloc_stop", "reason": "duration"},))
+        self._trace_timer.daemon = True
+        self._trace_timer.start()
+        return {"frames": frames, "duration": duration}
+
+    def _take_snapshot(self):
+        if not tracemalloc.is_tracing():
+            raise ValueError("not tracing, send tracemalloc_start first")
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap*>"),
+        ))
+        current, peak = tracemalloc.get_traced_memory()
+        report = {"traced_kb": current // 1024, "traced_peak_kb": peak // 1024,
+                  "file": self._write("tracemalloc", "snapshot", snapshot.dump)}
+        return snapshot, report
+
+    def _tracemalloc_snapshot(self, command):
+        snapshot, report = self._take_snapshot()
+        self._snapshot = snapshot
+        report["top"] = [{"where": where(statistic), "kb": round(statistic.size / 1024, 1), "count": statistic.count}
+                         for statistic in snapshot.statistics("lineno")[:self._top]]
+        return report
+
+    def _tracemalloc_diff(self, command):
+        snapshot, report = self._take_snapshot()
+        previous, self._snapshot = self._snapshot, snapshot
+        if previous is None:
+            # Nothing to compare with yet, the next diff is against this one
+            report["baseline"] = True
+            return report
+        report["growth"] = [{"where": where(statistic), "kb": round(statistic.size_diff / 1024, 1),
+                             "count": statistic.count_diff}
+                            for statistic in snapshot.compare_to(previous, "lineno")[:self._top]]
+        return report
+
+    def _tracemalloc_stop(self, command):
+        if not tracemalloc.is_tracing():
+            raise ValueError("not tracing")
+        self._stop_tracing()
+        return {}
+
+    def _stop_tracing(self):
+        if self._trace_timer is not None:
+            self._trace_timer.cancel()
+            self._trace_timer = None
+        self._snapshot = None
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    def _threads(self, command):
+        if not os.path.isdir(PROC_TASKS):
+            raise ValueError("per thread CPU needs {}".format(PROC_TASKS))
+        now = time.monotonic()
+        names = {thread.native_id: thread.name for thread in threading.enumerate()}
+        threads, cpu = [], {}
+        for tid in map(int, os.listdir(PROC_TASKS)):
+            cpu_ns = thread_cpu_ns(tid)
+            if cpu_ns is None:
+                continue
+            cpu[tid] = cpu_ns
+            entry = {"name": names.get(tid) or thread_comm(tid), "tid": tid, "cpu_s": round(cpu_ns / 1e9, 3)}
+            last = self._thread_cpu.get(tid)
+            if last is not None and now > self._thread_cpu_at:
+                entry["cpu_pct"] = round(100.0 * (cpu_ns - last) / 1e9 / (now - self._thread_cpu_at), 1)
+            threads.append(entry)
+        self._thread_cpu, self._thread_cpu_at = cpu, now
+        threads.sort(key=lambda entry: entry["cpu_s"], reverse=True)
+        return {"threads": threads}
+
+    def _resources(self, command):
+        times = os.times()
+        report = {"uptime_s": round(time.monotonic() - self._started, 1),
+                  "cpu_s": round(times.user + times.system, 2),
+                  "threads": threading.active_count(),
+                  "gc": list(gc.get_count()),
+                  "profiling": self._profiler is not None,
+                  "tracing": tracemalloc.is_tracing()}
+        report.update(memory_kb())
+        try:
+            report["fds"] = len(os.listdir("/proc/self/fd"))
+        except OSError:
+            pass
+        if self._counters is not None:
+            report["counters"] = self._counters()
+        if self._directory and os.path.isdir(self._directory):
+            report["files"] = sorted(os.listdir(self._directory))
+        return report
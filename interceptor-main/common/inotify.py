@@ -0,0 +1,62 @@
+import ctypes
+import os
+import struct
+
+# inotify(7) flags
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+_EVENT = struct.Struct("iIII")  # wd, mask, cookie, name length
+
+_libc = None
+
+
+class Inotify:
+    # Just enough of inotify to sleep until something changes in a few
+    # directories. Raises OSError where inotify is not available
+    def __init__(self):
+        global _libc
+        if _libc is None:
+            try:
+                _libc = ctypes.CDLL("libc.so.6", use_errno=True)
+            except OSError:
+                # Not glibc. ctypes.util and find_library (ldconfig or the
+                # compiler) take tens of ms, only paid where the soname differs
+                from ctypes.util import find_library
+                _libc = ctypes.CDLL(find_library("c"), use_errno=True)
+        self._fd = _libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+    def add_watch(self, path, mask=IN_CREATE | IN_DELETE | IN_ATTRIB | IN_MOVED_TO):
+        wd = _libc.inotify_add_watch(self._fd, os.fsencode(path), mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_add_watch {} failed".format(path))
+        return wd
+
+    def fileno(self):
+        return self._fd
+
+    def read(self):
+        # Names of everything that changed since the last read
+        names = []
+        try:
+            data = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return names
+        offset = 0
+        while offset + _EVENT.size <= len(data):
+            _, _, _, length = _EVENT.unpack_from(data, offset)
+            offset += _EVENT.size
+            names.append(data[offset:offset + length].rstrip(b"\0").decode(errors="replace"))
+            offset += length
+        return names
+
+    def close(self):
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
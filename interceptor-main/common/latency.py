@@ -0,0 +1,188 @@
+import os
+import threading
+import time
+
+# Latency histograms for the billing path, shared by pos-interface and
+# storetracker-interface. Values are recorded in microseconds into log-linear
+# buckets (HDR style): exact below 2^SUB_BITS, then 2^(SUB_BITS-1) buckets per
+# power of two, so any value is off by at most ~6% and memory stays fixed.
+
+SUB_BITS = 4
+MAX_BITS = 32  # about 71 minutes in microseconds, larger values are clamped
+PERCENTILES = (50, 90, 99, 99.9)
+
+
+def now_ns():
+    # CLOCK_MONOTONIC is system wide on Linux, so stamps compare across the
+    # containers on one device
+    return time.monotonic_ns()
+
+
+def new_correlation_id():
+    return os.urandom(4).hex()
+
+
+class LatencyHistogram:
+    def __init__(self, sub_bits=SUB_BITS, max_bits=MAX_BITS):
+        self._sub_bits = sub_bits
+        self._sub = 1 << sub_bits
+        self._half = self._sub >> 1
+        self._max_value = (1 << max_bits) - 1
+        self._counts = [0] * (self._sub + (max_bits - sub_bits) * self._half)
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            for i in range(len(self._counts)):
+                self._counts[i] = 0
+            self.count = 0
+            self.total = 0
+            self.min = None
+            self.max = None
+
+    def _index(self, value):
+        if value < self._sub:
+            return value
+        shift = value.bit_length() - self._sub_bits
+        return self._sub + (shift - 1) * self._half + (value >> shift) - self._half
+
+    def _bucket_value(self, index):
+        # Middle of the bucket, what a percentile reports
+        if index < self._sub:
+            return index
+        k, offset = divmod(index - self._sub, self._half)
+        shift = k + 1
+        low = (offset + self._half) << shift
+        return low + (1 << shift) // 2
+
+    def record(self, value_us):
+        value = min(max(int(value_us), 0), self._max_value)
+        with self._lock:
+            self._counts[self._index(value)] += 1
+            self.count += 1
+            self.total += value
+            if self.min is None or value < self.min:
+                self.min = value
+            if self.max is None or value > self.max:
+                self.max = value
+
+    def percentile(self, p):
+        with self._lock:
+            if not self.count:
+                return None
+            target = max(1, int(round(self.count * p / 100.0)))
+            seen = 0
+            for index, n in enumerate(self._counts):
+                seen += n
+                if seen >= target:
+                    return max(min(self._bucket_value(index), self.max), self.min)
+        return self.max
+
+    def summary(self):
+        if not self.count:
+            return {"count": 0}
+        result = {
+            "count": self.count,
+            "min": self.min,
+            "max": self.max,
+            "mean": round(self.total / self.count, 1),
+        }
+        for p in PERCENTILES:
+            result["p{}".format(p).replace(".", "_")] = self.percentile(p)
+        return result
+
+
+class LatencyRecorder:
+    # Named stage histograms, values in microseconds
+    def __init__(self, stages=()):
+        self._stages = {}
+        self._lock = threading.Lock()
+        for stage in stages:
+            self._stages[stage] = LatencyHistogram()
+
+    def _histogram(self, stage):
+        histogram = self._stages.get(stage)
+        if histogram is None:
+            with self._lock:
+                histogram = self._stages.setdefault(stage, LatencyHistogram())
+        return histogram
+
+    def record(self, stage, start_ns, end_ns):
+        if start_ns is None or end_ns is None:
+            return
+        self._histogram(stage).record((end_ns - start_ns) // 1000)
+
+    def snapshot(self, reset=False):
+        result = {}
+        for stage, histogram in list(self._stages.items()):
+            result[stage] = histogram.summary()
+            if reset:
+                histogram.reset()
+        return result
+
+
+def process_start_ns():
+    # monotonic_ns when this process was started, from /proc at clock tick
+    # resolution, None without /proc
+    try:
+        with open("/proc/self/stat", 'rb') as f:
+            fields = f.read().rsplit(b")", 1)[1].split()
+        started_ns = int(fields[19]) * 1000000000 // os.sysconf("SC_CLK_TCK")
+        return now_ns() - (time.clock_gettime_ns(time.CLOCK_BOOTTIME) - started_ns)
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+
+class StartupTimer:
+    # Milestones of a service start in ms since the process was started, so
+    # interpreter start and imports are included. Only the first mark of a
+    # name counts
+    def __init__(self):
+        self.origin_ns = process_start_ns() or now_ns()
+        self.marks = {}
+
+    def mark(self, name, ns=None):
+        if name not in self.marks:
+            self.marks[name] = round(((ns or now_ns()) - self.origin_ns) / 1e6, 1)
+        return self.marks[name]
+
+    def report(self, budget_ms=None, milestone="ready"):
+        # The marks, and whether milestone came later than budget_ms
+        report = dict(self.marks)
+        if budget_ms:
+            report["budget_ms"] = budget_ms
+            report["over_budget"] = milestone not in self.marks or self.marks[milestone] > budget_ms
+        return report
+
+
+# pos/billing payloads carry the bill result plus the trace that lets the
+# storetracker side time the rest of the path:
+#   "True <correlation id> <first byte ns> <classified ns> [<transaction id>]"
+# A bare "True"/"False" is still accepted
+
+def bill_payload(bill_ok, trace=None):
+    result = "True" if bill_ok else "False"
+    if not trace:
+        return result
+    payload = "{} {} {} {}".format(result, trace["id"], trace.get("rx_ns") or 0, trace.get("classified_ns") or 0)
+    if trace.get("txn"):
+        # Transaction id, the storetracker side drops a transaction it has seen
+        payload += " " + trace["txn"]
+    return payload
+
+
+def parse_bill_payload(payload):
+    # Returns (bill_ok, trace) or None if the payload is not a bill result
+    parts = payload.split()
+    if not parts or parts[0] not in ("True", "False"):
+        return None
+    trace = None
+    if len(parts) >= 4:
+        try:
+            trace = {"id": parts[1], "rx_ns": int(parts[2]) or None, "classified_ns": int(parts[3]) or None}
+            if len(parts) >= 5:
+                trace["txn"] = parts[4]
+        except ValueError:
+            trace = None
+    return parts[0] == "True", trace
@@ -0,0 +1,402 @@
+import collections
+import json
+import logging
+import queue
+import struct
+import threading
+import types
+from latency import now_ns
+
+# MQTT for pos-interface and storetracker-interface. Events (init states and
+# bills) go out at qos_events in a small binary envelope, metrics and debug
+# topics are queued and published together every batch_interval seconds.
+
+DEFAULT_HOST = "localhost"
+DEFAULT_PORT = 1883
+DEFAULT_KEEPALIVE = 60
+DEFAULT_QOS_EVENTS = 1
+DEFAULT_QOS_METRICS = 0
+DEFAULT_BATCH_INTERVAL = 1.0
+DEFAULT_MAX_PENDING = 10000
+RECONNECT_DELAY_MIN = 1
+RECONNECT_DELAY_MAX = 30
+
+ENVELOPE_BINARY = "binary"
+ENVELOPE_TEXT = "text"
+
+# Envelope, network byte order, then the lane name and the body:
+#   magic | version | kind | lane length | seq u32 | monotonic ns u64
+# The magic byte is not ASCII, a text payload never starts with it
+ENVELOPE = struct.Struct("!BBBBIQ")
+ENVELOPE_MAGIC = 0xB5
+ENVELOPE_VERSION = 1
+SEQ_MASK = 0xFFFFFFFF
+
+KIND_TEXT = 0       # Not enveloped, a bare "True"/"False", a bill line or JSON
+KIND_STATUS = 1     # Body is one byte, 1 up and 0 down
+KIND_BILL = 2       # Body is the bill payload, see latency.bill_payload
+
+
+class Message:
+    # A received payload. seq, ts_ns and lane are None without an envelope
+    __slots__ = ("topic", "kind", "seq", "ts_ns", "lane", "body")
+
+    def __init__(self, topic, kind, seq, ts_ns, lane, body):
+        self.topic = topic
+        self.kind = kind
+        self.seq = seq
+        self.ts_ns = ts_ns
+        self.lane = lane
+        self.body = body
+
+    def text(self):
+        # The payload as the text services used to publish it
+        if self.kind == KIND_STATUS:
+            return "True" if self.body[:1] == b"\x01" else "False"
+        return self.body.decode('utf-8', errors='replace')
+
+    def status(self):
+        # True/False for a status event or a bare "True"/"False", else None
+        text = self.text().strip()
+        return {"True": True, "False": False}.get(text)
+
+
+def encode(kind, seq, ts_ns, lane, body):
+    lane = (lane or "").encode('utf-8')[:255]
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    return ENVELOPE.pack(ENVELOPE_MAGIC, ENVELOPE_VERSION, kind, len(lane), seq & SEQ_MASK, ts_ns) + lane + body
+
+
+def decode(topic, payload):
+    # Message from an enveloped or a plain payload
+    if isinstance(payload, str):
+        payload = payload.encode('utf-8')
+    if len(payload) >= ENVELOPE.size and payload[0] == ENVELOPE_MAGIC:
+        _, version, kind, lane_length, seq, ts_ns = ENVELOPE.unpack_from(payload)
+        if version == ENVELOPE_VERSION:
+            start = ENVELOPE.size + lane_length
+            lane = payload[ENVELOPE.size:start].decode('utf-8', errors='replace') or None
+            return Message(topic, kind, seq, ts_ns, lane, payload[start:])
+    return Message(topic, KIND_TEXT, None, None, None, payload)
+
+
+_mqtt = None
+
+
+def _paho():
+    # paho is imported on first use, it is a good part of a service's import
+    # time and everything before the first MQTT connection can do without it
+    global _mqtt
+    if _mqtt is None:
+        import paho.mqtt.client as mqtt
+        _mqtt = mqtt
+    return _mqtt
+
+
+def paho_client(client_id, clean_session):
+    mqtt = _paho()
+    return mqtt.Client(mqtt.CallbackAPIVersion.VERSION1, client_id=client_id or "", clean_session=clean_session)
+
+
+class Messenger:
+    # One MQTT connection for a service.
+    # Connects in the background and keeps reconnecting, so a broker that is
+    # late or restarts does not stop the service. With clean_session false
+    # and a fixed client_id the broker keeps the subscriptions and queues
+    # QoS 1/2 events while the service is away, and events published while
+    # the broker is away wait in the client (up to max_pending).
+    # Every event carries a per topic sequence number and the monotonic time
+    # it was published, the receiving side counts gaps and drops a redelivered
+    # copy of the last event. envelope "text" publishes the old bare payloads.
+    # backend(client_id, clean_session) makes the paho style client,
+    # LoopbackBroker.client keeps everything in memory for tests
+    def __init__(self, client_id, host=DEFAULT_HOST, port=DEFAULT_PORT, keepalive=DEFAULT_KEEPALIVE,
+                 clean_session=False, qos_events=DEFAULT_QOS_EVENTS, qos_metrics=DEFAULT_QOS_METRICS,
+                 envelope=ENVELOPE_BINARY, batch_interval=DEFAULT_BATCH_INTERVAL, max_pending=DEFAULT_MAX_PENDING,
+                 backend=None):
+        for qos in (qos_events, qos_metrics):
+            if int(qos) not in (0, 1, 2):
+                raise ValueError("MQTT QoS must be 0, 1 or 2, not {}".format(qos))
+        if envelope not in (ENVELOPE_BINARY, ENVELOPE_TEXT):
+            raise ValueError("MQTT envelope must be {} or {}, not {}".format(ENVELOPE_BINARY, ENVELOPE_TEXT, envelope))
+        if not clean_session and not client_id:
+            raise ValueError("A persistent MQTT session needs a client_id")
+        self._address = (host, int(port))
+        self._keepalive = int(keepalive)
+        self._qos_events = int(qos_events)
+        self._qos_metrics = int(qos_metrics)
+        self._envelope = envelope
+        self._batch_interval = float(batch_interval)
+        self._max_pending = int(max_pending)
+
+        self._client = (backend or paho_client)(client_id, bool(clean_session))
+        self._client.on_connect = self._on_connect
+        self._client.on_disconnect = self._on_disconnect
+        self._client.on_message = self._on_message
+        self._client.reconnect_delay_set(RECONNECT_DELAY_MIN, RECONNECT_DELAY_MAX)
+        self._client.max_queued_messages_set(self._max_pending)
+
+        self._lock = threading.Lock()
+        self._handlers = collections.OrderedDict()
+        self._seq = {}
+        self._last_received = {}
+        self._pending = collections.deque()
+        self._stopped = threading.Event()
+        self._flusher = None
+        self._network = None
+        self.connected = False
+        self.first_connect_ns = None
+        self.stats = {"published": 0, "batched": 0, "dropped": 0, "received": 0, "duplicates": 0, "gaps": 0,
+                      "connects": 0, "bytes_out": 0, "bytes_in": 0}
+
+    @classmethod
+    def from_config(cls, mqtt_config, client_id, backend=None):
+        mqtt_config = mqtt_config or {}
+        return cls(mqtt_config.get('client_id', client_id), backend=backend,
+                   host=mqtt_config.get('host', DEFAULT_HOST),
+                   port=mqtt_config.get('port', DEFAULT_PORT),
+                   keepalive=mqtt_config.get('keepalive', DEFAULT_KEEPALIVE),
+                   clean_session=mqtt_config.get('clean_session', False),
+                   qos_events=mqtt_config.get('qos_events', DEFAULT_QOS_EVENTS),
+                   qos_metrics=mqtt_config.get('qos_metrics', DEFAULT_QOS_METRICS),
+                   envelope=mqtt_config.get('envelope', ENVELOPE_BINARY),
+                   batch_interval=mqtt_config.get('batch_interval', DEFAULT_BATCH_INTERVAL),
+                   max_pending=mqtt_config.get('max_pending', DEFAULT_MAX_PENDING))
+
+    def start(self):
+        self._client.connect_async(self._address[0], self._address[1], self._keepalive)
+        self._start_network()
+        if self._batch_interval > 0 and self._flusher is None:
+            self._flusher = threading.Thread(target=self._flush_loop, name="mqtt-batch", daemon=True)
+            self._flusher.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._flusher is not None:
+            self._flusher.join(timeout=1)
+        self.flush()
+        self._client.disconnect()
+        self._client.loop_stop()
+
+    def _start_network(self):
+        # paho forgets its network thread when it ends, the reference is kept
+        # here so a thread that died is noticed
+        self._client.loop_start()
+        self._network = getattr(self._client, "_thread", None)
+
+    def alive(self):
+        # False once the paho network thread or the batch thread died, an
+        # exception in a paho callback ends the network thread
+        if self._stopped.is_set():
+            return True
+        if self._network is not None and not self._network.is_alive():
+            return False
+        return self._flusher is None or self._flusher.is_alive()
+
+    def restart(self):
+        # Starts whichever thread died again, the session and the queued
+        # messages stay with the client
+        if self._network is not None and not self._network.is_alive():
+            self._client.loop_stop()
+            self._start_network()
+        if self._flusher is not None and not self._flusher.is_alive():
+            self._flusher = threading.Thread(target=self._flush_loop, name="mqtt-batch", daemon=True)
+            self._flusher.start()
+
+    def subscribe(self, topic, handler, qos=None):
+        # handler(message) on the MQTT network thread. Subscriptions are
+        # renewed on every connect
+        qos = self._qos_events if qos is None else int(qos)
+        with self._lock:
+            self._handlers.setdefault(topic, ([], qos))[0].append(handler)
+        if self.connected:
+            self._client.subscribe(topic, qos)
+
+    def _on_connect(self, client, userdata, flags, rc):
+        if rc != 0:
+            logging.error("MQTT connection to {}:{} refused, rc={}".format(self._address[0], self._address[1], rc))
+            return
+        self.connected = True
+        self.stats["connects"] += 1
+        if self.first_connect_ns is None:
+            self.first_connect_ns = now_ns()
+        logging.debug("Connected to message broker, session present={}".format(flags.get('session present', 0)))
+        with self._lock:
+            subscriptions = [(topic, qos) for topic, (_, qos) in self._handlers.items()]
+        for topic, qos in subscriptions:
+            self._client.subscribe(topic, qos)
+
+    def _on_disconnect(self, client, userdata, rc):
+        self.connected = False
+        if rc != 0 and not self._stopped.is_set():
+            logging.warning("Lost the message broker, rc={}, reconnecting".format(rc))
+
+    def _on_message(self, client, userdata, msg):
+        message = decode(msg.topic, msg.payload)
+        self.stats["received"] += 1
+        self.stats["bytes_in"] += len(msg.payload)
+        if message.seq is not None and not self._in_sequence(message):
+            return
+        logging.debug("Received message: {} {}".format(msg.topic, message.text()))
+        with self._lock:
+            handlers = [handler for topic, (topic_handlers, _) in self._handlers.items()
+                        if _paho().topic_matches_sub(topic, msg.topic) for handler in topic_handlers]
+        for handler in handlers:
+            try:
+                handler(message)
+            except Exception as e:
+                logging.error("Error handling message on {}: {}".format(msg.topic, e))
+
+    def _in_sequence(self, message):
+        # False for a redelivered copy of the last event on the topic. A
+        # sequence that jumps back is a restarted publisher, not a gap
+        last = self._last_received.get(message.topic)
+        self._last_received[message.topic] = (message.seq, message.ts_ns)
+        if last is None:
+            return True
+        if last == (message.seq, message.ts_ns):
+            self.stats["duplicates"] += 1
+            logging.debug("Dropping redelivered event {} on {}".format(message.seq, message.topic))
+            return False
+        missing = (message.seq - last[0] - 1) & SEQ_MASK
+        if 0 < missing < (SEQ_MASK >> 1):
+            self.stats["gaps"] += missing
+            logging.warning("{} event(s) missing on {} before {}".format(missing, message.topic, message.seq))
+        return True
+
+    def _next_seq(self, topic):
+        with self._lock:
+            seq = self._seq[topic] = (self._seq.get(topic, 0) + 1) & SEQ_MASK
+        return seq
+
+    def _event_payload(self, topic, kind, body, text, lane):
+        if self._envelope == ENVELOPE_TEXT:
+            return text
+        return encode(kind, self._next_seq(topic), now_ns(), lane, body)
+
+    def publish(self, topic, payload, qos=None, retain=False):
+        info = self._client.publish(topic, payload, self._qos_events if qos is None else qos, retain)
+        self.stats["published"] += 1
+        self.stats["bytes_out"] += len(payload) if payload is not None else 0
+        return info
+
+    def publish_status(self, topic, ok, lane=None):
+        payload = self._event_payload(topic, KIND_STATUS, b"\x01" if ok else b"\x00", "True" if ok else "False", lane)
+        return self.publish(topic, payload)
+
+    def publish_bill(self, topic, payload, lane=None, debug=False):
+        # debug: an observability copy, batched at qos_metrics
+        payload = self._event_payload(topic, KIND_BILL, payload, payload, lane)
+        if debug:
+            self._enqueue(topic, payload)
+        else:
+            self.publish(topic, payload)
+
+    def publish_metric(self, topic, value):
+        self._enqueue(topic, json.dumps(value))
+
+    def _enqueue(self, topic, payload):
+        if self._batch_interval <= 0:
+            self.publish(topic, payload, self._qos_metrics)
+            return
+        with self._lock:
+            if len(self._pending) >= self._max_pending:
+                self._pending.popleft()
+                self.stats["dropped"] += 1
+            self._pending.append((topic, payload))
+
+    def flush(self):
+        # Publishes the queued metric and debug messages
+        with self._lock:
+            pending, self._pending = self._pending, collections.deque()
+        for topic, payload in pending:
+            self.publish(topic, payload, self._qos_metrics)
+        self.stats["batched"] += len(pending)
+
+    def _flush_loop(self):
+        while not self._stopped.wait(self._batch_interval):
+            self.flush()
+
+
+class LoopbackBroker:
+    # In-memory stand-in for mosquitto, pass its client method as the
+    # Messenger backend. Messages are delivered in publish order on one
+    # dispatcher thread, like paho's network thread. QoS, sessions and
+    # keepalive are accepted and ignored, nothing is ever lost
+    def __init__(self):
+        self._clients = []
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self.listeners = []
+        threading.Thread(target=self._dispatch, name="loopback-broker", daemon=True).start()
+
+    def client(self, client_id=None, clean_session=True):
+        return LoopbackClient(self)
+
+    def attach(self, client):
+        with self._lock:
+            self._clients.append(client)
+
+    def detach(self, client):
+        with self._lock:
+            if client in self._clients:
+                self._clients.remove(client)
+
+    def publish(self, topic, payload):
+        if isinstance(payload, str):
+            payload = payload.encode()
+        for listener in self.listeners:
+            listener(topic, payload)
+        self._queue.put((topic, payload))
+
+    def _dispatch(self):
+        while True:
+            topic, payload = self._queue.get()
+            with self._lock:
+                clients = list(self._clients)
+            msg = types.SimpleNamespace(topic=topic, payload=payload, qos=0, retain=False)
+            for client in clients:
+                if client.subscribed(topic) and client.on_message is not None:
+                    client.on_message(client, None, msg)
+
+
+class LoopbackClient:
+    # The part of paho.mqtt.client.Client Messenger uses
+    def __init__(self, broker):
+        self._broker = broker
+        self._subscriptions = set()
+        self.on_connect = None
+        self.on_disconnect = None
+        self.on_message = None
+
+    def reconnect_delay_set(self, min_delay=1, max_delay=120):
+        pass
+
+    def max_queued_messages_set(self, queue_size):
+        pass
+
+    def connect_async(self, host, port=1883, keepalive=60):
+        self._broker.attach(self)
+
+    def loop_start(self):
+        if self.on_connect is not None:
+            self.on_connect(self, None, {}, 0)
+
+    def loop_stop(self):
+        pass
+
+    def disconnect(self):
+        self._broker.detach(self)
+        if self.on_disconnect is not None:
+            self.on_disconnect(self, None, 0)
+
+    def subscribe(self, topic, qos=0):
+        self._subscriptions.add(topic)
+        return 0, 0
+
+    def subscribed(self, topic):
+        return any(_paho().topic_matches_sub(sub, topic) for sub in self._subscriptions)
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self._broker.publish(topic, payload)
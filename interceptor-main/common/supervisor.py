@@ -0,0 +1,167 @@
+import logging
+import os
+import threading
+import time
+
+DEFAULT_INTERVAL = 0.05
+DEFAULT_BACKOFF_MIN = 0.05
+DEFAULT_BACKOFF_MAX = 5.0
+DEFAULT_STABLE_AFTER = 10.0
+EXIT_WATCHDOG = 3
+
+STATE_UP = "up"
+STATE_FAILED = "failed"
+
+
+def exit_process(name, reason):
+    # Last resort for a component that cannot be restarted in place, the
+    # container restart policy brings the service back
+    logging.critical("{} cannot be restarted in process ({}), exiting".format(name, reason))
+    logging.shutdown()
+    os._exit(EXIT_WATCHDOG)
+
+
+class Component:
+    # A thread, loop or connection the supervisor watches. alive() is False
+    # once it died, beat() is its heartbeat when it has a timeout. pause()
+    # stops the heartbeat check while it waits on purpose, e.g. for a port
+    # that is unplugged, the next beat() resumes it
+    def __init__(self, name, alive=None, restart=None, timeout=None, on_state=None):
+        self.name = name
+        self.alive = alive
+        self.restart = restart
+        self.timeout = float(timeout) if timeout else None
+        self.on_state = on_state
+        self.state = STATE_UP
+        self.paused = False
+        self.last_beat = time.monotonic()
+        self.failed_at = None
+        self.healthy_since = self.last_beat
+        self.next_restart = 0.0
+        self.failures = 0
+        self.restarts = 0
+        self.last_recovery_ms = None
+
+    def beat(self):
+        self.paused = False
+        self.last_beat = time.monotonic()
+
+    def pause(self):
+        self.paused = True
+
+    def stats(self):
+        return {"state": self.state, "restarts": self.restarts, "last_recovery_ms": self.last_recovery_ms}
+
+
+class Supervisor:
+    # Watches the components of a service from one thread and restarts the one
+    # that failed, the others keep running. A component fails when alive()
+    # says so or its heartbeat is older than its timeout. The first restart
+    # is immediate, the next ones back off from backoff_min doubling up to
+    # backoff_max until it stays healthy for stable_after seconds.
+    # on_state(ok) of the component is called when it fails and when it is
+    # back. A component without restart goes to on_fatal(name, reason)
+    def __init__(self, interval=DEFAULT_INTERVAL, backoff_min=DEFAULT_BACKOFF_MIN, backoff_max=DEFAULT_BACKOFF_MAX,
+                 stable_after=DEFAULT_STABLE_AFTER, on_fatal=exit_process):
+        self._interval = float(interval)
+        self._backoff_min = float(backoff_min)
+        self._backoff_max = float(backoff_max)
+        self._stable_after = float(stable_after)
+        self._on_fatal = on_fatal
+        self._components = []
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    @classmethod
+    def from_config(cls, supervisor_config, on_fatal=exit_process):
+        supervisor_config = supervisor_config or {}
+        return cls(on_fatal=on_fatal,
+                   interval=supervisor_config.get('interval', DEFAULT_INTERVAL),
+                   backoff_min=supervisor_config.get('backoff_min', DEFAULT_BACKOFF_MIN),
+                   backoff_max=supervisor_config.get('backoff_max', DEFAULT_BACKOFF_MAX),
+                   stable_after=supervisor_config.get('stable_after', DEFAULT_STABLE_AFTER))
+
+    def add(self, name, alive=None, restart=None, timeout=None, on_state=None):
+        component = Component(name, alive=alive, restart=restart, timeout=timeout, on_state=on_state)
+        with self._lock:
+            self._components.append(component)
+        return component
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="supervisor", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout=1)
+
+    def stats(self):
+        with self._lock:
+            return {component.name: component.stats() for component in self._components}
+
+    def _run(self):
+        while not self._stopped.wait(self._interval):
+            with self._lock:
+                components = list(self._components)
+            for component in components:
+                try:
+                    self._check(component, time.monotonic())
+                except Exception as e:
+                    logging.error("Supervisor check of {} failed: {}".format(component.name, e))
+
+    def _failure(self, component, now):
+        # None when healthy, the reason otherwise
+        try:
+            if component.alive is not None and not component.alive():
+                return "not running"
+        except Exception as e:
+            return "health check raised {}".format(e)
+        if component.timeout and not component.paused and now - component.last_beat > component.timeout:
+            return "no heartbeat for {:.1f}s".format(now - component.last_beat)
+        return None
+
+    def _set_state(self, component, ok):
+        component.state = STATE_UP if ok else STATE_FAILED
+        if component.on_state is not None:
+            try:
+                component.on_state(ok)
+            except Exception as e:
+                logging.error("Reporting the state of {} failed: {}".format(component.name, e))
+
+    def _check(self, component, now):
+        reason = self._failure(component, now)
+        if reason is None:
+            if component.state == STATE_FAILED:
+                component.last_recovery_ms = round((now - component.failed_at) * 1000, 1)
+                component.healthy_since = now
+                logging.warning("{} recovered in {}ms".format(component.name, component.last_recovery_ms))
+                self._set_state(component, True)
+            elif component.failures and now - component.healthy_since >= self._stable_after:
+                component.failures = 0
+            return
+
+        if component.state == STATE_UP:
+            logging.error("{} failed: {}".format(component.name, reason))
+            component.failed_at = now
+            component.next_restart = now if not component.failures else \
+                now + min(self._backoff_min * 2 ** (component.failures - 1), self._backoff_max)
+            self._set_state(component, False)
+        if now < component.next_restart:
+            return
+        if component.restart is None:
+            self._on_fatal(component.name, reason)
+            component.next_restart = float("inf")
+            return
+        component.failures += 1
+        component.restarts += 1
+        logging.info("Restarting {}, attempt {}".format(component.name, component.failures))
+        try:
+            component.restart()
+        except Exception as e:
+            logging.error("Restarting {} failed: {}".format(component.name, e))
+        component.beat()
+        component.next_restart = time.monotonic() + min(self._backoff_min * 2 ** (component.failures - 1),
+                                                         self._backoff_max)
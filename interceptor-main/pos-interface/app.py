@@ -1,16 +1,27 @@
 import logging
 import time
-import serial.tools
-import serial.tools.list_ports
-import yaml
 import serial
 import argparse
 import os
-import glob
 import threading
-import paho.mqtt.client as mqtt
+import json
+import collections
 import sys
 
+# Shared modules are in ../common in a checkout and next to app.py in the image
+COMMON_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common")
+if os.path.isdir(COMMON_DIR):
+    sys.path.append(COMMON_DIR)
+
+from latency import bill_payload, StartupTimer
+from messaging import Messenger
+from supervisor import Supervisor
+from diagnostics import Diagnostics
+from config_service import ConfigService, merge, DEFAULT_CACHE_DIR as DEFAULT_CONFIG_CACHE_DIR
+from matcher import LineMatcher
+from device_watcher import DeviceWatcher, DEFAULT_CACHE_FILE
+from lane import Lane, STATUS_POS, STATUS_PRINTER, POS_CONFIG_CODE, validate_pos_config
+
 BANNER = r'''
   _____   ____   _____     _____ _   _ _______ ______ _____  ______      _____ ______  
  |  __ \ / __ \ / ____|   |_   _| \ | |__   __|  ____|  __ \|  ____/\   / ____|  ____| 
@@ -28,221 +39,563 @@ BROKER_POS_INIT_STATUS_TOPIC = "pos/init"
 BROKER_PRINTER_INIT_STATUS_TOPIC = "printer/init"
 BROKER_SWITCH_INIT_STATUS_TOPIC = "switch/init"
 BROKER_POS_BILL_STATUS_TOPIC = "pos/billing"
+BROKER_PRINTER_METRICS_TOPIC = "printer/metrics"
+BROKER_POS_BILL_MIRROR_TOPIC = "pos/billing/mirror"
+BROKER_LATENCY_METRICS_TOPIC = "metrics/latency/{}"
+BROKER_METRICS_DUMP_TOPIC = "metrics/dump"
+BROKER_CONTROL_TOPIC = "control/diagnostics"
+BROKER_DIAGNOSTICS_TOPIC = "diagnostics/{}"
+BROKER_STARTUP_METRICS_TOPIC = "metrics/startup/{}"
+
+MQTT_CLIENT_ID = "pos-interface"
+# Errors in a row before a POS reader is restarted
+MAX_READ_ERRORS = 5
+# Seconds on top of idle_gap a replaced read loop gets to return
+READER_JOIN_MARGIN = 1.0
+# Seconds between _tick() calls
+TICK_INTERVAL = 1.0
+DEFAULT_READER_TIMEOUT = 5.0
+DEFAULT_LOOP_TIMEOUT = 10.0
+DEFAULT_FAST_START = True
+DEFAULT_STARTUP_BUDGET_MS = 1000
+
+SWITCH_CONFIG_FILE = "./config/switch_config.yaml"
+# Not the storetracker service's outbox, that one may still be running on the
+# same /data and would send its pending ACCs a second time
+UNIFIED_OUTBOX_PATH = "/data/acc_outbox_unified.db"
+STORETRACKER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "storetracker-interface")
             
 class POSInterface:
-    def __init__(self, pos_config = POS_CONFIG_FILE, print_config = PRINTER_CONFIG_FILE):
+    def __init__(self, pos_config = POS_CONFIG_FILE, print_config = PRINTER_CONFIG_FILE, bill_sink = None, lanes_config = None,
+                 pos_overrides = None, print_overrides = None, config_cache = DEFAULT_CONFIG_CACHE_DIR, mqtt_backend = None):
+        # Milestones since the process started, published on
+        # metrics/startup/pos-interface once the broker is up
+        self._startup = StartupTimer()
+        self._startup.mark("init")
+        self._startup_published = None
+        self._startup_reported = False
         self._pos_config_file = pos_config
         self._print_config_file = print_config
-        try:
-            # Create an MQTT client instance
-            self._client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION1)
-
-            # Set the callback functions
-            self._client.on_connect = self._on_connect
-            self._client.on_message = self._on_message
-        
-            # Connect to the MQTT broker (localhost)
-            self._client.connect("localhost", 1883, 60)
-
-            # Start the MQTT network loop
-            self._client.loop_start()
-        except Exception as e:
-            logging.error("Error in setting up local broker")
-            raise
-        ### POS setup    
+        # With a bill sink (unified runtime) bills go straight to the switch
+        # client and pos/billing is only mirrored for observability
+        self._bill_sink = bill_sink
+        self._latency_sources = {}
+        ### POS setup
         if not os.path.exists(self._pos_config_file):
             logging.error("POS config file not found")
             raise
-        
-        try:
-            with open(self._pos_config_file, 'r') as f:
-                self._pos_config = yaml.safe_load(f)
-        except Exception as e:
-            logging.error("Could not load YAML")
-            raise e
-        
+
+        # Configs are read through the config service: the compiled matcher
+        # comes from its cache on a cold start, and pos config changes are
+        # applied to the running lanes on the POS loop without closing ports.
+        # The overrides (command line, lane ports) are laid over every load
+        self._config = ConfigService(cache_dir=config_cache)
+        self._pos_overrides = pos_overrides or {}
+        self._print_overrides = print_overrides or {}
+        self._pos_sources = {}
+        self._pos_compiled = {}
+        self._updates = collections.deque()
+        pos_config, pos_matcher = self._watch_pos_config(self._pos_config_file)
+        self._pos_config = merge(pos_config, self._pos_overrides)
         logging.debug("Loading POS config from file={}, service={}".format(self._pos_config_file, self._pos_config['service']))
-        
-        self._pos_serial_port = self._pos_config['SETTINGS']['SERIAL']['static_port']
-        self._pos_baud_rate = self._pos_config['SETTINGS']['SERIAL']['baud']
-        self._pos_serial_setting = self._pos_config['SETTINGS']['SERIAL']['serial_setting']
+        self._print_config = merge(self._config.load(self._print_config_file)[0], self._print_overrides)
+        logging.debug("Loading Printer config from file={}, service={}".format(self._print_config_file, self._print_config['service']))
+        self._startup.mark("config")
+        startup_config = self._pos_config['SETTINGS'].get('STARTUP') or {}
+        fast_start = bool(startup_config.get('fast_start', DEFAULT_FAST_START))
+        self._startup_budget_ms = float(startup_config.get('budget_ms', DEFAULT_STARTUP_BUDGET_MS))
+
+        # Ports are found and reopened through the device watcher, which
+        # also implements auto_scan/usb_pattern
+        self._devices = DeviceWatcher(cache_file=self._pos_config['SETTINGS'].get('device_cache', DEFAULT_CACHE_FILE))
+        # Lane states from before MQTT is set up, published once it is
+        self._messenger = None
+        self._early_status = []
+
+        if lanes_config is None:
+            # Classic install, one lane on the pos/printer config as is
+            lane = Lane(None, self._pos_config, self._print_config, self._devices,
+                        on_bill=self._publish_bill, on_status=self._on_lane_status,
+                        matcher=pos_matcher)
+            self._pos_sources[self._pos_config_file].append((lane, self._pos_overrides))
+            self._lanes = [lane]
+        else:
+            if self._bill_sink is None:
+                raise ValueError("Lanes need the unified runtime, storetracker only knows one checkout")
+            self._lanes = self._load_lanes(lanes_config)
+        if fast_start:
+            # POS ports first: bytes the POS sends from here on wait in the
+            # tty instead of being lost while MQTT and the printers come up
+            for lane in self._lanes:
+                lane.open_pos()
+            self._startup.mark("pos_open")
 
-        self._pos_generic_strings = self._pos_config['GENERIC_STRINGS']
-        self._pos_success_strings = self._pos_config['SUCCESS_STRINGS']
-        self._pos_failure_strings = self._pos_config['FAILURE_STRINGS']
-        
-        logging.debug("Setting up POS serial interface")
-        logging.debug("Attempting to connect to {} {} {}".format(self._pos_serial_port, self._pos_baud_rate, self._pos_serial_setting))
         try:
-            self._pos_ser = serial.Serial(
-            port=self._pos_serial_port,
-            baudrate=int(self._pos_baud_rate),
-            bytesize=int(self._pos_serial_setting[0]),
-            parity=self._pos_serial_setting[1],
-            stopbits=int(self._pos_serial_setting[2])
-            )
-            logging.info("Connected to POS serial port: {}".format(self._pos_serial_port))
-            self._client.publish(BROKER_POS_INIT_STATUS_TOPIC, "True")
+            # Connects in the background, lane states published before the
+            # broker is up go out once it is
+            self._messenger = Messenger.from_config(self._pos_config['SETTINGS'].get('MQTT'), MQTT_CLIENT_ID,
+                                                    backend=mqtt_backend)
+            self._messenger.subscribe(BROKER_SWITCH_INIT_STATUS_TOPIC, self._on_switch_status)
+            self._messenger.subscribe(BROKER_METRICS_DUMP_TOPIC, self._on_metrics_dump)
+            # Profiling and resource reports on demand, idle until asked
+            self._diagnostics = Diagnostics.from_config(self._pos_config['SETTINGS'].get('DIAGNOSTICS'), MQTT_CLIENT_ID,
+                                                        self._publish_diagnostics, counters=self._diagnostic_counters)
+            self._messenger.subscribe(BROKER_CONTROL_TOPIC, self._diagnostics.handle)
+            self._messenger.start()
         except Exception as e:
-            self._pos_ser = None
-            logging.error("Error connecting to POS serial port:", e)
-            self._client.publish(BROKER_POS_INIT_STATUS_TOPIC, "False")
+            logging.error("Error in setting up local broker")
             raise
-        
-        ### Printer setup
-        try:
-            with open(self._print_config_file, 'r') as f:
-                self._print_config = yaml.safe_load(f)
-        except Exception as e:
-            logging.error("Could not load YAML")
-            raise e
-        
-        logging.debug("Loading Printer config from file={}, service={}".format(self._print_config_file, self._print_config['service']))
-        self._print_enabled = self._print_config['enabled']
-        
-        if self._print_enabled:
-            self._print_serial_port = self._print_config['SETTINGS']['SERIAL']['static_port']
-            self._print_baud_rate = self._print_config['SETTINGS']['SERIAL']['baud']
-            self._print_serial_setting = self._print_config['SETTINGS']['SERIAL']['serial_setting']
-            try:
-                self._print_ser = serial.Serial(
-                    port=self._print_serial_port,
-                    baudrate=int(self._print_baud_rate),
-                    bytesize=int(self._print_serial_setting[0]),
-                    parity=self._print_serial_setting[1],
-                    stopbits=int(self._print_serial_setting[2])
-                )
-                logging.info("Connected to Print serial port: {}".format(self._print_serial_port))
-                self._client.publish(BROKER_PRINTER_INIT_STATUS_TOPIC, "True")
-            except Exception as e:
-                self._print_ser = None
-                logging.error("Error connecting to Printer serial port: %s", e)
-                self._client.publish(BROKER_PRINTER_INIT_STATUS_TOPIC, "False")
-                raise
-        else:
-            logging.info("Printer interface not enabled, moving on!")
-
-        if self._pos_ser is None:
-            logging.error("POS serial port not found, starting thread to wait for it")
-            exit_flag = True
-            while exit_flag:
-                ports = serial.tools.list_ports.comports()
-                logging.info("Looking for port: {}".format(self._pos_serial_port))
-                for port in ports:
-                    logging.info(f"Device: {port.device}")
-                    logging.info(f"Description: {port.description}")
-                    logging.info(f"Hardware ID: {port.hwid}")
-                    logging.info("-" * 20)
-                    if port.device == self._pos_serial_port:
-                        exit_flag = False
-                time.sleep(5)
-            try:
-                self._pos_ser = serial.Serial(
-                port=self._pos_serial_port,
-                baudrate=int(self._pos_baud_rate),
-                bytesize=int(self._pos_serial_setting[0]),
-                parity=self._pos_serial_setting[1],
-                stopbits=int(self._pos_serial_setting[2])
-                )
-                logging.info("Connected to POS serial port: {}".format(self._pos_serial_port))
-                self._client.publish(BROKER_POS_INIT_STATUS_TOPIC, "True")
-            except Exception as e:
-                logging.error("Error connecting to POS serial port:", e)
-                self._client.publish(BROKER_POS_INIT_STATUS_TOPIC, "False")
-                raise
-
-        if self._print_enabled and self._print_ser is None:
-            logging.error("Printer serial port not found, starting thread to wait for it")
-            exit_flag = True
-            while exit_flag:
-                ports = serial.tools.list_ports.comports()
-                logging.info("Looking for port: {}".format(self._print_serial_port))
-                for port in ports:
-                    logging.info(f"Device: {port.device}")
-                    logging.info(f"Description: {port.description}")
-                    logging.info(f"Hardware ID: {port.hwid}")
-                    logging.info("-" * 20)
-                    if port.device == self._print_serial_port:
-                        exit_flag = False
-                time.sleep(5)
+        for topic, ok, lane in self._early_status:
+            self._messenger.publish_status(topic, ok, lane=lane)
+        self._early_status = None
+
+        if not fast_start:
+            # POS ports after MQTT, then the printers
+            for lane in self._lanes:
+                lane.open_pos()
+            self._startup.mark("pos_open")
+        for lane in self._lanes:
+            self._latency_sources[lane.topic("pos")] = lane.latency
+            # A single lane waits for its ports like before, with several a
+            # missing port must not hold up the other lanes
+            lane.start(wait=len(self._lanes) == 1)
+        self._startup.mark("printer")
+
+        # Threads and loops are restarted in place when they fail, the rest
+        # of the service stays up. POS readers are added by run()/run_async()
+        supervisor_config = self._pos_config['SETTINGS'].get('SUPERVISOR') or {}
+        self._reader_timeout = float(supervisor_config.get('reader_timeout', DEFAULT_READER_TIMEOUT))
+        self._loop_timeout = float(supervisor_config.get('loop_timeout', DEFAULT_LOOP_TIMEOUT))
+        self._supervisor = Supervisor.from_config(supervisor_config)
+        self._supervisor.add("mqtt", alive=self._messenger.alive, restart=self._messenger.restart)
+        self._supervisor.add("pos-config", alive=self._config.alive, restart=self._config.restart)
+        for lane in self._lanes:
+            if lane.print_enabled:
+                self._supervisor.add(lane.topic("printer"), alive=lambda lane=lane: lane.print_writer.is_alive(),
+                                     restart=lane.restart_printer,
+                                     on_state=lambda ok, lane=lane: self._on_lane_status(lane, STATUS_PRINTER,
+                                                                                         ok and lane.print_ser is not None))
+
+        queue_config = self._print_config['SETTINGS'].get('QUEUE') or {}
+        self._print_metrics_interval = float(queue_config.get('metrics_interval', 30))
+        metrics_config = self._pos_config['SETTINGS'].get('METRICS') or {}
+        self._latency_interval = float(metrics_config.get('latency_interval', 60))
+        now = time.monotonic()
+        self._next_latency_metrics = now + self._latency_interval
+        self._next_printer_metrics = now + self._print_metrics_interval
+
+    @property
+    def config(self):
+        return self._config
+
+    @property
+    def messenger(self):
+        return self._messenger
+
+    @property
+    def supervisor(self):
+        return self._supervisor
+
+    @property
+    def startup(self):
+        return self._startup
+
+    def _watch_pos_config(self, pos_file):
+        # (config, matcher) of a pos config file, watched from the first call
+        if pos_file not in self._pos_sources:
+            self._pos_sources[pos_file] = []
+            self._pos_compiled[pos_file] = self._config.watch(
+                pos_file, lambda config, matcher: self._on_pos_config_change(pos_file, config, matcher),
+                build=LineMatcher.from_config, validate=validate_pos_config, depends=POS_CONFIG_CODE)
+        return self._pos_compiled[pos_file]
+
+    def _on_pos_config_change(self, pos_file, config, matcher):
+        # Watcher thread: everything is built here, _tick() swaps it in on
+        # the POS loop. One lane failing to build rejects the whole change
+        updates = []
+        for lane, overrides in self._pos_sources.get(pos_file, []):
+            updates.append(lane.reconfigure(merge(config, overrides), matcher))
+        if pos_file == self._pos_config_file:
+            metrics_config = merge(config, self._pos_overrides)['SETTINGS'].get('METRICS') or {}
+            latency_interval = float(metrics_config.get('latency_interval', 60))
+            updates.append(lambda: setattr(self, '_latency_interval', latency_interval))
+        self._updates.extend(updates)
+
+    def _load_lanes(self, lanes_config_file):
+        # One Lane per LANES entry. A lane takes the default pos/printer
+        # config, or its own pos_config/printer_config file, with its ports
+        # and checkout_id on top. Lanes on the same pos config share the
+        # compiled matcher, it is read only once built
+        lanes_config = self._config.load(lanes_config_file)[0]
+        logging.debug("Loading lanes from file={}, service={}".format(lanes_config_file, lanes_config.get('service')))
+        print_configs = {}
+        lanes = []
+        for entry in lanes_config.get('LANES') or []:
+            name = str(entry['name'])
+            if any(lane.name == name for lane in lanes):
+                raise ValueError("Lane {} is defined twice".format(name))
+            pos_file = entry.get('pos_config', self._pos_config_file)
+            print_file = entry.get('printer_config', self._print_config_file)
+            raw_pos_config, matcher = self._watch_pos_config(pos_file)
+            if print_file not in print_configs:
+                print_configs[print_file] = self._config.load(print_file)[0]
+
+            pos_overrides = merge(self._pos_overrides, {})
+            if entry.get('pos_port'):
+                pos_overrides = merge(pos_overrides, {'SETTINGS': {'auto_scan': False, 'SERIAL': {'static_port': entry['pos_port']}}})
+            pos_config = merge(raw_pos_config, pos_overrides)
+            print_config = merge(print_configs[print_file], self._print_overrides)
+            if entry.get('printer_port'):
+                print_config['SETTINGS']['auto_scan'] = False
+                print_config['SETTINGS']['SERIAL']['static_port'] = entry['printer_port']
+            if 'printer_enabled' in entry:
+                print_config['enabled'] = bool(entry['printer_enabled'])
+            queue_config = print_config['SETTINGS'].get('QUEUE') or {}
+            if queue_config.get('spill_file'):
+                # Every lane spills into its own file
+                root, ext = os.path.splitext(queue_config['spill_file'])
+                queue_config['spill_file'] = "{}_{}{}".format(root, name, ext)
+
+            lane = Lane(name, pos_config, print_config, self._devices,
+                        on_bill=self._publish_bill, on_status=self._on_lane_status,
+                        checkout_id=int(entry['checkout_id']), matcher=matcher)
+            self._pos_sources[pos_file].append((lane, pos_overrides))
+            lanes.append(lane)
+        if not lanes:
+            raise ValueError("No LANES in {}".format(lanes_config_file))
+        logging.info("Loaded {} lanes: {}".format(len(lanes), ", ".join(lane.name for lane in lanes)))
+        return lanes
+
+    def _on_lane_status(self, lane, kind, ok):
+        topic = BROKER_POS_INIT_STATUS_TOPIC if kind == STATUS_POS else BROKER_PRINTER_INIT_STATUS_TOPIC
+        self.publish_status(lane.topic(topic), ok, lane=lane.name)
+
+    def _on_switch_status(self, message):
+        logging.debug("Switch state: {}".format(message.status()))
+
+    def _on_metrics_dump(self, message):
+        self._publish_latency_metrics(reset=False)
+
+    def _publish_diagnostics(self, report):
+        self._messenger.publish(BROKER_DIAGNOSTICS_TOPIC.format(MQTT_CLIENT_ID), json.dumps(report))
+
+    def _diagnostic_counters(self):
+        # Byte counters for the resources report
+        counters = {"mqtt": dict(self._messenger.stats)}
+        for lane in self._lanes:
+            serial_counters = {"pos_bytes_read": lane.reader.bytes_read if lane.reader is not None else 0}
+            if lane.print_enabled:
+                serial_counters["printer_bytes_written"] = lane.print_writer.stats()["written_bytes"]
+            counters[lane.topic("serial")] = serial_counters
+        return counters
+
+    def add_latency_source(self, name, recorder):
+        self._latency_sources[name] = recorder
+
+    def _publish_latency_metrics(self, reset):
+        for name, recorder in list(self._latency_sources.items()):
+            snapshot = recorder.snapshot(reset=reset)
+            logging.info("Latency {} (us): {}".format(name, snapshot))
+            self._messenger.publish_metric(BROKER_LATENCY_METRICS_TOPIC.format(name), snapshot)
+
+    def _publish_printer_metrics(self):
+        for lane in self._lanes:
+            if not lane.print_enabled:
+                continue
+            stats = lane.print_writer.stats()
+            logging.debug("Printer queue{}: {}".format("" if lane.name is None else " " + lane.name, stats))
+            self._messenger.publish_metric(lane.topic(BROKER_PRINTER_METRICS_TOPIC), stats)
+
+    def _tick(self):
+        # Once a second or so from the loop: config changes, lane
+        # housekeeping and metrics
+        while True:
             try:
-                self._print_ser = serial.Serial(
-                    port=self._print_serial_port,
-                    baudrate=int(self._print_baud_rate),
-                    bytesize=int(self._print_serial_setting[0]),
-                    parity=self._print_serial_setting[1],
-                    stopbits=int(self._print_serial_setting[2])
-                )
-                logging.info("Connected to Printer serial port: {}".format(self._print_serial_port))
-                self._client.publish(BROKER_PRINTER_INIT_STATUS_TOPIC, "True")
-            except Exception as e:
-                logging.error("Error connecting to Printer serial port:", e)
-                self._client.publish(BROKER_PRINTER_INIT_STATUS_TOPIC, "False")
-                self._print_enabled = False
-        if self._print_enabled == False:
-            logging.error("Printer setup failed")
-            self._client.publish(BROKER_PRINTER_INIT_STATUS_TOPIC, "False")
+                update = self._updates.popleft()
+            except IndexError:
+                break
+            update()
+        for lane in self._lanes:
+            lane.tick()
+        if not self._startup_reported:
+            self._publish_startup()
+        now = time.monotonic()
+        if now >= self._next_printer_metrics:
+            self._next_printer_metrics = now + self._print_metrics_interval
+            self._publish_printer_metrics()
+        if now >= self._next_latency_metrics:
+            self._next_latency_metrics = now + self._latency_interval
+            self._publish_latency_metrics(reset=True)
+
+    def _publish_bill(self, lane, bill_ok, trace):
+        payload = bill_payload(bill_ok, trace)
+        if self._bill_sink is not None:
+            self._bill_sink(bill_ok, trace, checkout_id=lane.checkout_id)
+            self._messenger.publish_bill(lane.topic(BROKER_POS_BILL_MIRROR_TOPIC), payload, lane=lane.name, debug=True)
         else:
-            logging.info("Printer setup success")
-            self._client.publish(BROKER_PRINTER_INIT_STATUS_TOPIC, "True")
-    
-    def _on_connect(self, client, userdata, flags, rc):
-        logging.debug("Connected to message broker")
-        self._client.subscribe(BROKER_SWITCH_INIT_STATUS_TOPIC)
-        
-    def _on_message(self, client, userdata, msg):
-        logging.debug("Received message: {} {}".format(msg.topic, msg.payload.decode()))
-        
+            self._messenger.publish_bill(BROKER_POS_BILL_STATUS_TOPIC, payload, lane=lane.name)
+
+    def publish_status(self, topic, ok, lane=None):
+        if self._messenger is None:
+            self._early_status.append((topic, ok, lane))
+            return
+        self._messenger.publish_status(topic, ok, lane=lane)
+
+    def _publish_startup(self):
+        # The startup milestones once the broker is up, again when the first
+        # POS byte has been read
+        if self._messenger.first_connect_ns is not None:
+            self._startup.mark("mqtt", self._messenger.first_connect_ns)
+        first_rx = [lane.reader.first_rx_ns for lane in self._lanes
+                    if lane.reader is not None and lane.reader.first_rx_ns is not None]
+        if first_rx:
+            self._startup.mark("first_byte", min(first_rx))
+        if not self._messenger.connected or self._startup_published == len(self._startup.marks):
+            return
+        report = self._startup.report(self._startup_budget_ms)
+        if self._startup_published is None:
+            logging.info("Startup (ms): {}".format(report))
+            if report["over_budget"]:
+                logging.warning("Startup took longer than the {} ms budget".format(self._startup_budget_ms))
+        self._startup_published = len(self._startup.marks)
+        self._startup_reported = "first_byte" in report
+        self._messenger.publish(BROKER_STARTUP_METRICS_TOPIC.format(MQTT_CLIENT_ID), json.dumps(report))
+
     def cleanup(self):
-        self._pos_ser.close()
-        self._print_serial_port.close()
-        self._client.disconnect()
-        
+        self._supervisor.stop()
+        self._diagnostics.stop()
+        self._config.stop()
+        for lane in self._lanes:
+            lane.stop()
+        self._messenger.stop()
+
     def run(self):
+        if len(self._lanes) != 1:
+            raise RuntimeError("run() drives a single lane, use run_async() for several")
+        lane = self._lanes[0]
         logging.info("starting pos-printer state machine")
+        # The read loop runs on a supervised thread. A loop that keeps failing
+        # or stops beating is replaced by a new one on a reopened port
+        self._stopped = threading.Event()
+        self._generation = 0
+        self._reader = self._supervisor.add(lane.topic("pos"), alive=lambda: self._reader_thread.is_alive(),
+                                            restart=lambda: self._restart_reader(lane), timeout=self._reader_timeout,
+                                            on_state=lambda ok: self._on_lane_status(lane, STATUS_POS, ok))
+        self._start_reader(lane, reconnect=False)
+        self._startup.mark("ready")
+        self._supervisor.start()
+        self._stopped.wait()
+
+        self._supervisor.stop()
+        if lane.print_enabled:
+            lane.print_writer.stop(timeout=1)
+        self._messenger.stop()
+        logging.info("Ending pos-printer state machine")
+
+    def stop(self):
+        self._stopped.set()
+
+    def _start_reader(self, lane, reconnect):
+        self._reader_thread = threading.Thread(target=self._read_loop, args=(lane, self._generation, reconnect),
+                                               name="pos-reader", daemon=True)
+        self._reader_thread.start()
+
+    def _restart_reader(self, lane):
+        # Supervisor thread. Closing the port ends a read the old loop is
+        # stuck in, the old loop sees it is outdated and returns. A read waits
+        # at most idle_gap, so it is joined before the port is reopened. One
+        # that is still busy keeps its FrameReader, the new loop gets a new one
+        self._generation += 1
+        old = self._reader_thread
+        if lane.pos_ser is not None:
+            try:
+                lane.pos_ser.close()
+            except Exception:
+                pass
+        if old is not None and old is not threading.current_thread():
+            old.join(timeout=(lane.reader.idle_gap if lane.reader is not None else 0) + READER_JOIN_MARGIN)
+            if old.is_alive():
+                logging.warning("Old POS read loop still running, starting the new one on a new reader")
+                lane.reader = None
+        self._start_reader(lane, reconnect=True)
+
+    def _read_loop(self, lane, generation, reconnect):
+        if reconnect:
+            self._reader.pause()
+            lane.reconnect_pos()
+        # This loop's reader, lane.reader may be a new one once it is replaced
+        reader = lane.reader
         err = 0
-        while True:
+        next_tick = 0.0
+        while generation == self._generation:
+            self._reader.beat()
+            now = time.monotonic()
+            if now >= next_tick:
+                next_tick = now + TICK_INTERVAL
+                self._tick()
             try:
-                line = self._pos_ser.readline().decode('utf-8')
+                frame = reader.read_frame()
+                if frame is None:
+                    continue
+                lane.handle_frame(frame)
                 err = 0
-                logging.debug("Line received: {}".format(line))
-                if any(string in line for string in self._pos_generic_strings):
-                    # Only for debugging
-                    logging.debug("Generic string found: {}".format(line))
-                elif any(string in line for string in self._pos_success_strings):
-                    logging.debug("Success string found:{}".format(line))
-                    # Let the Switch know
-                    self._client.publish(BROKER_POS_BILL_STATUS_TOPIC, "True")
-                elif any(string in line for string in self._pos_failure_strings):
-                    logging.debug("Failure string found:{}".format(line))
-                    # Let the switch know
-                    self._client.publish(BROKER_POS_BILL_STATUS_TOPIC, "False")
-
-                # send to printer for print
-                if self._print_enabled:
-                    try:
-                        # Open serial port and write to it
-                        self._print_ser.write(line.encode())
-                        logging.debug("Printing to printer: {}".format(line))
-                    except Exception as e:
-                        logging.error("Error printing from printer")
-                        raise e
+            except serial.SerialException as e:
+                if generation != self._generation:
+                    break
+                # Unplugged, not a reason to give up
+                logging.error("Error reading from serial port: {}".format(e))
+                self._reader.pause()
+                lane.reconnect_pos()
+                reader = lane.reader
+                continue
             except Exception as e:
-                logging.error("Error reading from serial port:", e)
+                if generation != self._generation:
+                    break
+                logging.error("Error reading from serial port: {}".format(e))
                 logging.warning("Continuing to read from serial port")
                 err += 1
-            
-            if err > 5:
-                logging.error("Too many errors, exiting")
+
+            if err > MAX_READ_ERRORS:
+                logging.error("Too many errors, restarting the POS reader")
                 break
 
-        self._client.loop_stop()
-        self._client.disconnect()        
-        logging.info("Ending pos-printer state machine")
+    async def run_async(self):
+        # Event loop version of run(), every POS port is read when the loop
+        # says it is readable instead of a thread blocking on each of them
+        logging.info("starting pos-printer event loop, {} lane(s)".format(len(self._lanes)))
+        # asyncio is only imported by the unified runtime, it is a good part
+        # of the import time and the split runtime does not need it
+        import asyncio
+        loop = self._loop = asyncio.get_running_loop()
+        self._done = loop.create_future()
+        self._err = {}
+        self._idle_timers = {}
+        # A stuck loop cannot be restarted from inside, the watchdog exits the
+        # process for a container restart. A lane that keeps failing gets its
+        # port reopened while the other lanes carry on
+        self._loop_watchdog = self._supervisor.add("pos-loop", timeout=self._loop_timeout)
+        for lane in self._lanes:
+            self._err[lane] = 0
+            self._supervisor.add(lane.topic("pos"), alive=lambda lane=lane: self._err[lane] <= MAX_READ_ERRORS,
+                                 restart=lambda lane=lane: loop.call_soon_threadsafe(self._restart_lane, lane),
+                                 on_state=lambda ok, lane=lane: self._on_lane_status(lane, STATUS_POS, ok))
+            if lane.reader is None:
+                # Came up without its POS port
+                loop.create_task(self._reconnect_pos_async(lane))
+            else:
+                loop.add_reader(lane.reader.fileno(), self._on_pos_readable, lane)
+        self._startup.mark("ready")
+        self._schedule_tick()
+        self._supervisor.start()
+        try:
+            await self._done
+        finally:
+            self._supervisor.stop()
+            for lane in self._lanes:
+                if lane.reader is not None:
+                    loop.remove_reader(lane.reader.fileno())
+                timer = self._idle_timers.pop(lane, None)
+                if timer is not None:
+                    timer.cancel()
+                if lane.print_enabled:
+                    lane.print_writer.stop(timeout=1)
+            self._messenger.stop()
+            logging.info("Ending pos-printer event loop")
+
+    def _schedule_tick(self):
+        if self._done.done():
+            return
+        self._loop_watchdog.beat()
+        self._tick()
+        self._loop.call_later(TICK_INTERVAL, self._schedule_tick)
+
+    def _on_pos_readable(self, lane):
+        try:
+            lane.reader.read_available()
+            frame = lane.reader.next_frame()
+            while frame is not None:
+                lane.handle_frame(frame)
+                self._err[lane] = 0
+                frame = lane.reader.next_frame()
+        except serial.SerialException as e:
+            logging.error("Error reading from serial port of {}: {}".format(lane, e))
+            self._loop.remove_reader(lane.reader.fileno())
+            self._loop.create_task(self._reconnect_pos_async(lane))
+            return
+        except Exception as e:
+            logging.error("Error reading from serial port of {}: {}".format(lane, e))
+            self._err[lane] += 1
+            if self._err[lane] > MAX_READ_ERRORS:
+                # The supervisor restarts this lane
+                logging.error("Too many errors on {}, stopping its reader".format(lane))
+                self._loop.remove_reader(lane.reader.fileno())
+                return
+
+        # A partial frame is flushed once the port stays quiet for idle_gap
+        timer = self._idle_timers.pop(lane, None)
+        if timer is not None:
+            timer.cancel()
+        if lane.reader.pending():
+            self._idle_timers[lane] = self._loop.call_later(lane.reader.idle_gap, self._on_pos_idle, lane)
+
+    async def _reconnect_pos_async(self, lane):
+        # Blocks until the port is back, on a thread of its own so a lane that
+        # stays away does not hold up the others or the exit of the process
+        loop = self._loop
+        reconnected = loop.create_future()
+
+        def reconnect():
+            try:
+                lane.reconnect_pos()
+                loop.call_soon_threadsafe(reconnected.set_result, None)
+            except Exception as e:
+                loop.call_soon_threadsafe(reconnected.set_exception, e)
+
+        threading.Thread(target=reconnect, name="pos-reconnect", daemon=True).start()
+        await reconnected
+        if not self._done.done():
+            loop.add_reader(lane.reader.fileno(), self._on_pos_readable, lane)
+
+    def _restart_lane(self, lane):
+        # On the loop, for a lane the supervisor saw failing. Its reader is
+        # already off the loop, the port is reopened like after an unplug
+        timer = self._idle_timers.pop(lane, None)
+        if timer is not None:
+            timer.cancel()
+        self._err[lane] = 0
+        self._loop.create_task(self._reconnect_pos_async(lane))
+
+    def _on_pos_idle(self, lane):
+        self._idle_timers.pop(lane, None)
+        frame = lane.reader.flush()
+        if frame is None:
+            return
+        try:
+            lane.handle_frame(frame)
+        except Exception as e:
+            logging.error("Error handling frame: {}".format(e))
 
 def print_banner():
     print(BANNER)
 
+def unquoted(value):
+    # docker-compose environment entries like POS_PORT="/dev/ttyUSB0" keep their quotes
+    return value.strip('"\'')
+
+def serial_overrides(port, baud):
+    serial_config = {}
+    if port:
+        serial_config['static_port'] = port
+    if baud:
+        serial_config['baud'] = int(baud)
+    if not serial_config:
+        return {}
+    overrides = {'SETTINGS': {'SERIAL': serial_config}}
+    if port:
+        # An explicit port wins over auto_scan
+        overrides['SETTINGS']['auto_scan'] = False
+    return overrides
+
 if __name__ == '__main__':
     # print_banner()
     parser = argparse.ArgumentParser(
@@ -250,35 +603,85 @@ if __name__ == '__main__':
                     description='Interface to the POS')
 
     parser.add_argument('--log-level', default="INFO", choices=set(["CRITICAL", "ERROR", "WARNING", "INFO", "DEBUG"]))
-    parser.add_argument('--pos-port', default="/dev/ttyUSB0", help="POS serial port")
-    parser.add_argument('--pos-baud', default=38400, help="POS serial baud rate")
-    parser.add_argument('--print-port', default="/dev/ttyUSB1", help="Printer serial port")
-    parser.add_argument('--print-baud', default=38400, help="Printer serial baud rate")
+    parser.add_argument('--pos-port', default=None, type=unquoted, help="POS serial port, overrides pos_config.yaml")
+    parser.add_argument('--pos-baud', default=None, type=unquoted, help="POS serial baud rate, overrides pos_config.yaml")
+    parser.add_argument('--print-port', default=None, type=unquoted, help="Printer serial port, overrides printer_config.yaml")
+    parser.add_argument('--print-baud', default=None, type=unquoted, help="Printer serial baud rate, overrides printer_config.yaml")
+    parser.add_argument('--runtime', default="split", choices=["split", "unified"],
+                        help="split publishes bills for the storetracker service, unified also drives the switch in this process")
+    parser.add_argument('--switch-ip', default="192.168.0.2", type=unquoted, help="Storetracker switch IP (unified runtime)")
+    parser.add_argument('--switch-port', default=25803, type=unquoted, help="Storetracker switch port (unified runtime)")
+    parser.add_argument('--outbox-path', default=UNIFIED_OUTBOX_PATH, help="ACC outbox database (unified runtime)")
+    parser.add_argument('--lanes-config', default=None, type=unquoted,
+                        help="Drive every lane in this file from one process, implies the unified runtime")
+    parser.add_argument('--config-cache', default=DEFAULT_CONFIG_CACHE_DIR, help="Directory for the compiled config cache, empty for none")
     
     args = parser.parse_args()
     logging.basicConfig(level=args.log_level, format='%(asctime)s %(message)s')
     
-    # Open POS config and update static_port to POS_PORT
-    with open(POS_CONFIG_FILE, 'r') as f:
-        pos_config = yaml.safe_load(f)
-        pos_config['SETTINGS']['SERIAL']['static_port'] = args.pos_port
-        pos_config['SETTINGS']['SERIAL']['baud'] = args.pos_baud
-    
-    with open(PRINTER_CONFIG_FILE, 'r') as f:
-        print_config = yaml.safe_load(f)
-        print_config['SETTINGS']['SERIAL']['static_port'] = args.print_port
-        print_config['SETTINGS']['SERIAL']['baud'] = args.print_baud
-    
+    # Ports and bauds given on the command line are laid over the configs,
+    # on the first load and on every reload
+    pos_overrides = serial_overrides(args.pos_port, args.pos_baud)
+    print_overrides = serial_overrides(args.print_port, args.print_baud)
+
+    if args.lanes_config and args.runtime != "unified":
+        # A storetracker service only knows one checkout_id
+        logging.info("Lanes config given, using the unified runtime")
+        args.runtime = "unified"
+
+    switch = None
+    bill_sink = None
+    if args.runtime == "unified":
+        # The image ships the storetracker client next to app.py, a checkout
+        # has it in the sibling service directory
+        if os.path.isdir(STORETRACKER_DIR):
+            sys.path.append(STORETRACKER_DIR)
+        # The switch client is set up once the POS side is, bills only flow
+        # when the loop runs
+        bill_sink = lambda bill_ok, trace, checkout_id=None: switch.submit(bill_ok, trace, checkout_id=checkout_id)
+
     logging.info("Starting POS interface")
     try:
-        posif = POSInterface(pos_config=POS_CONFIG_FILE, print_config=PRINTER_CONFIG_FILE)
+        posif = POSInterface(pos_config=POS_CONFIG_FILE, print_config=PRINTER_CONFIG_FILE, bill_sink=bill_sink,
+                             lanes_config=args.lanes_config, pos_overrides=pos_overrides,
+                             print_overrides=print_overrides, config_cache=args.config_cache)
+        if bill_sink is not None:
+            from switch_client import SwitchClient, validate_switch_config
+            switch_config_file = SWITCH_CONFIG_FILE
+            if not os.path.exists(switch_config_file):
+                switch_config_file = os.path.join(STORETRACKER_DIR, "config", "switch_config.yaml")
+            # Watched like the pos config, checkout and tuning changes apply live
+            switch_configs = ConfigService(cache_dir=args.config_cache)
+            switch_config = switch_configs.watch(switch_config_file, lambda config, _: switch.reconfigure(config),
+                                                 validate=validate_switch_config)[0]
+            logging.info("Starting unified runtime, storetracker on {}:{}".format(args.switch_ip, args.switch_port))
+            switch = SwitchClient(switch_config, args.switch_ip, int(args.switch_port), outbox_path=args.outbox_path)
+            # Both halves publish latency from this process
+            posif.add_latency_source("switch", switch.latency)
+
+            def on_switch_state(ok):
+                if ok:
+                    posif.startup.mark("switch")
+                posif.publish_status(BROKER_SWITCH_INIT_STATUS_TOPIC, ok)
+            switch.start(on_state=on_switch_state)
+            posif.supervisor.add("switch", alive=switch.alive, restart=switch.restart,
+                                 on_state=lambda ok: posif.publish_status(BROKER_SWITCH_INIT_STATUS_TOPIC,
+                                                                          ok and switch.connected))
+            posif.supervisor.add("switch-config", alive=switch_configs.alive, restart=switch_configs.restart)
     except Exception as e:
         logging.error("Error initializing the POS interface, error = {}".format(e))
         time.sleep(5)
         sys.exit(1)
         
     try:
-        posif.run()
+        if switch is not None:
+            import asyncio
+            asyncio.run(posif.run_async())
+        else:
+            posif.run()
     except Exception as e:
         posif.cleanup()
         logging.error("Error running the POS interface, error = {}".format(e))
+    finally:
+        if switch is not None:
+            switch.stop()
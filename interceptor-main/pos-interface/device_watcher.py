@@ -0,0 +1,187 @@
+import glob
+import json
+import logging
+import os
+import select
+import threading
+import time
+from inotify import Inotify
+
+DEFAULT_CACHE_FILE = "/data/device_cache.json"
+DEFAULT_POLL_INTERVAL = 1.0
+DEFAULT_OPEN_RETRY = 0.05
+
+
+def usb_fingerprint(device):
+    # "vid:pid" or "vid:pid:serial" of the USB device behind a tty or usblp
+    # node, read from sysfs. None for anything that is not USB
+    name = os.path.basename(os.path.realpath(device))
+    for device_class in ("tty", "usbmisc"):
+        node = os.path.join("/sys/class", device_class, name, "device")
+        if not os.path.exists(node):
+            continue
+        node = os.path.realpath(node)
+        while node != "/":
+            if os.path.exists(os.path.join(node, "idVendor")):
+                parts = []
+                for attribute in ("idVendor", "idProduct", "serial"):
+                    try:
+                        with open(os.path.join(node, attribute), 'r') as f:
+                            parts.append(f.read().strip())
+                    except OSError:
+                        pass
+                return ":".join(parts)
+            node = os.path.dirname(node)
+    return None
+
+
+class DeviceSpec:
+    # Which device a role (pos, printer) attaches to: the static port, or
+    # with auto_scan any node matching usb_pattern, optionally only those
+    # whose fingerprint starts with usb_id ("vid:pid")
+    def __init__(self, role, static_port=None, auto_scan=False, usb_pattern=None, usb_id=None):
+        if auto_scan and not usb_pattern:
+            raise ValueError("{}: auto_scan needs a usb_pattern".format(role))
+        if not auto_scan and not static_port:
+            raise ValueError("{}: no static_port and auto_scan is off".format(role))
+        self.role = role
+        self.static_port = static_port
+        self.auto_scan = bool(auto_scan)
+        self.usb_pattern = usb_pattern
+        self.usb_id = usb_id.lower() if usb_id else None
+
+    @classmethod
+    def from_settings(cls, role, settings, static_port=None):
+        # settings is the SETTINGS section of pos_config.yaml/printer_config.yaml
+        return cls(role,
+                   static_port=static_port or settings['SERIAL']['static_port'],
+                   auto_scan=settings.get('auto_scan', False),
+                   usb_pattern=settings.get('usb_pattern'),
+                   usb_id=settings.get('usb_id'))
+
+    def __repr__(self):
+        if self.auto_scan:
+            return "{} {}{}".format(self.role, self.usb_pattern, " " + self.usb_id if self.usb_id else "")
+        return "{} {}".format(self.role, self.static_port)
+
+    @property
+    def directory(self):
+        return os.path.dirname(self.usb_pattern if self.auto_scan else self.static_port)
+
+    def candidates(self):
+        if not self.auto_scan:
+            return [self.static_port] if os.path.exists(self.static_port) else []
+        found = sorted(glob.glob(self.usb_pattern))
+        if self.usb_id is not None:
+            found = [device for device in found if (usb_fingerprint(device) or "").lower().startswith(self.usb_id)]
+        return found
+
+
+class DeviceWatcher:
+    # Finds and opens the device for each role and waits for it to appear.
+    # Waiting sleeps on inotify on the device's directory, so a plugged in
+    # device is picked up as soon as its node shows up. The fingerprint of
+    # the device each role last used is kept in cache_file, when several
+    # nodes match a pattern the one seen before wins, and a node already in
+    # use by another role is never handed out
+    def __init__(self, cache_file=DEFAULT_CACHE_FILE, poll_interval=DEFAULT_POLL_INTERVAL):
+        self._cache_file = cache_file
+        self._poll_interval = float(poll_interval)
+        self._lock = threading.Lock()
+        self._claimed = {}
+        self._cache = {}
+        try:
+            with open(self._cache_file, 'r') as f:
+                self._cache = json.load(f)
+        except (OSError, ValueError):
+            pass
+
+    def find(self, spec):
+        with self._lock:
+            taken = set(device for role, device in self._claimed.items() if role != spec.role)
+            cached = self._cache.get(spec.role)
+        candidates = [device for device in spec.candidates() if device not in taken]
+        if len(candidates) > 1 and cached:
+            for device in candidates:
+                if usb_fingerprint(device) == cached:
+                    return device
+        return candidates[0] if candidates else None
+
+    def claim(self, spec, device):
+        fingerprint = usb_fingerprint(device)
+        with self._lock:
+            self._claimed[spec.role] = device
+            if fingerprint is None or self._cache.get(spec.role) == fingerprint:
+                return
+            self._cache[spec.role] = fingerprint
+            cache = dict(self._cache)
+        logging.info("{} is {} ({})".format(spec.role, device, fingerprint))
+        try:
+            tmp = self._cache_file + ".tmp"
+            with open(tmp, 'w') as f:
+                json.dump(cache, f)
+            os.replace(tmp, self._cache_file)
+        except OSError as e:
+            logging.warning("Could not save device cache {}: {}".format(self._cache_file, e))
+
+    def release(self, role):
+        with self._lock:
+            self._claimed.pop(role, None)
+
+    def wait(self, spec, timeout=None):
+        # Device for spec, waiting up to timeout seconds (None forever) for
+        # one to appear. None on timeout
+        device = self.find(spec)
+        if device is not None or timeout == 0:
+            return device
+        deadline = None if timeout is None else time.monotonic() + timeout
+        logging.info("Waiting for {}".format(spec))
+        inotify = None
+        try:
+            inotify = Inotify()
+            inotify.add_watch(spec.directory)
+        except OSError as e:
+            # No inotify or no directory yet, fall back to a slow poll
+            logging.warning("Not watching {} ({}), polling every {}s".format(spec.directory, e, self._poll_interval))
+            if inotify is not None:
+                inotify.close()
+            inotify = None
+        try:
+            while True:
+                # Checked after the watch is set up so nothing slips between
+                device = self.find(spec)
+                if device is not None:
+                    return device
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return None
+                if inotify is None:
+                    time.sleep(self._poll_interval if remaining is None else min(remaining, self._poll_interval))
+                    continue
+                if select.select([inotify], [], [], remaining)[0]:
+                    inotify.read()
+        finally:
+            if inotify is not None:
+                inotify.close()
+
+    def open(self, spec, opener, timeout=None):
+        # Waits for the device and returns opener(device), retrying while a
+        # new node is not ready to be opened yet. None on timeout
+        deadline = None if timeout is None else time.monotonic() + timeout
+        retry = DEFAULT_OPEN_RETRY
+        while True:
+            remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+            device = self.wait(spec, remaining)
+            if device is None:
+                return None
+            try:
+                port = opener(device)
+            except Exception as e:
+                logging.warning("Could not open {} {}: {}".format(spec.role, device, e))
+                if deadline is not None and time.monotonic() >= deadline:
+                    return None
+                time.sleep(retry)
+                retry = min(retry * 2, self._poll_interval)
+                continue
+            self.claim(spec, device)
+            return port
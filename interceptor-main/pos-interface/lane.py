@@ -0,0 +1,301 @@
+import logging
+import re
+import sys
+import serial
+from latency import LatencyRecorder, new_correlation_id, now_ns
+from matcher import LineMatcher, CATEGORY_GENERIC, CATEGORY_SUCCESS, CATEGORY_FAILURE, CONFIG_SECTIONS
+from serial_reader import FrameReader, has_cut, compile_terminators, DEFAULT_TERMINATORS
+from device_watcher import DeviceSpec
+from printer_writer import PrinterWriter
+from transaction import TransactionTracker
+
+STATUS_POS = "pos"
+STATUS_PRINTER = "printer"
+
+# Code the compiled form of a pos config depends on, see ConfigService
+POS_CONFIG_CODE = (sys.modules[LineMatcher.__module__], sys.modules[TransactionTracker.__module__], sys.modules[__name__])
+
+
+def validate_pos_config(pos_config):
+    # Raises ValueError for a pos config a lane cannot run with. The strings
+    # themselves are checked when the matcher is built
+    try:
+        settings = pos_config['SETTINGS']
+        serial_config = settings['SERIAL']
+        int(serial_config['baud'])
+        bytesize, parity, stopbits = serial_config['serial_setting']
+        if int(bytesize) not in serial.Serial.BYTESIZES or parity not in serial.Serial.PARITIES \
+                or float(stopbits) not in serial.Serial.STOPBITS:
+            raise ValueError("bad serial_setting {}".format(serial_config['serial_setting']))
+        DeviceSpec.from_settings("pos", settings)
+        framing = settings.get('FRAMING') or {}
+        compile_terminators(framing.get('terminators', DEFAULT_TERMINATORS))
+        for key in ('idle_gap', 'chunk_size', 'max_frame'):
+            if key in framing and float(framing[key]) <= 0:
+                raise ValueError("FRAMING.{} must be positive".format(key))
+        for _, section in CONFIG_SECTIONS:
+            if not isinstance(pos_config.get(section) or [], list):
+                raise ValueError("{} must be a list".format(section))
+        # Compiles the boundary strings and id_regex
+        TransactionTracker.from_config(pos_config, None)
+    except (KeyError, TypeError, ValueError, re.error) as e:
+        raise ValueError("invalid pos config: {}: {}".format(type(e).__name__, e))
+
+
+class Lane:
+    # One checkout: a POS port, its printer and the checkout_id bills go out
+    # with. Owns framing, classification and the printer queue, the owner
+    # (POSInterface) owns MQTT and the loop that reads the port.
+    #   on_bill(lane, bill_ok, trace) for every success or failure line
+    #   on_status(lane, STATUS_POS/STATUS_PRINTER, ok) when a port comes or goes
+    # name is None for the single lane of a classic install, otherwise it
+    # prefixes device roles and suffixes MQTT topics
+    def __init__(self, name, pos_config, print_config, devices, on_bill, on_status, checkout_id=None, matcher=None):
+        self.name = name
+        self.checkout_id = checkout_id
+        self._pos_config = pos_config
+        self._print_config = print_config
+        self._devices = devices
+        self._on_bill = on_bill
+        self._on_status = on_status
+
+        pos_settings = pos_config['SETTINGS']
+        self._pos_baud_rate = pos_settings['SERIAL']['baud']
+        self._pos_serial_setting = pos_settings['SERIAL']['serial_setting']
+        # Build the line matcher once, all strings are checked in a single pass
+        self.matcher = matcher if matcher is not None else LineMatcher.from_config(pos_config)
+        # Lines are grouped into transactions, one bill each, when enabled
+        self.transactions = TransactionTracker.from_config(pos_config, self._publish_bill)
+        # Per stage latency of every line, published on metrics/latency/<name>
+        self.latency = LatencyRecorder(("pos.frame", "pos.classify", "pos.publish"))
+        self.pos_device = DeviceSpec.from_settings(self._role("pos"), pos_settings)
+
+        self.print_enabled = bool(print_config['enabled'])
+        if self.print_enabled:
+            self._print_baud_rate = print_config['SETTINGS']['SERIAL']['baud']
+            self._print_serial_setting = print_config['SETTINGS']['SERIAL']['serial_setting']
+            self.print_device = DeviceSpec.from_settings(self._role("printer"), print_config['SETTINGS'])
+        self.passthrough = self.print_enabled and bool(print_config.get('passthrough', False))
+
+        self.pos_ser = None
+        self.print_ser = None
+        self.print_writer = None
+        self.reader = None
+
+    def _role(self, role):
+        return role if self.name is None else "{}/{}".format(self.name, role)
+
+    def topic(self, base):
+        return base if self.name is None else "{}/{}".format(base, self.name)
+
+    def __repr__(self):
+        return "lane {}".format(self.name) if self.name is not None else "lane"
+
+    def _open_pos_port(self, device):
+        return serial.Serial(
+            port=device,
+            baudrate=int(self._pos_baud_rate),
+            bytesize=int(self._pos_serial_setting[0]),
+            parity=self._pos_serial_setting[1],
+            stopbits=int(self._pos_serial_setting[2])
+            )
+
+    def _open_print_port(self, device):
+        return serial.Serial(
+            port=device,
+            baudrate=int(self._print_baud_rate),
+            bytesize=int(self._print_serial_setting[0]),
+            parity=self._print_serial_setting[1],
+            stopbits=int(self._print_serial_setting[2])
+            )
+
+    def open_pos(self):
+        # Opens the POS port when it is there, a missing one is neither waited
+        # for nor reported. From here on the tty buffers what the POS sends
+        # until the reader is attached in start(), so a fast start calls this
+        # before MQTT and the printer. Returns True when the port is open
+        if self.pos_ser is None:
+            logging.debug("Attempting to connect to {} {} {}".format(self.pos_device, self._pos_baud_rate, self._pos_serial_setting))
+            self.pos_ser = self._devices.open(self.pos_device, self._open_pos_port, timeout=0)
+            if self.pos_ser is not None:
+                logging.info("Connected to POS serial port: {}".format(self.pos_ser.port))
+                self._on_status(self, STATUS_POS, True)
+        return self.pos_ser is not None
+
+    def start(self, wait=True):
+        # Opens the ports and starts the printer writer. With wait a missing
+        # port is waited for here, without it the lane comes up without it:
+        # the printer writer attaches on its own, the POS port is left to
+        # reconnect_pos(). Returns True when the POS port is open
+        logging.debug("Setting up POS serial interface for {}".format(self))
+        if not self.open_pos():
+            logging.error("POS serial port not found for {}, waiting for it".format(self))
+            self._on_status(self, STATUS_POS, False)
+            if wait:
+                self.pos_ser = self._devices.open(self.pos_device, self._open_pos_port)
+                logging.info("Connected to POS serial port: {}".format(self.pos_ser.port))
+                self._on_status(self, STATUS_POS, True)
+
+        if self.print_enabled:
+            self.print_ser = self._devices.open(self.print_device, self._open_print_port, timeout=0)
+            if self.print_ser is None:
+                logging.error("Printer serial port not found for {}, waiting for it".format(self))
+                self._on_status(self, STATUS_PRINTER, False)
+                if wait:
+                    self.print_ser = self._devices.open(self.print_device, self._open_print_port)
+            if self.print_ser is not None:
+                logging.info("Connected to Print serial port: {}".format(self.print_ser.port))
+            # Printer writes run on their own thread behind a bounded queue
+            queue_config = self._print_config['SETTINGS'].get('QUEUE') or {}
+            self.print_writer = PrinterWriter.from_config(self.print_ser, queue_config, reopen=self._reopen_print_port)
+            self.print_writer.start()
+            logging.info("Printer setup success")
+            if self.print_ser is not None:
+                self._on_status(self, STATUS_PRINTER, True)
+        else:
+            logging.info("Printer interface not enabled, moving on!")
+            self._on_status(self, STATUS_PRINTER, False)
+
+        if self.pos_ser is not None:
+            self._attach_pos(self.pos_ser)
+        logging.info("Printer passthrough: {}".format(self.passthrough))
+        return self.pos_ser is not None
+
+    def reconfigure(self, pos_config, matcher):
+        # Builds what a new pos config needs off the POS loop and returns a
+        # function that swaps it in, to be called on the POS loop between
+        # frames. Ports stay open: serial settings are applied to the open
+        # port, a new port or usb pattern is used from the next reconnect
+        pos_settings = pos_config['SETTINGS']
+        tracker = TransactionTracker.from_config(pos_config, self._publish_bill)
+        device = DeviceSpec.from_settings(self._role("pos"), pos_settings)
+        baud_rate = pos_settings['SERIAL']['baud']
+        serial_setting = pos_settings['SERIAL']['serial_setting']
+        framing = pos_settings.get('FRAMING')
+
+        def apply():
+            self._pos_config = pos_config
+            self.matcher = matcher
+            if tracker is not None and self.transactions is not None:
+                tracker.adopt(self.transactions)
+            elif self.transactions is not None:
+                self.transactions.close()
+            self.transactions = tracker
+            if self.reader is not None:
+                self.reader.reconfigure(framing)
+            if (baud_rate, serial_setting) != (self._pos_baud_rate, self._pos_serial_setting):
+                self._pos_baud_rate, self._pos_serial_setting = baud_rate, serial_setting
+                if self.pos_ser is not None:
+                    try:
+                        self.pos_ser.baudrate = int(baud_rate)
+                        self.pos_ser.bytesize = int(serial_setting[0])
+                        self.pos_ser.parity = serial_setting[1]
+                        self.pos_ser.stopbits = int(serial_setting[2])
+                    except (serial.SerialException, ValueError) as e:
+                        logging.error("Could not change serial settings of {}: {}".format(self, e))
+            if repr(device) != repr(self.pos_device):
+                logging.warning("POS port of {} is now {}, used from the next reconnect".format(self, device))
+                self.pos_device = device
+            logging.info("New pos config applied to {}, {} rules".format(self, len(matcher.rules)))
+        return apply
+
+    def _attach_pos(self, ser):
+        if self.reader is not None:
+            self.reader.reattach(ser)
+            return
+        # Chunked reader on the POS port, frames on terminators or idle gaps.
+        # In passthrough mode the printer gets the raw chunks as they are read
+        # and frames are only used for classification
+        self.reader = FrameReader.from_config(ser, self._pos_config['SETTINGS'].get('FRAMING'),
+                                              on_chunk=self.print_writer.put if self.passthrough else None)
+
+    def restart_printer(self):
+        # A new writer thread for one that died, queued and spilled frames
+        # carry over
+        queue_config = self._print_config['SETTINGS'].get('QUEUE') or {}
+        writer = PrinterWriter.from_config(self.print_ser, queue_config, reopen=self._reopen_print_port)
+        writer.adopt(self.print_writer)
+        writer.start()
+        self.print_writer = writer
+        if self.reader is not None and self.passthrough:
+            self.reader.set_on_chunk(writer.put)
+
+    def _reopen_print_port(self, timeout):
+        # Called by the printer writer after a failed write
+        self._devices.release(self.print_device.role)
+        self._on_status(self, STATUS_PRINTER, False)
+        ser = self._devices.open(self.print_device, self._open_print_port, timeout=timeout)
+        if ser is not None:
+            logging.info("Reconnected to Print serial port: {}".format(ser.port))
+            self.print_ser = ser
+            self._on_status(self, STATUS_PRINTER, True)
+        return ser
+
+    def reconnect_pos(self):
+        # Blocks until the POS port is back, the reader carries on with it
+        logging.error("POS serial port lost for {}, waiting for it to come back".format(self))
+        self._on_status(self, STATUS_POS, False)
+        if self.pos_ser is not None:
+            try:
+                self.pos_ser.close()
+            except Exception:
+                pass
+        self._devices.release(self.pos_device.role)
+        self.pos_ser = self._devices.open(self.pos_device, self._open_pos_port)
+        self._attach_pos(self.pos_ser)
+        logging.info("Reconnected to POS serial port: {}".format(self.pos_ser.port))
+        self._on_status(self, STATUS_POS, True)
+
+    def handle_frame(self, frame):
+        framed_ns = now_ns()
+        if self.passthrough:
+            # Bytes are already with the printer, no decode needed
+            line = frame
+            category, pattern = self.matcher.match_bytes(frame) or (None, None)
+        else:
+            line = frame.decode('utf-8')
+            category, pattern = self.matcher.match(line) or (None, None)
+        classified_ns = now_ns()
+        trace = None
+        self.latency.record("pos.frame", self.reader.frame_rx_ns, framed_ns)
+        self.latency.record("pos.classify", framed_ns, classified_ns)
+        logging.debug("Line received: {}".format(line))
+        if category == CATEGORY_GENERIC:
+            # Only for debugging
+            logging.debug("Generic string found: {}".format(line))
+        elif category == CATEGORY_SUCCESS or category == CATEGORY_FAILURE:
+            trace = {"id": new_correlation_id(), "rx_ns": self.reader.frame_rx_ns, "classified_ns": classified_ns}
+            logging.debug("{} string found ({}) id={}:{}".format(
+                "Success" if category == CATEGORY_SUCCESS else "Failure", pattern, trace["id"], line))
+            if self.transactions is None:
+                # Let the Switch know
+                self._publish_bill(category == CATEGORY_SUCCESS, trace)
+        if self.transactions is not None:
+            self.transactions.feed(line, category, trace, cut=has_cut(frame))
+
+        # send to printer for print, the writer thread does the write
+        if self.print_enabled and not self.passthrough:
+            self.print_writer.put(line.encode())
+            logging.debug("Queued for printer: {}".format(line))
+
+    def _publish_bill(self, bill_ok, trace):
+        published_ns = now_ns()
+        self._on_bill(self, bill_ok, trace)
+        self.latency.record("pos.publish", published_ns, now_ns())
+
+    def tick(self):
+        # Housekeeping from the owner's loop, about once a second
+        if self.transactions is not None:
+            self.transactions.tick()
+
+    def stop(self):
+        if self.transactions is not None:
+            self.transactions.close()
+        if self.print_writer is not None:
+            self.print_writer.stop(timeout=1)
+        for ser in (self.pos_ser, self.print_ser):
+            if ser is not None:
+                try:
+                    ser.close()
+                except Exception:
+                    pass
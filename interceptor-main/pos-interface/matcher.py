@@ -0,0 +1,196 @@
+import logging
+import re
+
+# Categories in priority order, a line matching more than one category is
+# reported as the first one here (same order as the old if/elif chain)
+CATEGORY_GENERIC = "generic"
+CATEGORY_SUCCESS = "success"
+CATEGORY_FAILURE = "failure"
+
+CONFIG_SECTIONS = [
+    (CATEGORY_GENERIC, "GENERIC_STRINGS"),
+    (CATEGORY_SUCCESS, "SUCCESS_STRINGS"),
+    (CATEGORY_FAILURE, "FAILURE_STRINGS"),
+]
+
+_NEVER = "(?!)"
+
+# ESC/POS control sequences, dropped from the byte view used for matching.
+# Commands without an argument, with two or three, then the common one
+# argument form, then any C0 control left except tab, CR and LF
+_ESCPOS_CONTROL = re.compile(
+    rb"\x1b[@2<im]|\x1c[.&]"
+    rb"|\x1dV[AB][\x00-\xff]|\x1bp[\x00-\xff]{3}|\x1b[$\\][\x00-\xff]{2}|\x1d[LW][\x00-\xff]{2}"
+    rb"|[\x1b\x1d\x1c][\x00-\xff][\x00-\xff]?"
+    rb"|[\x00-\x08\x0b\x0c\x0e-\x1f\x7f]"
+)
+
+
+def strip_controls(data):
+    # Cheap text view of a raw POS frame. Bitmap data is not parsed, a logo
+    # can leave printable junk behind but it will not carry a receipt phrase
+    return _ESCPOS_CONTROL.sub(b"", data)
+
+
+def _trie_regex(words):
+    # Factor common prefixes so the regex engine walks one branch per
+    # character instead of trying every pattern at every position
+    trie = {}
+    for word in words:
+        node = trie
+        for ch in word:
+            node = node.setdefault(ch, {})
+        node[""] = None
+    return _node_regex(trie)
+
+
+def _node_regex(node):
+    branches = [re.escape(ch) + _node_regex(child) for ch, child in sorted(node.items()) if ch != ""]
+    if not branches:
+        return ""
+    if len(branches) == 1 and "" not in node:
+        return branches[0]
+    body = "(?:" + "|".join(branches) + ")"
+    if "" in node:
+        body += "?"
+    return body
+
+
+class Rule:
+    def __init__(self, category, pattern, regex=False, ignore_case=False):
+        self.category = category
+        self.pattern = pattern
+        self.regex = regex
+        self.ignore_case = ignore_case
+
+    @classmethod
+    def from_entry(cls, category, entry, ignore_case=False):
+        # Entries are plain strings, or mappings for regex/case options
+        #   - valid payment
+        #   - {pattern: 'PAID \d+', regex: true, ignore_case: true}
+        if isinstance(entry, dict):
+            return cls(category, str(entry["pattern"]),
+                       regex=bool(entry.get("regex", False)),
+                       ignore_case=bool(entry.get("ignore_case", ignore_case)))
+        return cls(category, str(entry), ignore_case=ignore_case)
+
+    def __repr__(self):
+        return "Rule({!r}, {!r}, regex={}, ignore_case={})".format(self.category, self.pattern, self.regex, self.ignore_case)
+
+
+class _Program:
+    # One compiled alternation over a set of rules, over str or UTF-8 bytes.
+    # Case folding on bytes only covers ASCII
+    def __init__(self, rules, binary=False):
+        self._binary = binary
+        self._literals = {}
+        self._folded = {}
+        self._regex_rules = {}
+        case_words = []
+        fold_words = []
+        regex_parts = []
+        for rule in rules:
+            if rule.regex:
+                name = "r{}".format(len(self._regex_rules))
+                self._regex_rules[name] = rule
+                flags = "(?i:" if rule.ignore_case else "(?:"
+                regex_parts.append("(?P<{}>{}{}))".format(name, flags, rule.pattern))
+            elif rule.ignore_case:
+                key = rule.pattern.lower()
+                if key not in self._folded:
+                    self._folded[key] = rule
+                    fold_words.append(key)
+            elif rule.pattern not in self._literals:
+                self._literals[rule.pattern] = rule
+                case_words.append(rule.pattern)
+
+        parts = []
+        if case_words:
+            parts.append("(?P<lit>{})".format(_trie_regex(case_words)))
+        if fold_words:
+            parts.append("(?P<fold>(?i:{}))".format(_trie_regex(fold_words)))
+        parts.extend(regex_parts)
+        self.source = "|".join(parts) if parts else _NEVER
+        self._search = re.compile(self.source.encode('utf-8') if binary else self.source).search
+
+    def search(self, line):
+        m = self._search(line)
+        if m is None:
+            return None
+        group = m.lastgroup
+        if group == "lit":
+            text = m.group()
+            return self._literals[text.decode('utf-8') if self._binary else text]
+        if group == "fold":
+            text = m.group().lower()
+            return self._folded[text.decode('utf-8') if self._binary else text]
+        if group in self._regex_rules:
+            return self._regex_rules[group]
+        # A regex rule with inner named groups, find the outer one that hit
+        for name, rule in self._regex_rules.items():
+            if m.group(name) is not None:
+                return rule
+        return None
+
+
+class LineMatcher:
+    # Classifies a POS line against all configured strings in one pass.
+    # match() returns (category, pattern) or None
+    def __init__(self, rules):
+        self._rules = list(rules)
+        self._priority = {category: i for i, (category, _) in enumerate(CONFIG_SECTIONS)}
+        for rule in self._rules:
+            self._priority.setdefault(rule.category, len(self._priority))
+
+        self._program, self._higher = self._compile(binary=False)
+        self._program_bytes, self._higher_bytes = self._compile(binary=True)
+        logging.debug("Compiled matcher with {} rules".format(len(self._rules)))
+
+    def _compile(self, binary):
+        program = _Program(self._rules, binary)
+        # Per category programs, only used to resolve a line that hit a lower
+        # priority category first, which is rare
+        higher = {}
+        for category, prio in self._priority.items():
+            above = [rule for rule in self._rules if self._priority[rule.category] < prio]
+            if above:
+                higher[category] = [
+                    _Program([rule for rule in above if rule.category == c], binary)
+                    for c in sorted(set(rule.category for rule in above), key=self._priority.get)
+                ]
+        return program, higher
+
+    @classmethod
+    def from_config(cls, pos_config):
+        options = pos_config.get('MATCHING') or {}
+        ignore_case = bool(options.get('ignore_case', False))
+        rules = []
+        for category, section in CONFIG_SECTIONS:
+            for entry in pos_config.get(section) or []:
+                if entry is None or entry == "" or (isinstance(entry, dict) and not entry.get("pattern")):
+                    logging.warning("Skipping empty pattern in {}".format(section))
+                    continue
+                rules.append(Rule.from_entry(category, entry, ignore_case))
+        return cls(rules)
+
+    @property
+    def rules(self):
+        return list(self._rules)
+
+    def match(self, line):
+        return self._match(self._program, self._higher, line)
+
+    def match_bytes(self, data):
+        # Same as match() on a raw frame, ESC/POS controls are ignored
+        return self._match(self._program_bytes, self._higher_bytes, strip_controls(data))
+
+    def _match(self, program, higher, line):
+        rule = program.search(line)
+        if rule is None:
+            return None
+        for other in higher.get(rule.category, ()):
+            better = other.search(line)
+            if better is not None:
+                rule = better
+                break
+        return rule.category, rule.pattern
@@ -0,0 +1,268 @@
+import collections
+import logging
+import os
+import select
+import threading
+import time
+import serial
+
+POLICY_BLOCK = "block"
+POLICY_DROP_OLDEST = "drop_oldest"
+POLICY_SPILL = "spill"
+POLICIES = (POLICY_BLOCK, POLICY_DROP_OLDEST, POLICY_SPILL)
+
+DEFAULT_MAX_FRAMES = 256
+DEFAULT_MAX_WRITE = 4096
+DEFAULT_WRITE_TIMEOUT = 2.0
+DEFAULT_RETRY_DELAY = 0.5
+DEFAULT_SPILL_FILE = "/data/printer_spill.bin"
+DEFAULT_SPILL_MAX_BYTES = 4 * 1024 * 1024
+
+
+class PartialWrite(Exception):
+    # A printer write that failed or timed out after written bytes went out
+    def __init__(self, written, error):
+        super().__init__(str(error))
+        self.written = written
+        self.error = error
+
+
+class PrinterWriter(threading.Thread):
+    # Owns the printer port so the POS loop never waits on it.
+    # put() queues a frame and returns, the writer thread merges whatever is
+    # queued into a single write. When the queue is full the policy decides:
+    #   block       - put() waits up to block_timeout, then drops the frame
+    #   drop_oldest - the oldest queued frame is dropped
+    #   spill       - frames go to spill_file until the printer catches up
+    # reopen(timeout), when set, is called after a write fails for anything
+    # but a timeout and returns a new port, or None if the printer is not back.
+    # After a failed write only the bytes that did not reach the port are
+    # written again, a frame is never printed twice
+    def __init__(self, ser, max_frames=DEFAULT_MAX_FRAMES, policy=POLICY_SPILL, max_write=DEFAULT_MAX_WRITE,
+                 block_timeout=None, write_timeout=DEFAULT_WRITE_TIMEOUT, retry_delay=DEFAULT_RETRY_DELAY,
+                 spill_file=DEFAULT_SPILL_FILE, spill_max_bytes=DEFAULT_SPILL_MAX_BYTES, reopen=None):
+        super().__init__(name="printer-writer", daemon=True)
+        if policy not in POLICIES:
+            raise ValueError("Unknown printer queue policy {}, use one of {}".format(policy, POLICIES))
+        self._ser = ser
+        self._max_frames = int(max_frames)
+        self._policy = policy
+        self._max_write = int(max_write)
+        self._block_timeout = block_timeout
+        self._retry_delay = float(retry_delay)
+        self._spill_file = spill_file
+        self._spill_max_bytes = int(spill_max_bytes)
+        self._reopen = reopen
+        self._write_timeout = write_timeout
+
+        self._queue = collections.deque()
+        self._cond = threading.Condition()
+        self._running = True
+        # Spill file is read back from _spill_offset, new frames are appended
+        # while it holds data so the printer still sees them in order
+        self._spill = None
+        self._spill_offset = 0
+        self._spill_size = 0
+
+        self._stats = {
+            "depth": 0,
+            "max_depth": 0,
+            "queued_frames": 0,
+            "written_frames": 0,
+            "written_bytes": 0,
+            "writes": 0,
+            "dropped_frames": 0,
+            "spilled_bytes": 0,
+            "write_errors": 0,
+        }
+
+    @classmethod
+    def from_config(cls, ser, queue_config, reopen=None):
+        queue_config = queue_config or {}
+        return cls(ser, reopen=reopen,
+                   max_frames=queue_config.get('max_frames', DEFAULT_MAX_FRAMES),
+                   policy=queue_config.get('policy', POLICY_SPILL),
+                   max_write=queue_config.get('max_write', DEFAULT_MAX_WRITE),
+                   block_timeout=queue_config.get('block_timeout'),
+                   write_timeout=queue_config.get('write_timeout', DEFAULT_WRITE_TIMEOUT),
+                   retry_delay=queue_config.get('retry_delay', DEFAULT_RETRY_DELAY),
+                   spill_file=queue_config.get('spill_file', DEFAULT_SPILL_FILE),
+                   spill_max_bytes=queue_config.get('spill_max_bytes', DEFAULT_SPILL_MAX_BYTES))
+
+    def adopt(self, other):
+        # Takes over the queue, spill file and counters of a writer whose
+        # thread died, what was queued there is written by this one
+        with other._cond:
+            self._queue = other._queue
+            self._cond = other._cond
+            self._spill, self._spill_offset, self._spill_size = other._spill, other._spill_offset, other._spill_size
+            self._stats = other._stats
+            other._spill = None
+
+    def put(self, frame):
+        with self._cond:
+            self._stats["queued_frames"] += 1
+            if self._spill_size > self._spill_offset:
+                self._spill_write(frame)
+            elif len(self._queue) < self._max_frames:
+                self._queue.append(frame)
+            elif self._policy == POLICY_DROP_OLDEST:
+                self._queue.popleft()
+                self._queue.append(frame)
+                self._stats["dropped_frames"] += 1
+            elif self._policy == POLICY_SPILL:
+                self._spill_write(frame)
+            elif self._cond.wait_for(lambda: len(self._queue) < self._max_frames or not self._running,
+                                     timeout=self._block_timeout) and self._running:
+                self._queue.append(frame)
+            else:
+                self._stats["dropped_frames"] += 1
+                logging.warning("Printer queue full, dropping frame")
+            self._update_depth()
+            self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self._stats)
+        stats["spill_pending_bytes"] = self._spill_size - self._spill_offset
+        return stats
+
+    def stop(self, timeout=None):
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        if self.is_alive():
+            self.join(timeout)
+        if self._spill is not None:
+            self._spill.close()
+            self._spill = None
+
+    def _update_depth(self):
+        depth = len(self._queue)
+        self._stats["depth"] = depth
+        if depth > self._stats["max_depth"]:
+            self._stats["max_depth"] = depth
+
+    def _spill_write(self, frame):
+        if self._spill_size - self._spill_offset + len(frame) > self._spill_max_bytes:
+            self._stats["dropped_frames"] += 1
+            logging.warning("Printer spill file full, dropping frame")
+            return
+        try:
+            if self._spill is None:
+                self._spill = open(self._spill_file, "w+b")
+                self._spill_offset = 0
+                self._spill_size = 0
+                logging.warning("Printer queue full, spilling to {}".format(self._spill_file))
+            self._spill.seek(self._spill_size)
+            self._spill.write(frame)
+            self._spill_size += len(frame)
+            self._stats["spilled_bytes"] += len(frame)
+        except OSError as e:
+            self._stats["dropped_frames"] += 1
+            logging.error("Error spilling printer frame: {}".format(e))
+
+    def _spill_read(self):
+        self._spill.flush()
+        self._spill.seek(self._spill_offset)
+        return self._spill.read(min(self._max_write, self._spill_size - self._spill_offset))
+
+    def _spill_done(self, size):
+        self._spill_offset += size
+        if self._spill_offset >= self._spill_size:
+            # Drained, start the file over next time
+            self._spill.truncate(0)
+            self._spill_offset = 0
+            self._spill_size = 0
+
+    def _take_batch(self):
+        # Called with the lock held, merges queued frames up to max_write
+        frames = [self._queue.popleft()]
+        size = len(frames[0])
+        while self._queue and size + len(self._queue[0]) <= self._max_write:
+            frame = self._queue.popleft()
+            frames.append(frame)
+            size += len(frame)
+        self._update_depth()
+        self._cond.notify_all()
+        return frames
+
+    def _reconnect(self):
+        # The port is most likely gone, wait up to retry_delay for it to be back
+        try:
+            self._ser.close()
+        except Exception:
+            pass
+        ser = self._reopen(self._retry_delay)
+        if ser is None:
+            return
+        self._ser = ser
+        logging.info("Printer port reopened")
+
+    def _write(self, data):
+        # Writes data to the port, waiting at most write_timeout for a stalled
+        # printer. Serial.write loses the count of what went out when it
+        # raises, this does the same non-blocking writes on the port's fd and
+        # raises PartialWrite with it
+        written = 0
+        try:
+            if self._ser is None:
+                raise serial.SerialException("Printer port not open")
+            fd = self._ser.fileno()
+            deadline = None if self._write_timeout is None else time.monotonic() + float(self._write_timeout)
+            with memoryview(data) as view:
+                while written < len(data):
+                    try:
+                        written += os.write(fd, view[written:])
+                        continue
+                    except BlockingIOError:
+                        pass
+                    remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+                    if not select.select([], [fd], [], remaining)[1]:
+                        raise serial.SerialTimeoutException("Write timeout")
+        except Exception as e:
+            raise PartialWrite(written, e)
+        return written
+
+    def run(self):
+        logging.info("Starting printer writer, policy={}".format(self._policy))
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._queue or self._spill_size > self._spill_offset or not self._running)
+                if not self._running:
+                    break
+                if self._queue:
+                    frames = self._take_batch()
+                    data = b"".join(frames)
+                else:
+                    frames = None
+                    data = self._spill_read()
+
+            try:
+                self._write(data)
+            except PartialWrite as e:
+                logging.error("Error writing to printer after {} of {} bytes: {}".format(e.written, len(data), e.error))
+                with self._cond:
+                    self._stats["write_errors"] += 1
+                    self._stats["written_bytes"] += e.written
+                    # Only what did not go out is put back in front, the
+                    # policy deals with anything that arrives meanwhile
+                    if frames is None:
+                        self._spill_done(e.written)
+                    elif e.written < len(data):
+                        self._queue.appendleft(data[e.written:])
+                    self._update_depth()
+                if self._reopen is not None and not isinstance(e.error, serial.SerialTimeoutException):
+                    self._reconnect()
+                else:
+                    time.sleep(self._retry_delay)
+                continue
+
+            with self._cond:
+                if frames is None:
+                    self._spill_done(len(data))
+                self._stats["writes"] += 1
+                self._stats["written_bytes"] += len(data)
+                self._stats["written_frames"] += len(frames) if frames is not None else 0
+            logging.debug("Printed {} bytes".format(len(data)))
+        logging.info("Printer writer stopped")
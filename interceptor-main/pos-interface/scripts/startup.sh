@@ -43,6 +43,10 @@ register_arg "--pos-port" "$POS_PORT"
 register_arg "--pos-baud" "$POS_BAUD"
 register_arg "--print-port" "$PRINT_PORT"
 register_arg "--print-baud" "$PRINT_BUAD"
+register_arg "--runtime" "$RUNTIME"
+register_arg "--switch-ip" "$SWITCH_IP"
+register_arg "--switch-port" "$SWITCH_PORT"
+register_arg "--lanes-config" "$LANES_CONFIG"
 
 
 echo "Launching with following commands"
@@ -0,0 +1,187 @@
+import logging
+import re
+import time
+
+# ESC/POS paper cut commands, each one ends a receipt
+#   GS V m (m = 0, 1, 48, 49), GS V m n (m = 65, 66), ESC i, ESC m
+ESCPOS_CUT = "escpos_cut"
+_ESCPOS_CUT_REGEX = rb"\x1dV[\x00\x01\x30\x31]|\x1dV[\x41\x42][\x00-\xff]|\x1b[im]"
+_ESCPOS_CUT_SEARCH = re.compile(_ESCPOS_CUT_REGEX).search
+
+DEFAULT_TERMINATORS = ["\n", ESCPOS_CUT]
+DEFAULT_IDLE_GAP = 0.2
+DEFAULT_CHUNK_SIZE = 4096
+DEFAULT_MAX_FRAME = 4096
+
+
+def has_cut(frame):
+    # True when a raw frame carries a paper cut, i.e. a receipt ended
+    return _ESCPOS_CUT_SEARCH(frame) is not None
+
+
+def compile_terminators(terminators):
+    # Returns the compiled terminator regex and the longest terminator length
+    parts = []
+    longest = 0
+    for terminator in terminators:
+        if terminator == ESCPOS_CUT:
+            parts.append(_ESCPOS_CUT_REGEX)
+            longest = max(longest, 4)
+        else:
+            if isinstance(terminator, str):
+                terminator = terminator.encode('latin-1')
+            if not terminator:
+                raise ValueError("Empty frame terminator")
+            parts.append(re.escape(terminator))
+            longest = max(longest, len(terminator))
+    if not parts:
+        raise ValueError("At least one frame terminator is required")
+    return re.compile(b"|".join(parts)), longest
+
+
+class FrameReader:
+    # Reads the POS port in chunks and splits it into frames.
+    # Each read pulls everything the driver has buffered (in_waiting) into one
+    # reusable buffer, instead of readline() asking for a byte at a time. A
+    # frame ends at any of the terminators, which stay part of the frame, or
+    # when nothing arrives for idle_gap seconds after a partial frame.
+    # on_chunk, when set, gets every chunk exactly as read before framing
+    def __init__(self, ser, terminators=DEFAULT_TERMINATORS, idle_gap=DEFAULT_IDLE_GAP,
+                 chunk_size=DEFAULT_CHUNK_SIZE, max_frame=DEFAULT_MAX_FRAME, on_chunk=None):
+        self._ser = ser
+        self._on_chunk = on_chunk
+        self._terminator, longest = compile_terminators(terminators)
+        self._overlap = longest - 1
+        self._idle_gap = float(idle_gap)
+        self._chunk_size = int(chunk_size)
+        self._max_frame = int(max_frame)
+        self._buf = bytearray()
+        self._scanned = 0
+        self.last_rx = None
+        self._last_rx_ns = None
+        # monotonic_ns of the first byte of the buffered frame, and of the
+        # frame returned last, for latency tracing
+        self._first_rx_ns = None
+        self.frame_rx_ns = None
+        # monotonic_ns of the first byte ever read, for the startup report
+        self.first_rx_ns = None
+        self.reads = 0
+        self.bytes_read = 0
+
+        # A bounded read is what lets an unterminated last line get flushed
+        self._ser.timeout = self._idle_gap
+
+    @classmethod
+    def from_config(cls, ser, framing_config, on_chunk=None):
+        framing_config = framing_config or {}
+        return cls(ser, on_chunk=on_chunk,
+                   terminators=framing_config.get('terminators', DEFAULT_TERMINATORS),
+                   idle_gap=framing_config.get('idle_gap', DEFAULT_IDLE_GAP),
+                   chunk_size=framing_config.get('chunk_size', DEFAULT_CHUNK_SIZE),
+                   max_frame=framing_config.get('max_frame', DEFAULT_MAX_FRAME))
+
+    def _pop(self, end):
+        with memoryview(self._buf) as view:
+            frame = bytes(view[:end])
+        del self._buf[:end]
+        self._scanned = 0
+        self.frame_rx_ns = self._first_rx_ns
+        # What is left came in with the last chunk
+        self._first_rx_ns = self._last_rx_ns if self._buf else None
+        return frame
+
+    def _next_frame(self):
+        m = self._terminator.search(self._buf, self._scanned)
+        if m is not None:
+            return self._pop(m.end())
+        if len(self._buf) >= self._max_frame:
+            logging.warning("No terminator in {} bytes, flushing frame".format(len(self._buf)))
+            return self._pop(len(self._buf))
+        # Only a terminator split across reads can start in the scanned part
+        self._scanned = max(0, len(self._buf) - self._overlap)
+        return None
+
+    def pending(self):
+        return len(self._buf)
+
+    @property
+    def idle_gap(self):
+        return self._idle_gap
+
+    def fileno(self):
+        return self._ser.fileno()
+
+    def reconfigure(self, framing_config):
+        # New framing on the same port, the partial frame is kept and scanned
+        # again with the new terminators
+        framing_config = framing_config or {}
+        self._terminator, longest = compile_terminators(framing_config.get('terminators', DEFAULT_TERMINATORS))
+        self._overlap = longest - 1
+        self._idle_gap = float(framing_config.get('idle_gap', DEFAULT_IDLE_GAP))
+        self._chunk_size = int(framing_config.get('chunk_size', DEFAULT_CHUNK_SIZE))
+        self._max_frame = int(framing_config.get('max_frame', DEFAULT_MAX_FRAME))
+        self._scanned = 0
+        self._ser.timeout = self._idle_gap
+
+    def set_on_chunk(self, on_chunk):
+        self._on_chunk = on_chunk
+
+    def reattach(self, ser):
+        # Carries on with a reopened port, a partial frame from before the
+        # port went away is dropped
+        if self._buf:
+            logging.warning("Dropping {} bytes of partial frame from the old port".format(len(self._buf)))
+        self._ser = ser
+        self._ser.timeout = self._idle_gap
+        self._buf.clear()
+        self._scanned = 0
+        self._first_rx_ns = None
+
+    def feed(self, chunk):
+        # Adds bytes read from the port, for callers that do their own reads
+        self._last_rx_ns = time.monotonic_ns()
+        self.last_rx = self._last_rx_ns / 1e9
+        if not self._buf:
+            self._first_rx_ns = self._last_rx_ns
+            if self.first_rx_ns is None:
+                self.first_rx_ns = self._last_rx_ns
+        self.bytes_read += len(chunk)
+        if self._on_chunk is not None:
+            self._on_chunk(chunk)
+        self._buf += chunk
+
+    def next_frame(self):
+        # Next complete frame in the buffer, or None
+        return self._next_frame()
+
+    def flush(self):
+        # Partial frame left after an idle gap, or None
+        if not self._buf:
+            return None
+        logging.debug("Idle gap after {} bytes, flushing partial frame".format(len(self._buf)))
+        return self._pop(len(self._buf))
+
+    def read_available(self):
+        # Non-blocking read of what the driver holds, for event loops that
+        # were told the port is readable
+        chunk = self._ser.read(min(self._ser.in_waiting, self._chunk_size) or 1)
+        self.reads += 1
+        if chunk:
+            self.feed(chunk)
+        return len(chunk)
+
+    def read_frame(self):
+        # Returns the next frame as bytes, or None when the port stayed idle
+        while True:
+            frame = self._next_frame()
+            if frame is not None:
+                return frame
+
+            waiting = self._ser.in_waiting
+            # With nothing buffered read(1) blocks for at most idle_gap
+            chunk = self._ser.read(min(waiting, self._chunk_size) if waiting else 1)
+            self.reads += 1
+            if chunk:
+                self.feed(chunk)
+                continue
+            return self.flush()
@@ -0,0 +1,176 @@
+import logging
+import re
+import time
+from latency import new_correlation_id
+from matcher import LineMatcher, Rule, CATEGORY_SUCCESS, CATEGORY_FAILURE
+
+BOUNDARY_START = "start"
+BOUNDARY_END = "end"
+
+DEFAULT_IDLE_TIMEOUT = 30.0
+
+
+class Transaction:
+    def __init__(self, txn_id):
+        self.id = txn_id
+        self.started = time.monotonic()
+        self.last_line = self.started
+        self.lines = 0
+        self.outcome = None
+        self.successes = 0
+        self.emitted = False
+        self.trace = None
+
+
+class TransactionTracker:
+    # Groups classified POS lines into transactions and emits one outcome per
+    # transaction through on_outcome(bill_ok, trace), trace["txn"] being the
+    # transaction id. A success goes out on its first line, the gate should
+    # not wait for the end of the receipt, later success lines of the same
+    # transaction are dropped. A failure is held until the transaction ends,
+    # a retried payment in the same receipt turns it into a success.
+    # A transaction ends on an end string, a paper cut (end_on_cut), a start
+    # string or idle_timeout seconds without a line. Generic lines never end
+    # one, lines after the payment such as "TRANSACTION 000123" belong to the
+    # same receipt. Start strings are for a line that only heads a receipt,
+    # e.g. the store name. A POS that does not cut needs start or end strings,
+    # a warning is logged when it is relied on to cut, no cut was seen yet and
+    # a paid transaction ends idle or gets a third success line, the signs of
+    # receipts running together. id_regex takes the id from the
+    # receipt itself, the first group of the first line it matches, so a
+    # reprinted receipt has the same id as the original
+    def __init__(self, on_outcome, start_rules=None, end_rules=None, end_on_cut=True,
+                 idle_timeout=DEFAULT_IDLE_TIMEOUT, id_regex=None):
+        self._on_outcome = on_outcome
+        self._boundaries = None
+        if start_rules or end_rules:
+            self._boundaries = LineMatcher(list(start_rules or []) + list(end_rules or []))
+        self._end_on_cut = bool(end_on_cut)
+        self._idle_timeout = float(idle_timeout) if idle_timeout else None
+        self._id_regex = re.compile(id_regex) if id_regex else None
+        self._id_regex_bytes = re.compile(id_regex.encode('utf-8')) if id_regex else None
+        self._current = None
+        # Only cuts end transactions unless start/end strings are set
+        self._cuts_only = self._end_on_cut and not (start_rules or end_rules)
+        self._cut_seen = False
+        self._warned = False
+        self.stats = {"transactions": 0, "outcomes": 0, "duplicates": 0, "unresolved": 0}
+
+    @classmethod
+    def from_config(cls, pos_config, on_outcome):
+        # None when the TRANSACTIONS section is missing or disabled, lines are
+        # then reported one by one as before
+        txn_config = pos_config.get('TRANSACTIONS') or {}
+        if not txn_config.get('enabled', False):
+            return None
+        ignore_case = bool((pos_config.get('MATCHING') or {}).get('ignore_case', False))
+        start_rules = [Rule.from_entry(BOUNDARY_START, entry, ignore_case) for entry in txn_config.get('start_strings') or []]
+        end_rules = [Rule.from_entry(BOUNDARY_END, entry, ignore_case) for entry in txn_config.get('end_strings') or []]
+        if not start_rules and not end_rules and not txn_config.get('end_on_cut', True):
+            logging.warning("Transactions without start_strings, end_strings or end_on_cut only end after idle_timeout")
+        return cls(on_outcome, start_rules=start_rules, end_rules=end_rules,
+                   end_on_cut=txn_config.get('end_on_cut', True),
+                   idle_timeout=txn_config.get('idle_timeout', DEFAULT_IDLE_TIMEOUT),
+                   id_regex=txn_config.get('id_regex') or None)
+
+    def _boundary(self, line):
+        # (starts, ends) for a line. The boundary matcher is a second pass,
+        # only there when start or end strings are configured
+        if self._boundaries is None:
+            return False, False
+        hit = self._boundaries.match_bytes(line) if isinstance(line, bytes) else self._boundaries.match(line)
+        boundary = hit[0] if hit else None
+        return boundary == BOUNDARY_START, boundary == BOUNDARY_END
+
+    def _receipt_id(self, line):
+        regex = self._id_regex_bytes if isinstance(line, bytes) else self._id_regex
+        m = regex.search(line)
+        if m is None:
+            return None
+        found = m.group(1) if m.groups() else m.group()
+        found = found.decode('utf-8', errors='replace') if isinstance(found, bytes) else found
+        # Ids travel in space separated bill payloads
+        return "_".join(found.split())
+
+    def adopt(self, other):
+        # Takes over the open transaction and counters of the tracker this
+        # one replaces after a config change
+        self._current = other._current
+        self._cut_seen = other._cut_seen
+        self._warned = other._warned
+        self.stats = other.stats
+
+    def feed(self, line, category, trace=None, cut=False):
+        # One framed line, category and trace as the lane classified it
+        starts, ends = self._boundary(line)
+        if starts and self._current is not None:
+            self.close()
+        txn = self._current
+        if txn is None:
+            txn = self._current = Transaction(new_correlation_id())
+            self.stats["transactions"] += 1
+        txn.lines += 1
+        txn.last_line = time.monotonic()
+        if self._id_regex is not None and not txn.emitted:
+            receipt_id = self._receipt_id(line)
+            if receipt_id:
+                txn.id = receipt_id
+
+        if category == CATEGORY_SUCCESS:
+            txn.successes += 1
+            if txn.outcome == CATEGORY_SUCCESS:
+                self.stats["duplicates"] += 1
+                logging.debug("Transaction {}: already paid, dropping success line".format(txn.id))
+                if txn.successes > 2:
+                    self._check_cuts()
+            else:
+                txn.outcome = CATEGORY_SUCCESS
+                self._emit(txn, trace)
+        elif category == CATEGORY_FAILURE:
+            if txn.outcome is None:
+                txn.outcome = CATEGORY_FAILURE
+                txn.trace = trace
+            else:
+                self.stats["duplicates"] += 1
+
+        if cut:
+            self._cut_seen = True
+        if ends or (cut and self._end_on_cut):
+            self.close()
+
+    def _check_cuts(self):
+        # Receipts look merged, which they are on a POS that does not cut
+        if self._cuts_only and not self._cut_seen and not self._warned:
+            self._warned = True
+            logging.warning("Transactions end on paper cuts but none was seen yet, receipts without a cut are merged "
+                            "for up to {}s. Set start_strings or end_strings".format(self._idle_timeout))
+
+    def _emit(self, txn, trace):
+        trace = dict(trace or {})
+        trace["txn"] = txn.id
+        txn.emitted = True
+        self.stats["outcomes"] += 1
+        self._on_outcome(txn.outcome == CATEGORY_SUCCESS, trace)
+
+    def close(self):
+        # Ends the open transaction, a held failure goes out now
+        txn, self._current = self._current, None
+        if txn is None:
+            return
+        if txn.outcome == CATEGORY_FAILURE and not txn.emitted:
+            self._emit(txn, txn.trace)
+        elif txn.outcome is None:
+            self.stats["unresolved"] += 1
+        logging.debug("Transaction {} closed: {} after {} lines".format(txn.id, txn.outcome, txn.lines))
+
+    def tick(self, now=None):
+        # Closes a transaction that has been quiet for idle_timeout
+        txn = self._current
+        if txn is None or self._idle_timeout is None:
+            return
+        now = time.monotonic() if now is None else now
+        if now - txn.last_line >= self._idle_timeout:
+            logging.debug("Transaction {} idle for {}s".format(txn.id, self._idle_timeout))
+            if txn.outcome is not None:
+                self._check_cuts()
+            self.close()
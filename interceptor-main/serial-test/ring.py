@@ -0,0 +1,166 @@
+import mmap
+import os
+import struct
+import time
+
+# Fixed size ring of timestamped serial chunks in a memory mapped file.
+# Layout: a 4 KiB header (magic, version, port names, head and tail) then the
+# data area. head and tail are byte counts since the ring was created, the
+# record at tail is the oldest one still in the file. A record that would
+# run past the end of the data area starts again at the front instead, the
+# gap left behind holds a PAD marker when there is room for one.
+
+MAGIC = b"SRNG"
+VERSION = 1
+HEADER_SIZE = 4096
+MAX_PORTS = 16
+PORT_NAME_SIZE = 32
+PORTS_OFFSET = 64
+PAD = 0xFFFFFFFF
+
+DEFAULT_RING_FILE = "/data/serial_ring.bin"
+DEFAULT_RING_SIZE = 16 * 1024 * 1024
+
+_HEADER = struct.Struct("<4sHHQQQ")   # magic, version, port count, data size, head, tail
+_RECORD = struct.Struct("<IQQB3x")    # record length, wall clock ns, monotonic ns, port index
+_LENGTH = struct.Struct("<I")
+
+
+class SerialRing:
+    # Opened with ports it is the writer, an existing ring for other ports is
+    # started over. Without ports it is a read only view of a ring that may
+    # still be written by a capture running in another process
+    def __init__(self, path=DEFAULT_RING_FILE, size=DEFAULT_RING_SIZE, ports=None):
+        self._path = path
+        self._writable = ports is not None
+        if self._writable:
+            if len(ports) > MAX_PORTS:
+                raise ValueError("at most {} ports".format(MAX_PORTS))
+            self._open_writer(path, int(size), list(ports))
+        else:
+            self._open_reader(path)
+
+    def _open_writer(self, path, size, ports):
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size != size:
+                os.ftruncate(fd, size)
+            self._mm = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        self._data_size = size - HEADER_SIZE
+        magic, version, _, data_size, head, tail = _HEADER.unpack_from(self._mm, 0)
+        if magic == MAGIC and version == VERSION and data_size == self._data_size and self._read_ports() == ports:
+            # Same capture as before a restart, keep the history
+            self._head, self._tail = head, tail
+            self.ports = ports
+            return
+        self._head = self._tail = 0
+        self.ports = ports
+        self._mm[PORTS_OFFSET:PORTS_OFFSET + MAX_PORTS * PORT_NAME_SIZE] = bytes(MAX_PORTS * PORT_NAME_SIZE)
+        for index, name in enumerate(ports):
+            encoded = name.encode()[:PORT_NAME_SIZE]
+            offset = PORTS_OFFSET + index * PORT_NAME_SIZE
+            self._mm[offset:offset + len(encoded)] = encoded
+        self._store()
+
+    def _open_reader(self, path):
+        with open(path, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, _, data_size, _, _ = _HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("{} is not a serial ring".format(path))
+        self._data_size = data_size
+        self.ports = self._read_ports()
+
+    def _read_ports(self):
+        count = _HEADER.unpack_from(self._mm, 0)[2]
+        ports = []
+        for index in range(min(count, MAX_PORTS)):
+            offset = PORTS_OFFSET + index * PORT_NAME_SIZE
+            ports.append(bytes(self._mm[offset:offset + PORT_NAME_SIZE]).rstrip(b"\0").decode())
+        return ports
+
+    def _store(self):
+        _HEADER.pack_into(self._mm, 0, MAGIC, VERSION, len(self.ports), self._data_size, self._head, self._tail)
+
+    def _is_gap(self, pos):
+        # True where the writer skipped to the front of the data area
+        if self._data_size - pos < _RECORD.size:
+            return True
+        return _LENGTH.unpack_from(self._mm, HEADER_SIZE + pos)[0] in (PAD, 0)
+
+    def _next(self, offset):
+        # Offset of the record after the one at offset
+        pos = offset % self._data_size
+        if self._is_gap(pos):
+            return offset + self._data_size - pos
+        return offset + _LENGTH.unpack_from(self._mm, HEADER_SIZE + pos)[0]
+
+    def _reserve(self, end):
+        # Drops the oldest records until end fits
+        moved = False
+        while end - self._tail > self._data_size:
+            self._tail = self._next(self._tail)
+            moved = True
+        if moved:
+            # Readers must see the new tail before its bytes are overwritten
+            self._store()
+
+    def append(self, port, data, wall_ns=None, mono_ns=None):
+        wall_ns = time.time_ns() if wall_ns is None else wall_ns
+        mono_ns = time.monotonic_ns() if mono_ns is None else mono_ns
+        limit = self._data_size // 4 - _RECORD.size
+        for start in range(0, len(data), limit):
+            self._append(port, data[start:start + limit], wall_ns, mono_ns)
+
+    def _append(self, port, data, wall_ns, mono_ns):
+        length = _RECORD.size + len(data)
+        pos = self._head % self._data_size
+        room = self._data_size - pos
+        if room < length:
+            self._reserve(self._head + room)
+            if room >= _LENGTH.size:
+                _LENGTH.pack_into(self._mm, HEADER_SIZE + pos, PAD)
+            self._head += room
+            pos = 0
+        self._reserve(self._head + length)
+        _RECORD.pack_into(self._mm, HEADER_SIZE + pos, length, wall_ns, mono_ns, port)
+        self._mm[HEADER_SIZE + pos + _RECORD.size:HEADER_SIZE + pos + length] = data
+        self._head += length
+        self._store()
+
+    def records(self, since_wall_ns=None, port=None):
+        # [(wall_ns, mono_ns, port name, data)] oldest first, optionally only
+        # those at or after since_wall_ns and from the named port
+        _, _, _, _, head, tail = _HEADER.unpack_from(self._mm, 0)
+        found = []
+        offset = tail
+        while offset < head:
+            pos = offset % self._data_size
+            nxt = self._next(offset)
+            if self._is_gap(pos):
+                offset = nxt
+                continue
+            length, wall_ns, mono_ns, index = _RECORD.unpack_from(self._mm, HEADER_SIZE + pos)
+            if since_wall_ns is None or wall_ns >= since_wall_ns:
+                name = self.ports[index] if index < len(self.ports) else str(index)
+                if port is None or name == port:
+                    data = bytes(self._mm[HEADER_SIZE + pos + _RECORD.size:HEADER_SIZE + pos + length])
+                    found.append((offset, (wall_ns, mono_ns, name, data)))
+            offset = nxt
+        # A writer may have gone past the old tail while this was reading
+        tail = _HEADER.unpack_from(self._mm, 0)[5]
+        return [record for offset, record in found if offset >= tail]
+
+    def stats(self):
+        _, _, _, _, head, tail = _HEADER.unpack_from(self._mm, 0)
+        return {"size": self._data_size, "used": head - tail, "written": head}
+
+    def flush(self):
+        if self._writable:
+            self._mm.flush()
+
+    def close(self):
+        self.flush()
+        self._mm.close()
@@ -1,16 +1,200 @@
-import serial
+import argparse
+import datetime
 import logging
+import os
+import selectors
+import signal
+import sys
+import time
+import serial
+from ring import SerialRing, DEFAULT_RING_FILE, DEFAULT_RING_SIZE
+
+# Serial capture into a memory mapped ring file, see ring.py
+#   capture: record every byte from the given ports, sleeping in the selector
+#            until one of them has data
+#   dump:    write the last N minutes of one port as raw bytes (what the port
+#            carried, bench/replay.py takes this file) or as readable text
+#   replay:  write the last N minutes of one port to a serial device with the
+#            original timing, e.g. into the POS port of pos-interface
+#   python3 serial_monitor.py capture --port pos=/dev/ttyUSB0@38400 --port printer=/dev/ttyUSB1@38400
+#   python3 serial_monitor.py dump --minutes 10 --port pos --out /data/incident.bin
+
+DEFAULT_PORTS = ["pos=/dev/ttyUSB0@38400", "printer=/dev/ttyUSB1@38400"]
+READ_SIZE = 4096
+REOPEN_INTERVAL = 5.0
+
+
+def parse_port(spec):
+    # name=device[@baud]
+    name, sep, device = spec.partition("=")
+    if not sep or not name or not device:
+        raise argparse.ArgumentTypeError("expected name=device[@baud], got {}".format(spec))
+    device, _, baud = device.partition("@")
+    return name, device, int(baud) if baud else 38400
+
+
+class Capture:
+    def __init__(self, ports, ring):
+        self._ports = ports
+        self._ring = ring
+        self._selector = selectors.DefaultSelector()
+        self._serials = [None] * len(ports)
+        self._running = True
+        self._bytes = [0] * len(ports)
+        # stop() runs in a signal handler, the pipe wakes the selector up
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        self._selector.register(self._wakeup_r, selectors.EVENT_READ, None)
+
+    def _open(self, index):
+        name, device, baud = self._ports[index]
+        try:
+            # Non blocking, reads happen only when the selector says so
+            ser = serial.Serial(device, baud, timeout=0)
+        except (serial.SerialException, OSError) as e:
+            logging.warning("Could not open {} {}: {}".format(name, device, e))
+            return
+        self._serials[index] = ser
+        self._selector.register(ser.fileno(), selectors.EVENT_READ, index)
+        logging.info("Capturing {} from {} at {}".format(name, device, baud))
+
+    def _close(self, index):
+        ser = self._serials[index]
+        self._serials[index] = None
+        try:
+            self._selector.unregister(ser.fileno())
+        except (KeyError, ValueError):
+            pass
+        ser.close()
+
+    def stop(self, *args):
+        self._running = False
+        os.write(self._wakeup_w, b"\0")
+
+    def run(self, stats_interval):
+        for index in range(len(self._ports)):
+            self._open(index)
+        next_reopen = time.monotonic() + REOPEN_INTERVAL
+        next_stats = time.monotonic() + stats_interval
+        while self._running:
+            # Block until data arrives, only wake up early to reopen a port
+            # that went away or to log stats
+            deadline = next_stats
+            if None in self._serials:
+                deadline = min(deadline, next_reopen)
+            events = self._selector.select(max(0.0, deadline - time.monotonic()))
+            for key, _ in events:
+                index = key.data
+                if index is None:
+                    continue
+                try:
+                    data = os.read(key.fd, READ_SIZE)
+                except BlockingIOError:
+                    continue
+                except OSError as e:
+                    data = b""
+                    logging.error("Read error on {}: {}".format(self._ports[index][0], e))
+                if not data:
+                    # Unplugged, a tty at EOF stays readable forever
+                    logging.error("{} went away, reopening every {}s".format(self._ports[index][0], REOPEN_INTERVAL))
+                    self._close(index)
+                    continue
+                self._ring.append(index, data)
+                self._bytes[index] += len(data)
+            now = time.monotonic()
+            if now >= next_reopen:
+                next_reopen = now + REOPEN_INTERVAL
+                for index, ser in enumerate(self._serials):
+                    if ser is None:
+                        self._open(index)
+            if now >= next_stats:
+                next_stats = now + stats_interval
+                logging.info("Captured {} ring {}".format(
+                    {port[0]: count for port, count in zip(self._ports, self._bytes)}, self._ring.stats()))
+        for index, ser in enumerate(self._serials):
+            if ser is not None:
+                self._close(index)
+        self._ring.close()
+        logging.info("Capture stopped")
+
+
+def selected_records(args):
+    ring = SerialRing(args.ring)
+    if args.port is not None and args.port not in ring.ports:
+        raise SystemExit("No port {} in {}, ports are {}".format(args.port, args.ring, ring.ports))
+    since = None
+    if args.minutes:
+        since = time.time_ns() - int(args.minutes * 60e9)
+    return ring.records(since_wall_ns=since, port=args.port)
+
+
+def dump(args):
+    records = selected_records(args)
+    out = open(args.out, 'wb') if args.out != "-" else sys.stdout.buffer
+    try:
+        for wall_ns, mono_ns, name, data in records:
+            if args.format == "raw":
+                out.write(data)
+            else:
+                stamp = datetime.datetime.fromtimestamp(wall_ns / 1e9).isoformat(timespec='microseconds')
+                out.write("{} {:>10} {:<8} {}\n".format(stamp, mono_ns // 1000, name, repr(data)).encode())
+    finally:
+        if out is not sys.stdout.buffer:
+            out.close()
+    logging.info("Dumped {} records, {} bytes".format(len(records), sum(len(r[3]) for r in records)))
+
+
+def replay(args):
+    records = selected_records(args)
+    ser = serial.Serial(args.to, args.baud)
+    start = time.monotonic()
+    first = records[0][1] if records else 0
+    for _, mono_ns, _, data in records:
+        if args.speed:
+            delay = start + (mono_ns - first) / 1e9 / args.speed - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        ser.write(data)
+    ser.flush()
+    ser.close()
+    logging.info("Replayed {} records, {} bytes in {:.1f}s".format(
+        len(records), sum(len(r[3]) for r in records), time.monotonic() - start))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='serial_monitor.py', description='Serial capture into a ring file')
+    parser.add_argument('--log-level', default="INFO", choices=["CRITICAL", "ERROR", "WARNING", "INFO", "DEBUG"])
+    parser.add_argument('--ring', default=DEFAULT_RING_FILE, help="ring file")
+    commands = parser.add_subparsers(dest="command", required=True)
 
-# Open connections to both serial ports
-ser1 = serial.Serial('/dev/ttyUSB0', 38400, timeout=1)
-ser2 = serial.Serial('/dev/ttyUSB1', 38400, timeout=1)
+    capture_parser = commands.add_parser('capture', help="capture ports into the ring")
+    capture_parser.add_argument('--port', action='append', type=parse_port, help="name=device[@baud], repeatable")
+    capture_parser.add_argument('--size', type=int, default=DEFAULT_RING_SIZE, help="ring file size in bytes")
+    capture_parser.add_argument('--stats-interval', type=float, default=300.0)
 
-logging.info("Monitoring Serial Ports...")
+    for command in ('dump', 'replay'):
+        sub = commands.add_parser(command, help="{} the last minutes of a port".format(command))
+        sub.add_argument('--minutes', type=float, default=None, help="default everything in the ring")
+        sub.add_argument('--port', default=None, help="port name, required for raw output")
+    commands.choices['dump'].add_argument('--format', default="raw", choices=["raw", "text"])
+    commands.choices['dump'].add_argument('--out', default="-", help="output file, - for stdout")
+    commands.choices['replay'].add_argument('--to', required=True, help="serial device to write to")
+    commands.choices['replay'].add_argument('--baud', type=int, default=38400)
+    commands.choices['replay'].add_argument('--speed', type=float, default=1.0, help="0 writes as fast as possible")
 
-while True:
-    if ser1.in_waiting:
-        logging.info("POS {}".format(ser1.readline().decode().strip()))
+    args = parser.parse_args()
+    logging.basicConfig(level=args.log_level, format='%(asctime)s %(message)s', stream=sys.stderr)
 
-    # This should ideally not print anything
-    if ser2.in_waiting:
-        logging.info("Printer {}".format(ser2.readline().decode().strip()))
+    if args.command == 'capture':
+        ports = args.port or [parse_port(spec) for spec in DEFAULT_PORTS]
+        capture = Capture(ports, SerialRing(args.ring, size=args.size, ports=[port[0] for port in ports]))
+        signal.signal(signal.SIGTERM, capture.stop)
+        signal.signal(signal.SIGINT, capture.stop)
+        capture.run(args.stats_interval)
+    elif args.command == 'dump':
+        if args.format == "raw" and args.port is None:
+            parser.error("dump --format raw needs --port")
+        dump(args)
+    else:
+        if args.port is None:
+            parser.error("replay needs --port")
+        replay(args)
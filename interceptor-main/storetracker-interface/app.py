@@ -1,55 +1,66 @@
 import logging
 import time
-import serial.tools
-import serial.tools.list_ports
-import yaml
-import serial
 import argparse
 import os
-import socket
-import paho.mqtt.client as mqtt
+import threading
+import json
+import sys
+
+# Shared modules are in ../common in a checkout and next to app.py in the image
+COMMON_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common")
+if os.path.isdir(COMMON_DIR):
+    sys.path.append(COMMON_DIR)
+
+from latency import parse_bill_payload, StartupTimer
+from messaging import Messenger
+from supervisor import Supervisor
+from diagnostics import Diagnostics
+from config_service import ConfigService, DEFAULT_CACHE_DIR as DEFAULT_CONFIG_CACHE_DIR
+from switch_client import SwitchClient, validate_switch_config
 
 SWITCH_CONFIG_FILE = "./config/switch_config.yaml"
 BROKER_POS_BILL_STATUS_TOPIC = "pos/billing"
 BROKER_POS_INIT_STATUS_TOPIC = "pos/init"
 BROKER_PRINTER_INIT_STATUS_TOPIC = "printer/init"
 BROKER_SWITCH_INIT_STATUS_TOPIC = "switch/init"
+BROKER_LATENCY_METRICS_TOPIC = "metrics/latency/{}"
+BROKER_METRICS_DUMP_TOPIC = "metrics/dump"
+BROKER_CONTROL_TOPIC = "control/diagnostics"
+BROKER_DIAGNOSTICS_TOPIC = "diagnostics/{}"
+BROKER_STARTUP_METRICS_TOPIC = "metrics/startup/{}"
+MQTT_CLIENT_ID = "storetracker-interface"
+DEFAULT_STARTUP_BUDGET_MS = 1000
 
 class SwitchInterface:
-    def __init__(self, switch_config = SWITCH_CONFIG_FILE, ip = None, port = None):
+    def __init__(self, switch_config = SWITCH_CONFIG_FILE, ip = None, port = None, config_cache = DEFAULT_CONFIG_CACHE_DIR, mqtt_backend = None):
         if ip == None or port == None:
             raise Exception("IP and Port cannot be none")
         
+        # Milestones since the process started, published on
+        # metrics/startup/storetracker-interface once the broker is up
+        self._startup = StartupTimer()
+        self._startup.mark("init")
+        self._startup_published = None
+        self._startup_reported = False
         self._switch_config_file = switch_config
-        try:
-            # Create an MQTT client instance
-            self._client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION1)
-
-            # Set the callback functions
-            self._client.on_connect = self._on_connect
-            self._client.on_message = self._on_message
-
-            # Connect to the MQTT broker (localhost)
-            self._client.connect("localhost", 1883, 60)
-
-            # Start the MQTT network loop
-            self._client.loop_start()
-        except Exception as e:
-            logging.error("Error in setting up local broker")
-            raise
         ### POS setup    
         if not os.path.exists(self._switch_config_file):
             logging.error("POS config file not found")
             raise
         
+        # Watched, a changed checkout_id or tuning applies without a restart
+        self._config = ConfigService(cache_dir=config_cache)
         try:
-            with open(self._switch_config_file, 'r') as f:
-                self._switch_config = yaml.safe_load(f)
+            self._switch_config = self._config.watch(self._switch_config_file, self._on_switch_config_change,
+                                                     validate=validate_switch_config)[0]
         except Exception as e:
             logging.error("Could not load YAML")
             raise e
         
         logging.debug("Loading Switch config from file={}, service={}".format(self._switch_config_file, self._switch_config['service']))
+        self._startup.mark("config")
+        startup_config = self._switch_config['SETTINGS'].get('STARTUP') or {}
+        self._startup_budget_ms = float(startup_config.get('budget_ms', DEFAULT_STARTUP_BUDGET_MS))
         if self._switch_config['SETTINGS']['auto_scan']:
             logging.error("auto_scan is not implemented, use static IP")
             raise
@@ -58,86 +69,101 @@ class SwitchInterface:
             self._switch_ip_port = int(port)
             logging.info("Using static TCP address {}:{}".format(self._switch_ip_address, self._switch_ip_port))
         
-        self._checkout_id = self._switch_config['SETTINGS']['checkout_id']
-        self._enabled = self._check_port()
-        
-        if not self._enabled:
-            self._client.publish(BROKER_SWITCH_INIT_STATUS_TOPIC, "False")
-            logging.error("Error connecting to IP {}:{}".format(self._switch_ip_address, self._switch_ip_port))
-            raise Exception("Error in connecting to TCP port")
-        else:
-            self._client.publish(BROKER_SWITCH_INIT_STATUS_TOPIC, "True")
-        
-            logging.info("Switch init successful, using store tracker on IP {}:{}".format(self._switch_ip_address, self._switch_ip_port))
-            
-        
-    def _check_port(self):
-        port_avail = False
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # Persistent switch connection and ACC outbox, switch/init follows
+        # the connection state from here on
+        self._switch = SwitchClient(self._switch_config, self._switch_ip_address, self._switch_ip_port)
         try:
-            s.connect((self._switch_ip_address, self._switch_ip_port))
-            port_avail = True
-            logging.info("Port {} on {} is available.".format(self._switch_ip_address, self._switch_ip_port))
-        except:
-            logging.info("Port {} on {} is closed.".format(self._switch_ip_address, self._switch_ip_port))
-            port_avail = False
-        finally:
-            s.close()
-        return port_avail
+            # With a persistent session the broker holds pos/billing for us
+            # while this service restarts
+            self._messenger = Messenger.from_config(self._switch_config['SETTINGS'].get('MQTT'), MQTT_CLIENT_ID,
+                                                    backend=mqtt_backend)
+            self._messenger.subscribe(BROKER_POS_INIT_STATUS_TOPIC, self._on_init_status)
+            self._messenger.subscribe(BROKER_PRINTER_INIT_STATUS_TOPIC, self._on_init_status)
+            self._messenger.subscribe(BROKER_POS_BILL_STATUS_TOPIC, self._on_bill)
+            self._messenger.subscribe(BROKER_METRICS_DUMP_TOPIC, self._on_metrics_dump)
+            # Profiling and resource reports on demand, idle until asked
+            self._diagnostics = Diagnostics.from_config(self._switch_config['SETTINGS'].get('DIAGNOSTICS'),
+                                                        MQTT_CLIENT_ID, self._publish_diagnostics,
+                                                        counters=lambda: {"mqtt": dict(self._messenger.stats)})
+            self._messenger.subscribe(BROKER_CONTROL_TOPIC, self._diagnostics.handle)
+            self._messenger.start()
+        except Exception as e:
+            logging.error("Error in setting up local broker")
+            raise
+        self._enabled = self._switch.start(on_state=self._on_switch_state)
+        # A dead paho loop, connection or outbox thread is restarted in place
+        self._supervisor = Supervisor.from_config(self._switch_config['SETTINGS'].get('SUPERVISOR'))
+        self._supervisor.add("mqtt", alive=self._messenger.alive, restart=self._messenger.restart)
+        self._supervisor.add("switch", alive=self._switch.alive, restart=self._switch.restart,
+                             on_state=lambda ok: self._on_switch_state(ok and self._switch.connected))
+        self._supervisor.add("switch-config", alive=self._config.alive, restart=self._config.restart)
+        metrics_config = self._switch_config['SETTINGS'].get('METRICS') or {}
+        self._latency_interval = float(metrics_config.get('latency_interval', 60))
+            
+    def _on_switch_config_change(self, config, _):
+        # Config watcher thread
+        self._switch_config = config
+        self._switch.reconfigure(config)
+        metrics_config = config['SETTINGS'].get('METRICS') or {}
+        self._latency_interval = float(metrics_config.get('latency_interval', 60))
+
+    def _on_switch_state(self, connected):
+        self._enabled = connected
+        if connected:
+            self._startup.mark("switch")
+        self._messenger.publish_status(BROKER_SWITCH_INIT_STATUS_TOPIC, connected)
     
-    def _send_acc_command(self, acc_command):
-        try:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                s.settimeout(0.500)
-                for retry in range(0,5):
-                    logging.info("trying.. {} Sending ACC message to {}:{}".format(retry, self._switch_ip_address, self._switch_ip_port))
-                    s.connect((self._switch_ip_address, self._switch_ip_port))
-                    s.sendall(acc_command.encode())
+    def _on_init_status(self, message):
+        logging.debug("{} state: {}".format(message.topic, message.status()))
+
+    def _on_bill(self, message):
+        bill = parse_bill_payload(message.text())
+        if bill is not None:
+            self._switch.submit(*bill)
+        else:
+            logging.error("Unknown message on topic: {} = {}".format(message.topic, message.text()))
 
-                    # Receive reply
-                    data = s.recv(1024)
-                    if(data):
-                        reply = data.decode()
-                        logging.info("Received reply from storetracker {}".format(reply))
-                        break
-                    
-                s.close()
-                return reply
+    def _on_metrics_dump(self, message):
+        self._publish_latency_metrics(reset=False)
 
-        except Exception as e:
-            logging.error("Error sending ACC command to storetracker: {}".format(e))
-            return None
-    
-    def _generate_acc_command(self, checkout_id):
-        timestamp = time.strftime("%Y%m%d%H%M%S")
-        acc_command = f"ACC {timestamp}{checkout_id:04d}\n"
-        return acc_command
-    
-    def _on_connect(self, client, userdata, flags, rc):
-        logging.debug("Connected to message broker")
-        self._client.subscribe(BROKER_POS_INIT_STATUS_TOPIC)
-        self._client.subscribe(BROKER_PRINTER_INIT_STATUS_TOPIC)
-        self._client.subscribe(BROKER_POS_BILL_STATUS_TOPIC)
-        
-    def _on_message(self, client, userdata, msg):
-        logging.debug("Received message: {} {}".format(msg.topic, msg.payload.decode()))
-        if msg.topic == BROKER_POS_BILL_STATUS_TOPIC:
-            if msg.payload.decode() == "True":
-                acc_command = self._generate_acc_command(self._checkout_id)
-                logging.info("Sending ACC command: {}".format(acc_command))
-                try:
-                    self._send_acc_command(acc_command)
-                except Exception as e:
-                    logging.error("Error sending ACC command")
-            elif msg.payload.decode() == "False":
-                logging.info("Received a failed billing")
-            else:
-                logging.error("Unknown message on topic: {} = {}".format(msg.topic, msg.payload.decode()))
+    def _publish_diagnostics(self, report):
+        self._messenger.publish(BROKER_DIAGNOSTICS_TOPIC.format(MQTT_CLIENT_ID), json.dumps(report))
+
+    def _publish_latency_metrics(self, reset):
+        snapshot = self._switch.latency.snapshot(reset=reset)
+        logging.info("Latency switch (us): {}".format(snapshot))
+        self._messenger.publish_metric(BROKER_LATENCY_METRICS_TOPIC.format("switch"), snapshot)
+
+    def _publish_startup(self):
+        # The startup milestones once the broker is up, again when the
+        # switch is connected
+        if self._messenger.first_connect_ns is not None:
+            self._startup.mark("mqtt", self._messenger.first_connect_ns)
+        if not self._messenger.connected or self._startup_published == len(self._startup.marks):
+            return
+        report = self._startup.report(self._startup_budget_ms)
+        if self._startup_published is None:
+            logging.info("Startup (ms): {}".format(report))
+            if report["over_budget"]:
+                logging.warning("Startup took longer than the {} ms budget".format(self._startup_budget_ms))
+        self._startup_published = len(self._startup.marks)
+        self._startup_reported = "switch" in report
+        self._messenger.publish(BROKER_STARTUP_METRICS_TOPIC.format(MQTT_CLIENT_ID), json.dumps(report))
 
     def run(self):
         logging.info("starting storetracker state machine")
-        while True:
-            time.sleep(1)
+        # Work happens on the MQTT, connection and outbox threads, this one
+        # only publishes the startup report and the latency histograms
+        self._supervisor.start()
+        self._startup.mark("ready")
+        stopped = threading.Event()
+        next_latency_metrics = time.monotonic() + self._latency_interval
+        while not stopped.wait(1):
+            if not self._startup_reported:
+                self._publish_startup()
+            if time.monotonic() >= next_latency_metrics:
+                next_latency_metrics = time.monotonic() + self._latency_interval
+                self._publish_latency_metrics(reset=True)
         
         logging.info("Ending storetracker state machine")
 
@@ -149,13 +175,15 @@ if __name__ == '__main__':
     parser.add_argument('--log-level', default="INFO", choices=set(["CRITICAL", "ERROR", "WARNING", "INFO", "DEBUG"]))
     parser.add_argument('--switch-ip', default="192.168.0.2", help="Storetracker switch IP")
     parser.add_argument('--switch-port', default=25803, help="Storetracker switch port")
+    parser.add_argument('--config-cache', default=DEFAULT_CONFIG_CACHE_DIR, help="Directory for the compiled config cache, empty for none")
     
     args = parser.parse_args()
     logging.basicConfig(level=args.log_level, format='%(asctime)s %(message)s')
     
     logging.info("Starting Switch interface")
     try:
-        storetracker = SwitchInterface(switch_config=SWITCH_CONFIG_FILE, ip=args.switch_ip, port=int(args.switch_port))
+        storetracker = SwitchInterface(switch_config=SWITCH_CONFIG_FILE, ip=args.switch_ip, port=int(args.switch_port),
+                                       config_cache=args.config_cache)
     except Exception as e:
         logging.error("Error initializing the Switch interface, error = {}".format(e))
         exit(-1)
@@ -0,0 +1,309 @@
+import fcntl
+import logging
+import sqlite3
+import threading
+import time
+from switch_connection import NoReply
+
+STATE_PENDING = "pending"
+STATE_ACKED = "acked"
+STATE_UNACKED = "unacked"
+STATE_EXPIRED = "expired"
+
+DEFAULT_PATH = "/data/acc_outbox.db"
+DEFAULT_SYNCHRONOUS = "FULL"
+DEFAULT_BATCH_SIZE = 32
+DEFAULT_RETRY_INTERVAL = 1.0
+DEFAULT_MAX_AGE = 120.0
+DEFAULT_COALESCE_AFTER = 30.0
+DEFAULT_RETENTION = 7 * 24 * 3600.0
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    created REAL NOT NULL,
+    payload TEXT NOT NULL,
+    state TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    updated REAL,
+    reply TEXT,
+    tag TEXT,
+    key TEXT
+);
+CREATE INDEX IF NOT EXISTS outbox_state ON outbox (state, id);
+"""
+
+
+class AccOutbox:
+    # Append only outbox for ACC commands, kept in SQLite on /data.
+    # enqueue() hands the command to the drainer thread, which writes every
+    # command that arrived since its last pass in one transaction and then
+    # sends pending entries oldest first through send(payload, tag), tag is
+    # whatever the caller passed to enqueue(), e.g. a correlation id. A reply marks
+    # the entry acked. send() returning None means it was not sent (no
+    # connection, circuit open) and the entry stays pending for the next
+    # pass. send() raising NoReply means it went out and the switch did not
+    # answer, the switch may have opened the gate so the entry is marked
+    # unacked and never resent. Entries older than max_age are marked expired
+    # instead of opening a gate long after the customer left. enqueue() with a
+    # key, e.g. the checkout id, coalesces the backlog of an outage: once a
+    # send failed, pending entries older than coalesce_after that have a newer
+    # pending entry with the same key were for customers who already left and
+    # are marked expired, only the newest per key is sent. While the switch
+    # answers nothing is coalesced, a drain that lags behind a burst of bills
+    # sends every one of them. unacked and
+    # expired entries stay in the table for reconciliation.
+    # Only one process drains an outbox file: start() takes an exclusive lock
+    # on <path>.lock, and while another process (e.g. the storetracker
+    # container next to a unified pos-interface on the same /data) holds it,
+    # bills are kept in memory and nothing is sent until the lock is free.
+    # A command is sent again only when the process dies after a reply and
+    # before the batch's acks are written.
+    # synchronous defaults to FULL: every commit (one per batch of incoming
+    # bills, one per batch of acks) is fsynced, so a power cut cannot lose a
+    # bill that was enqueued or resend one that was acked. That costs an fsync
+    # per batch, a few ms on an SD card, see bench/bench_outbox.py. NORMAL
+    # only syncs at WAL checkpoints and can lose the last commits on power loss.
+    def __init__(self, send, path=DEFAULT_PATH, synchronous=DEFAULT_SYNCHRONOUS, batch_size=DEFAULT_BATCH_SIZE,
+                 retry_interval=DEFAULT_RETRY_INTERVAL, max_age=DEFAULT_MAX_AGE, retention=DEFAULT_RETENTION,
+                 coalesce_after=DEFAULT_COALESCE_AFTER):
+        self._send = send
+        self._path = path
+        self._synchronous = str(synchronous).upper()
+        self._batch_size = int(batch_size)
+        self._retry_interval = float(retry_interval)
+        self._max_age = float(max_age) if max_age else None
+        self._coalesce_after = float(coalesce_after) if coalesce_after else None
+        # Set by a send that failed, cleared by the next one the switch answers
+        self._outage = False
+        self._retention = float(retention)
+
+        self._incoming = []
+        self._cond = threading.Condition()
+        self._running = False
+        self._thread = None
+        self._db = None
+        self._lock_file = None
+        self._stats = {
+            "enqueued": 0,
+            "sent": 0,
+            "failed": 0,
+            "unacked": 0,
+            "expired": 0,
+            "coalesced": 0,
+            "pending": 0,
+        }
+
+    @classmethod
+    def from_config(cls, send, outbox_config):
+        outbox_config = outbox_config or {}
+        return cls(send,
+                   path=outbox_config.get('path', DEFAULT_PATH),
+                   synchronous=outbox_config.get('synchronous', DEFAULT_SYNCHRONOUS),
+                   batch_size=outbox_config.get('batch_size', DEFAULT_BATCH_SIZE),
+                   retry_interval=outbox_config.get('retry_interval', DEFAULT_RETRY_INTERVAL),
+                   max_age=outbox_config.get('max_age', DEFAULT_MAX_AGE),
+                   retention=outbox_config.get('retention', DEFAULT_RETENTION),
+                   coalesce_after=outbox_config.get('coalesce_after', DEFAULT_COALESCE_AFTER))
+
+    def configure(self, outbox_config):
+        # New batch, retry, age and retention settings for the running
+        # drainer. path and synchronous only change with a restart
+        fresh = AccOutbox.from_config(self._send, outbox_config)
+        if (fresh._path, fresh._synchronous) != (self._path, self._synchronous):
+            logging.warning("ACC outbox path/synchronous change needs a restart")
+        with self._cond:
+            for name in ("_batch_size", "_retry_interval", "_max_age", "_retention", "_coalesce_after"):
+                setattr(self, name, getattr(fresh, name))
+            self._cond.notify_all()
+
+    def start(self):
+        # Opened here so a bad path fails at init, then owned by the drainer
+        self._lock_file = open(self._path + ".lock", "a")
+        if self._lock():
+            self._db = self._open()
+        else:
+            logging.error("ACC outbox {} is used by another process, not sending until it is released".format(self._path))
+        self._running = True
+        self._thread = threading.Thread(target=self._drain, name="acc-outbox", daemon=True)
+        self._thread.start()
+
+    def alive(self):
+        return not self._running or self._thread is None or self._thread.is_alive()
+
+    def respawn(self):
+        # New drainer for one that died, the database connection is shared
+        # across threads (check_same_thread off) so it carries on with it
+        self._thread = threading.Thread(target=self._drain, name="acc-outbox", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def enqueue(self, payload, tag=None, key=None):
+        with self._cond:
+            self._incoming.append((time.time(), payload, tag, key))
+            self._stats["enqueued"] += 1
+            self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            return dict(self._stats)
+
+    def _lock(self):
+        # True once this process holds the outbox lock
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except BlockingIOError:
+            return False
+
+    def _open(self):
+        db = sqlite3.connect(self._path, isolation_level=None, check_same_thread=False)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous={}".format(self._synchronous))
+        db.executescript(_SCHEMA)
+        columns = [row[1] for row in db.execute("PRAGMA table_info(outbox)")]
+        if "tag" not in columns:
+            # Database from before tags
+            db.execute("ALTER TABLE outbox ADD COLUMN tag TEXT")
+        if "key" not in columns:
+            # Database from before coalescing
+            db.execute("ALTER TABLE outbox ADD COLUMN key TEXT")
+        pending = db.execute("SELECT COUNT(*) FROM outbox WHERE state = ?", (STATE_PENDING,)).fetchone()[0]
+        self._stats["pending"] = pending
+        if pending:
+            logging.warning("ACC outbox has {} pending entries from before restart".format(pending))
+            self._outage = True
+        return db
+
+    def _flush_incoming(self):
+        with self._cond:
+            incoming, self._incoming = self._incoming, []
+        if incoming:
+            with self._db:
+                self._db.execute("BEGIN")
+                self._db.executemany("INSERT INTO outbox (created, payload, tag, key) VALUES (?, ?, ?, ?)", incoming)
+            self._stats["pending"] += len(incoming)
+        return len(incoming)
+
+    def _expire(self, now):
+        if self._max_age is None:
+            return
+        with self._db:
+            self._db.execute("BEGIN")
+            expired = self._db.execute("UPDATE outbox SET state = ?, updated = ? WHERE state = ? AND created < ?",
+                                       (STATE_EXPIRED, now, STATE_PENDING, now - self._max_age)).rowcount
+        if expired:
+            logging.error("Expired {} ACC commands older than {}s".format(expired, self._max_age))
+            self._stats["expired"] += expired
+            self._stats["pending"] -= expired
+
+    def _coalesce(self, now):
+        # During an outage only the newest pending entry per key is kept of
+        # those older than coalesce_after, the backlog opens each gate once
+        if not self._outage or self._coalesce_after is None:
+            return
+        with self._db:
+            self._db.execute("BEGIN")
+            coalesced = self._db.execute(
+                "UPDATE outbox SET state = ?, updated = ? WHERE state = ? AND key IS NOT NULL AND created < ? AND id < "
+                "(SELECT MAX(newer.id) FROM outbox AS newer WHERE newer.state = ? AND newer.key = outbox.key)",
+                (STATE_EXPIRED, now, STATE_PENDING, now - self._coalesce_after, STATE_PENDING)).rowcount
+        if coalesced:
+            logging.warning("Coalesced {} stale ACC commands, sending the newest per checkout".format(coalesced))
+            self._stats["coalesced"] += coalesced
+            self._stats["pending"] -= coalesced
+
+    def _prune(self, now):
+        with self._db:
+            self._db.execute("BEGIN")
+            self._db.execute("DELETE FROM outbox WHERE state != ? AND updated < ?", (STATE_PENDING, now - self._retention))
+
+    def _send_batch(self):
+        # Sends up to batch_size pending entries in order, acks are written
+        # together at the end. Returns False when an entry could not be sent
+        rows = self._db.execute("SELECT id, payload, tag FROM outbox WHERE state = ? ORDER BY id LIMIT ?",
+                                (STATE_PENDING, self._batch_size)).fetchall()
+        acked = []
+        ok = True
+        for row_id, payload, tag in rows:
+            # Keep picking up new bills between sends during a long backlog
+            self._flush_incoming()
+            try:
+                reply = self._send(payload, tag)
+            except NoReply as e:
+                # Sent, the outcome is unknown. Written right away, a resend
+                # could open the gate twice
+                logging.error("ACC command {} id={} unacked: {}".format(payload.strip(), tag, e))
+                with self._db:
+                    self._db.execute("BEGIN")
+                    self._db.execute("UPDATE outbox SET state = ?, updated = ?, attempts = attempts + 1 WHERE id = ?",
+                                     (STATE_UNACKED, time.time(), row_id))
+                self._stats["unacked"] += 1
+                self._stats["pending"] -= 1
+                self._outage = False
+                continue
+            if reply is None:
+                ok = False
+                self._outage = True
+                self._stats["failed"] += 1
+                self._db.execute("UPDATE outbox SET attempts = attempts + 1, updated = ? WHERE id = ?", (time.time(), row_id))
+                break
+            acked.append((STATE_ACKED, time.time(), reply, row_id))
+            self._outage = False
+        if acked:
+            with self._db:
+                self._db.execute("BEGIN")
+                self._db.executemany("UPDATE outbox SET state = ?, updated = ?, reply = ?, attempts = attempts + 1 WHERE id = ?", acked)
+            self._stats["sent"] += len(acked)
+            self._stats["pending"] -= len(acked)
+        return ok and len(rows) > 0
+
+    def _drain(self):
+        logging.info("Starting ACC outbox drainer, {}".format(self._path))
+        last_prune = 0.0
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._incoming or not self._running or self._stats["pending"],
+                                    timeout=self._retry_interval)
+                if not self._running:
+                    break
+            if self._db is None:
+                # Another process drains this outbox, bills wait in memory
+                if not self._lock():
+                    with self._cond:
+                        self._cond.wait_for(lambda: not self._running, timeout=self._retry_interval)
+                    continue
+                logging.info("ACC outbox {} released by the other process".format(self._path))
+                self._db = self._open()
+            try:
+                self._flush_incoming()
+                now = time.time()
+                self._expire(now)
+                self._coalesce(now)
+                if now - last_prune > 3600:
+                    last_prune = now
+                    self._prune(now)
+                # Drain everything pending while the switch keeps answering
+                while self._stats["pending"] > 0 and self._running:
+                    if not self._send_batch():
+                        break
+                if self._stats["pending"] > 0:
+                    # Switch is not answering, do not spin on it
+                    with self._cond:
+                        self._cond.wait_for(lambda: self._incoming or not self._running, timeout=self._retry_interval)
+            except sqlite3.Error as e:
+                logging.error("ACC outbox error: {}".format(e))
+                time.sleep(self._retry_interval)
+        if self._db is not None:
+            self._flush_incoming()
+            self._db.close()
+        elif self._incoming:
+            logging.error("Dropping {} ACC commands, the outbox was never free".format(len(self._incoming)))
+        self._lock_file.close()
+        logging.info("ACC outbox drainer stopped")
@@ -0,0 +1,175 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from latency import LatencyRecorder, now_ns
+from switch_connection import SwitchConnection
+from outbox import AccOutbox
+
+# Traces of bills still in the outbox, oldest are dropped past this
+MAX_PENDING_TRACES = 1024
+# Transaction ids remembered for txn_window seconds, at most this many
+MAX_SEEN_TRANSACTIONS = 4096
+DEFAULT_TXN_WINDOW = 300.0
+
+
+def validate_switch_config(switch_config):
+    # Raises ValueError for a switch config the client cannot run with
+    try:
+        settings = switch_config['SETTINGS']
+        checkout_id = int(settings['checkout_id'])
+        if not 0 <= checkout_id <= 9999:
+            raise ValueError("checkout_id {} does not fit the ACC command".format(checkout_id))
+        if float(settings.get('txn_window', DEFAULT_TXN_WINDOW)) < 0:
+            raise ValueError("txn_window must not be negative")
+        SwitchConnection.from_config("0.0.0.0", 0, settings.get('CONNECTION'))
+        AccOutbox.from_config(None, settings.get('OUTBOX'))
+    except (KeyError, TypeError, ValueError, AttributeError) as e:
+        raise ValueError("invalid switch config: {}: {}".format(type(e).__name__, e))
+
+
+class SwitchClient:
+    # Storetracker side of a bill: the switch connection plus the ACC outbox.
+    # SwitchInterface feeds it from MQTT, the unified runtime in pos-interface
+    # calls submit() directly from the POS loop. outbox_path, when given,
+    # replaces OUTBOX.path so the two runtimes never share an outbox
+    def __init__(self, switch_config, ip, port, outbox_path=None):
+        self._switch_config = switch_config
+        self._switch_ip_address = ip
+        self._switch_ip_port = int(port)
+        self._checkout_id = switch_config['SETTINGS']['checkout_id']
+        self._connection = None
+        self._outbox = None
+        self._outbox_path = outbox_path
+        # switch.hop: POS classification to here (MQTT, or a call in unified mode)
+        # switch.queue: time in the outbox, switch.rtt: ACC round trip
+        # bill.total: first POS byte of the line to the switch reply
+        self.latency = LatencyRecorder(("switch.hop", "switch.queue", "switch.rtt", "bill.total"))
+        self._traces = OrderedDict()
+        self._traces_lock = threading.Lock()
+        # A transaction id seen within txn_window is a duplicate, e.g. the
+        # same bill over MQTT twice or a reprinted receipt
+        self._txn_window = float(switch_config['SETTINGS'].get('txn_window', DEFAULT_TXN_WINDOW))
+        self._txns = OrderedDict()
+        self._txns_lock = threading.Lock()
+        self.duplicates = 0
+
+    def start(self, on_state=None):
+        # on_state(bool) is called whenever the switch connection goes up or down
+        self._connection = SwitchConnection.from_config(self._switch_ip_address, self._switch_ip_port,
+                                                        self._switch_config['SETTINGS'].get('CONNECTION'),
+                                                        on_state=on_state)
+        connected = self._connection.start()
+        if not connected:
+            logging.error("Error connecting to IP {}:{}, retrying in background".format(self._switch_ip_address, self._switch_ip_port))
+        else:
+            logging.info("Switch init successful, using store tracker on IP {}:{}".format(self._switch_ip_address, self._switch_ip_port))
+
+        # Bills go through a durable outbox so an ACC survives a switch outage
+        self._outbox = AccOutbox.from_config(self.send_acc_command, self._outbox_config(self._switch_config['SETTINGS']))
+        self._outbox.start()
+        return connected
+
+    def reconfigure(self, switch_config):
+        # Applies a changed switch config to the running client, called from
+        # the config watcher. The connection and outbox stay up
+        settings = switch_config['SETTINGS']
+        self._switch_config = switch_config
+        self._checkout_id = settings['checkout_id']
+        self._txn_window = float(settings.get('txn_window', DEFAULT_TXN_WINDOW))
+        if self._connection is not None:
+            self._connection.configure(settings.get('CONNECTION'))
+        if self._outbox is not None:
+            self._outbox.configure(self._outbox_config(settings))
+        logging.info("Switch config applied, checkout_id {}".format(self._checkout_id))
+
+    def _outbox_config(self, settings):
+        outbox_config = dict(settings.get('OUTBOX') or {})
+        if self._outbox_path is not None:
+            outbox_config['path'] = self._outbox_path
+        return outbox_config
+
+    @property
+    def connected(self):
+        return self._connection is not None and self._connection.connected
+
+    def alive(self):
+        # False when the connection or outbox thread died
+        return all(part is None or part.alive() for part in (self._connection, self._outbox))
+
+    def restart(self):
+        for part in (self._connection, self._outbox):
+            if part is not None and not part.alive():
+                part.respawn()
+
+    def stop(self):
+        if self._outbox is not None:
+            self._outbox.stop(timeout=2)
+        if self._connection is not None:
+            self._connection.stop()
+
+    def _seen_transaction(self, key):
+        now = time.monotonic()
+        with self._txns_lock:
+            while self._txns:
+                oldest, seen = next(iter(self._txns.items()))
+                if now - seen < self._txn_window and len(self._txns) < MAX_SEEN_TRANSACTIONS:
+                    break
+                self._txns.popitem(last=False)
+            if key in self._txns:
+                self.duplicates += 1
+                return True
+            self._txns[key] = now
+            return False
+
+    def submit(self, bill_ok, trace=None, checkout_id=None):
+        # trace is the dict pos-interface attached to the bill, if any.
+        # checkout_id is the lane's in a multi-lane install, else the config one
+        received_ns = now_ns()
+        corr_id = None
+        if trace:
+            corr_id = trace["id"]
+            self.latency.record("switch.hop", trace.get("classified_ns"), received_ns)
+            txn = trace.get("txn")
+            if txn and self._seen_transaction((checkout_id, txn)):
+                logging.info("Dropping duplicate transaction {} id={}".format(txn, corr_id))
+                return
+        if bill_ok:
+            checkout_id = self._checkout_id if checkout_id is None else checkout_id
+            acc_command = self.generate_acc_command(checkout_id)
+            logging.info("Queueing ACC command: {} id={}".format(acc_command.strip(), corr_id))
+            if corr_id is not None:
+                with self._traces_lock:
+                    self._traces[corr_id] = (trace.get("rx_ns"), received_ns)
+                    while len(self._traces) > MAX_PENDING_TRACES:
+                        self._traces.popitem(last=False)
+            # Keyed by checkout, a backlog only opens each gate once
+            self._outbox.enqueue(acc_command, tag=corr_id, key=str(checkout_id))
+        else:
+            logging.info("Received a failed billing id={}".format(corr_id))
+
+    def send_acc_command(self, acc_command, tag=None):
+        logging.info("Sending ACC message to {}:{} id={}".format(self._switch_ip_address, self._switch_ip_port, tag))
+        with self._traces_lock:
+            rx_ns, received_ns = self._traces.get(tag, (None, None))
+        send_ns = now_ns()
+        self.latency.record("switch.queue", received_ns, send_ns)
+        # NoReply goes up to the outbox, which must not resend it
+        data = self._connection.send(acc_command.encode())
+        if data is None:
+            logging.error("Error sending ACC command to storetracker")
+            return None
+        reply_ns = now_ns()
+        self.latency.record("switch.rtt", send_ns, reply_ns)
+        self.latency.record("bill.total", rx_ns, reply_ns)
+        with self._traces_lock:
+            self._traces.pop(tag, None)
+        reply = data.decode(errors="replace")
+        logging.info("Received reply from storetracker {}".format(reply))
+        return reply
+
+    @staticmethod
+    def generate_acc_command(checkout_id):
+        timestamp = time.strftime("%Y%m%d%H%M%S")
+        acc_command = f"ACC {timestamp}{checkout_id:04d}\n"
+        return acc_command
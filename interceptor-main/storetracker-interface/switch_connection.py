@@ -0,0 +1,251 @@
+import logging
+import random
+import select
+import socket
+import threading
+import time
+
+DEFAULT_CONNECT_TIMEOUT = 1.0
+DEFAULT_REPLY_TIMEOUT = 0.5
+DEFAULT_BACKOFF_MIN = 0.2
+DEFAULT_BACKOFF_MAX = 10.0
+DEFAULT_BREAKER_THRESHOLD = 3
+DEFAULT_BREAKER_RESET = 5.0
+DEFAULT_PROBE_INTERVAL = 10.0
+DEFAULT_KEEPALIVE_IDLE = 10
+DEFAULT_KEEPALIVE_INTERVAL = 3
+DEFAULT_KEEPALIVE_COUNT = 3
+
+
+class NoReply(Exception):
+    # The payload went out but the switch did not answer in reply_timeout.
+    # It may have acted on it, so it must not be sent again
+    pass
+
+
+class SwitchConnection:
+    # Long lived TCP connection to the storetracker switch.
+    # A background thread keeps it up: reconnects with jittered backoff and
+    # probes it every probe_interval seconds. send() never waits on a switch
+    # known to be down, after breaker_threshold failures in a row the breaker
+    # opens and sends fail fast for breaker_reset seconds or until the
+    # background thread gets a connection back.
+    def __init__(self, ip, port, connect_timeout=DEFAULT_CONNECT_TIMEOUT, reply_timeout=DEFAULT_REPLY_TIMEOUT,
+                 backoff_min=DEFAULT_BACKOFF_MIN, backoff_max=DEFAULT_BACKOFF_MAX,
+                 breaker_threshold=DEFAULT_BREAKER_THRESHOLD, breaker_reset=DEFAULT_BREAKER_RESET,
+                 probe_interval=DEFAULT_PROBE_INTERVAL, probe_command=None,
+                 keepalive_idle=DEFAULT_KEEPALIVE_IDLE, keepalive_interval=DEFAULT_KEEPALIVE_INTERVAL,
+                 keepalive_count=DEFAULT_KEEPALIVE_COUNT, on_state=None):
+        self._address = (ip, int(port))
+        self._connect_timeout = float(connect_timeout)
+        self._reply_timeout = float(reply_timeout)
+        self._backoff_min = float(backoff_min)
+        self._backoff_max = float(backoff_max)
+        self._breaker_threshold = int(breaker_threshold)
+        self._breaker_reset = float(breaker_reset)
+        self._probe_interval = float(probe_interval)
+        self._probe_command = probe_command.encode() if isinstance(probe_command, str) and probe_command else None
+        self._keepalive = (int(keepalive_idle), int(keepalive_interval), int(keepalive_count))
+        self._on_state = on_state
+
+        self._sock = None
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._running = False
+        self._thread = None
+        self._failures = 0
+        self._open_until = 0.0
+        self._backoff = self._backoff_min
+        self._last_activity = 0.0
+        self._state = None
+
+    @classmethod
+    def from_config(cls, ip, port, connection_config, on_state=None):
+        connection_config = connection_config or {}
+        return cls(ip, port, on_state=on_state,
+                   connect_timeout=connection_config.get('connect_timeout', DEFAULT_CONNECT_TIMEOUT),
+                   reply_timeout=connection_config.get('reply_timeout', DEFAULT_REPLY_TIMEOUT),
+                   backoff_min=connection_config.get('backoff_min', DEFAULT_BACKOFF_MIN),
+                   backoff_max=connection_config.get('backoff_max', DEFAULT_BACKOFF_MAX),
+                   breaker_threshold=connection_config.get('breaker_threshold', DEFAULT_BREAKER_THRESHOLD),
+                   breaker_reset=connection_config.get('breaker_reset', DEFAULT_BREAKER_RESET),
+                   probe_interval=connection_config.get('probe_interval', DEFAULT_PROBE_INTERVAL),
+                   probe_command=connection_config.get('probe_command'),
+                   keepalive_idle=connection_config.get('keepalive_idle', DEFAULT_KEEPALIVE_IDLE),
+                   keepalive_interval=connection_config.get('keepalive_interval', DEFAULT_KEEPALIVE_INTERVAL),
+                   keepalive_count=connection_config.get('keepalive_count', DEFAULT_KEEPALIVE_COUNT))
+
+    def configure(self, connection_config):
+        # New timeouts, backoff, breaker and probe settings for the running
+        # connection, the address stays and keepalive applies from the next
+        # connect
+        fresh = SwitchConnection.from_config(self._address[0], self._address[1], connection_config)
+        for name in ("_connect_timeout", "_reply_timeout", "_backoff_min", "_backoff_max", "_breaker_threshold",
+                     "_breaker_reset", "_probe_interval", "_probe_command", "_keepalive"):
+            setattr(self, name, getattr(fresh, name))
+        self._wakeup.set()
+
+    @property
+    def connected(self):
+        return self._sock is not None
+
+    @property
+    def breaker_open(self):
+        return time.monotonic() < self._open_until
+
+    def start(self):
+        # Connects once in the caller's thread, then keeps the link up
+        with self._lock:
+            self._connect_locked()
+        self._running = True
+        self._thread = threading.Thread(target=self._maintain, name="switch-connection", daemon=True)
+        self._thread.start()
+        return self.connected
+
+    def alive(self):
+        return not self._running or self._thread is None or self._thread.is_alive()
+
+    def respawn(self):
+        # New background thread for one that died, the socket stays
+        self._thread = threading.Thread(target=self._maintain, name="switch-connection", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self._connect_timeout + 1)
+        with self._lock:
+            self._close_locked()
+
+    def send(self, payload):
+        # Sends payload and returns the reply bytes, or None if it was not
+        # sent because the switch could not be reached. Raises NoReply when it
+        # was sent and no reply came in reply_timeout
+        if self.breaker_open:
+            logging.warning("Switch circuit open, not sending")
+            return None
+        with self._lock:
+            for attempt in range(2):
+                if self._sock is not None and not self._alive_locked():
+                    # Hung up while idle, not a failure of this send
+                    self._close_locked()
+                if self._sock is None and not self._connect_locked():
+                    return None
+                try:
+                    self._sock.sendall(payload)
+                    self._sock.settimeout(self._reply_timeout)
+                    reply = self._sock.recv(1024)
+                except socket.timeout:
+                    # The switch may have acted on it, do not send it twice
+                    logging.error("No reply from storetracker in {}s".format(self._reply_timeout))
+                    self._failed_locked()
+                    raise NoReply("no reply in {}s".format(self._reply_timeout))
+                except OSError as e:
+                    logging.warning("Switch connection error: {}".format(e))
+                    reply = b""
+                if reply:
+                    self._succeeded_locked()
+                    return reply
+                # Reset or closed, usually a connection that went stale while
+                # idle and the switch never saw the payload. Retry once on a
+                # fresh connection
+                self._failed_locked()
+            return None
+
+    def _connect_locked(self):
+        self._close_locked()
+        try:
+            sock = socket.create_connection(self._address, timeout=self._connect_timeout)
+        except OSError as e:
+            logging.info("Could not connect to storetracker {}:{} {}".format(self._address[0], self._address[1], e))
+            self._failed_locked()
+            return False
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        if hasattr(socket, "TCP_KEEPIDLE"):
+            idle, interval, count = self._keepalive
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, idle)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, interval)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, count)
+        self._sock = sock
+        logging.info("Connected to storetracker {}:{}".format(self._address[0], self._address[1]))
+        self._succeeded_locked()
+        return True
+
+    def _close_locked(self):
+        if self._sock is not None:
+            try:
+                self._sock.close()
+            except OSError:
+                pass
+            self._sock = None
+
+    def _alive_locked(self):
+        # Drops late replies to an earlier timed out command so they are not
+        # taken as the reply to the next one. False if the switch hung up
+        try:
+            while select.select([self._sock], [], [], 0)[0]:
+                if not self._sock.recv(1024):
+                    return False
+        except OSError:
+            return False
+        return True
+
+    def _succeeded_locked(self):
+        self._failures = 0
+        self._open_until = 0.0
+        self._backoff = self._backoff_min
+        self._last_activity = time.monotonic()
+        self._set_state(True)
+
+    def _failed_locked(self):
+        self._close_locked()
+        self._failures += 1
+        if self._failures >= self._breaker_threshold and not self.breaker_open:
+            logging.error("Storetracker failed {} times, opening circuit for {}s".format(self._failures, self._breaker_reset))
+            self._open_until = time.monotonic() + self._breaker_reset
+        self._set_state(False)
+        self._wakeup.set()
+
+    def _set_state(self, state):
+        if state != self._state:
+            self._state = state
+            if self._on_state is not None:
+                self._on_state(state)
+
+    def _probe_locked(self):
+        try:
+            # Without a probe command this only notices a closed connection,
+            # keepalive covers a switch that vanished without closing it
+            if not self._alive_locked():
+                raise ConnectionResetError("closed by storetracker")
+            if self._probe_command is not None:
+                self._sock.sendall(self._probe_command)
+                self._sock.settimeout(self._reply_timeout)
+                if not self._sock.recv(1024):
+                    raise ConnectionResetError("closed by storetracker")
+            self._last_activity = time.monotonic()
+            return True
+        except OSError as e:
+            logging.warning("Storetracker health probe failed: {}".format(e))
+            self._failed_locked()
+            return False
+
+    def _maintain(self):
+        while self._running:
+            self._wakeup.clear()
+            if self._sock is None:
+                delay = self._backoff * random.uniform(0.5, 1.0)
+                self._backoff = min(self._backoff * 2, self._backoff_max)
+            else:
+                delay = max(0.0, self._last_activity + self._probe_interval - time.monotonic())
+            self._wakeup.wait(delay)
+            if not self._running:
+                break
+            with self._lock:
+                if self._sock is None:
+                    if self._connect_locked():
+                        logging.info("Reconnected to storetracker")
+                elif time.monotonic() - self._last_activity >= self._probe_interval:
+                    self._probe_locked()